@@ -0,0 +1,836 @@
+import atexit
+import base64
+import bisect
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+def leer_json(archivo):
+    """Lee una lista JSON desde disco; devuelve [] si no existe o es invalida."""
+    if os.path.exists(archivo):
+        try:
+            with open(archivo, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return []
+    return []
+
+
+def escribir_json(archivo, datos):
+    """Escribe datos JSON en disco de forma atomica (archivo temporal + replace)."""
+    temporal = f"{archivo}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(datos, f, ensure_ascii=False, indent=2)
+    os.replace(temporal, archivo)
+
+
+ARCHIVO_ELEMENTOS = 'elementos_mapa.json'
+ARCHIVO_CAPAS = 'capas_mapa.json'
+ARCHIVO_DIARIO = 'elementos_mapa.diario.jsonl'
+ARCHIVO_DB = 'mapa_datos.sqlite3'
+DIRECTORIO_ICONOS = 'iconos_mapa'
+PREFIJO_ICONO = 'sha256:'
+TIPOS_ICONO = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'gif': 'image/gif',
+    'svg': 'image/svg+xml',
+}
+
+
+def guardar_icono(datos, extension='png', directorio=DIRECTORIO_ICONOS):
+    """Guarda un icono direccionado por su contenido y devuelve su referencia.
+
+    El archivo se nombra con el SHA-256 de los bytes, asi que un mismo icono
+    usado por muchos elementos se guarda una sola vez. La referencia tiene la
+    forma 'sha256:<hash>'.
+    """
+    clave = hashlib.sha256(datos).hexdigest()
+    ruta = os.path.join(directorio, f"{clave}.{extension}")
+    if not os.path.exists(ruta):
+        os.makedirs(directorio, exist_ok=True)
+        # Temporal unico: varios procesos pueden guardar el mismo icono a la vez
+        descriptor, temporal = tempfile.mkstemp(dir=directorio, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(datos)
+        os.replace(temporal, ruta)
+    return PREFIJO_ICONO + clave
+
+
+def decodificar_icono(valor):
+    """Devuelve (bytes, extension) de un icono 'data:image/...;base64,...', o None si no lo es."""
+    if not isinstance(valor, str) or not valor.startswith('data:image/') or ';base64,' not in valor:
+        return None
+    cabecera, contenido = valor.split(',', 1)
+    mime = cabecera[5:].split(';')[0]
+    extension = next((ext for ext, tipo in TIPOS_ICONO.items() if tipo == mime), 'png')
+    return base64.b64decode(contenido), extension
+
+
+def internar_icono(valor, directorio=DIRECTORIO_ICONOS):
+    """Sustituye un icono 'data:image/...;base64,...' por su referencia en el almacen de iconos."""
+    decodificado = decodificar_icono(valor)
+    if decodificado is None:
+        return valor
+    return guardar_icono(*decodificado, directorio)
+
+
+def buscar_icono(clave, directorio=DIRECTORIO_ICONOS):
+    """Devuelve (ruta, mimetype) del icono con ese hash, o None si no existe."""
+    if clave.startswith(PREFIJO_ICONO):
+        clave = clave[len(PREFIJO_ICONO):]
+    if len(clave) != 64 or any(c not in '0123456789abcdef' for c in clave):
+        return None
+    for extension, mimetype in TIPOS_ICONO.items():
+        ruta = os.path.join(directorio, f"{clave}.{extension}")
+        if os.path.exists(ruta):
+            return ruta, mimetype
+    return None
+
+
+def partes_operacion(op):
+    """Devuelve que archivos ('elementos', 'capas') modifica una operacion."""
+    tipo = op['op']
+    if tipo == 'lote':
+        partes = set()
+        for sub in op['operaciones']:
+            partes |= partes_operacion(sub)
+        return partes
+    if tipo == 'eliminar_capa':
+        return {'elementos', 'capas'}
+    if tipo.endswith('capa') or tipo == 'reemplazar_capas':
+        return {'capas'}
+    return {'elementos'}
+
+
+def cambios_operacion(op):
+    """(ids de elementos, ids de capas, completo) que toca una operacion ya aplicada.
+
+    `completo` es True si la operacion sustituye el estado entero
+    (reemplazar, reemplazar_capas o la recarga desde disco).
+    """
+    tipo = op['op']
+    if tipo in ('reemplazar', 'reemplazar_capas', 'recargar'):
+        return set(), set(), True
+    if tipo == 'lote':
+        elementos, capas = set(), set()
+        for sub in op['operaciones']:
+            sub_elementos, sub_capas, completo = cambios_operacion(sub)
+            if completo:
+                return set(), set(), True
+            elementos |= sub_elementos
+            capas |= sub_capas
+        return elementos, capas, False
+    if tipo == 'agregar':
+        return {op['elemento']['id']}, set(), False
+    if tipo in ('actualizar', 'eliminar'):
+        return {op['id']}, set(), False
+    if tipo == 'agregar_capa':
+        return set(), {op['capa']['id']}, False
+    if tipo == 'eliminar_capa':
+        return set(op.get('desasignados', ())), {op['id']}, False
+    return set(), {op['id']}, False
+
+
+class LoteRechazado(ValueError):
+    """Un lote no se aplico porque la operacion en `posicion` no encontro su elemento o capa."""
+
+    def __init__(self, posicion, op):
+        super().__init__(f"Operacion {posicion} ({op['op']}): no existe el id {op['id']}")
+        self.posicion = posicion
+        self.op = op
+
+
+class RegistroCambios:
+    """Revision global del almacen y registro de los elementos y capas cambiados en cada una.
+
+    Se suscribe al almacen con `registrar`: cada operacion aplicada avanza
+    la revision y anota los ids que toca. Las revisiones empiezan en el
+    instante de arranque en microsegundos, asi que siguen creciendo entre
+    reinicios y una revision de otro proceso nunca se confunde con una de
+    este. Solo se guardan las ultimas `max_entradas` anotaciones; las
+    revisiones anteriores a lo guardado (o a un reemplazo completo) ya no
+    admiten un delta y piden resincronizar todo.
+    """
+
+    def __init__(self, max_entradas=100000):
+        self.max_entradas = max_entradas
+        self._lock = threading.Condition()
+        self.revision = time.time_ns() // 1000
+        self._minima = self.revision
+        self._revisiones = []
+        self._cambios = []
+
+    def registrar(self, op):
+        elementos, capas, completo = cambios_operacion(op)
+        with self._lock:
+            self.revision += 1
+            self._lock.notify_all()
+            if completo:
+                self._minima = self.revision
+                self._revisiones.clear()
+                self._cambios.clear()
+                return
+            cambios = [('elemento', i) for i in elementos] + [('capa', i) for i in capas]
+            self._revisiones.extend([self.revision] * len(cambios))
+            self._cambios.extend(cambios)
+            if len(self._cambios) > self.max_entradas:
+                sobran = len(self._cambios) - self.max_entradas // 2
+                self._minima = self._revisiones[sobran - 1]
+                del self._revisiones[:sobran]
+                del self._cambios[:sobran]
+
+    def esperar(self, revision, tiempo):
+        """Espera hasta `tiempo` segundos a que la revision deje de ser `revision`; devuelve la actual."""
+        with self._lock:
+            self._lock.wait_for(lambda: self.revision != revision, tiempo)
+            return self.revision
+
+    def desde(self, revision):
+        """(revision actual, ids de elementos, ids de capas) cambiados despues de `revision`.
+
+        Los ids son None si el registro ya no cubre esa revision y hay que
+        volver a pedir el estado completo.
+        """
+        with self._lock:
+            if not self._minima <= revision <= self.revision:
+                return self.revision, None, None
+            cambios = self._cambios[bisect.bisect_right(self._revisiones, revision):]
+            actual = self.revision
+        elementos = {i for tipo, i in cambios if tipo == 'elemento'}
+        capas = {i for tipo, i in cambios if tipo == 'capa'}
+        return actual, elementos, capas
+
+
+def caja_elemento(elemento):
+    """Calcula la caja envolvente (min_lon, max_lon, min_lat, max_lat) de un elemento.
+
+    Los circulos y torres se expanden por su radio. Devuelve None si el
+    elemento no tiene coordenadas validas.
+    """
+    try:
+        if elemento.get('tipo') == 'ruta':
+            puntos = elemento.get('puntos') or []
+            if not puntos:
+                return None
+            lats = [float(p[0]) for p in puntos]
+            lons = [float(p[1]) for p in puntos]
+            return min(lons), max(lons), min(lats), max(lats)
+        lat = float(elemento['lat'])
+        lon = float(elemento['lon'])
+    except (KeyError, TypeError, ValueError, IndexError):
+        return None
+    radio = elemento.get('radio') if elemento.get('tipo') in ('circulo', 'torre') else 0
+    d_lat = float(radio or 0) / 111320
+    d_lon = d_lat / max(math.cos(math.radians(lat)), 1e-6)
+    return lon - d_lon, lon + d_lon, lat - d_lat, lat + d_lat
+
+
+class AlmacenMapa:
+    """Almacen en memoria de elementos y capas con escritura diferida a disco.
+
+    Los elementos y capas se indexan por id en diccionarios (que conservan el
+    orden de insercion) y se sirven desde memoria. Toda modificacion se
+    expresa como una operacion (dict con clave 'op') que se aplica con
+    `aplicar()`, lo que permite deshacer/rehacer cualquier cambio.
+
+    Hay dos modos de persistencia:
+    - Instantanea (por defecto): cada modificacion programa una reescritura
+      de los archivos JSON tras `retardo` segundos; varias modificaciones
+      seguidas se agrupan en una sola escritura.
+    - Diario (`diario` = ruta de archivo): cada operacion se agrega como una
+      linea al diario; cada `compactar_cada` operaciones (y al cerrar) se
+      escribe la instantanea JSON y se vacia el diario. Al arrancar se lee la
+      instantanea y se reproducen las operaciones del diario.
+
+    Al terminar el proceso se fuerza la escritura pendiente.
+    """
+
+    def __init__(self, archivo_elementos, archivo_capas, retardo=1.0, diario=None,
+                 compactar_cada=500, max_historial=100):
+        self.archivo_elementos = archivo_elementos
+        self.archivo_capas = archivo_capas
+        self.archivo_diario = diario
+        self.retardo = retardo
+        self.compactar_cada = compactar_cada
+        self.max_historial = max_historial
+        self._lock = threading.RLock()
+        self._elementos = None
+        self._capas = None
+        self._siguiente_id = 1
+        self._siguiente_id_capa = 1
+        self._sucio = set()
+        self._timer = None
+        self._ops_diario = 0
+        self._historial = []
+        self._rehacer = []
+        self._oyentes = []
+        atexit.register(self.guardar)
+
+    def suscribir(self, oyente):
+        """Registra una funcion que recibe cada operacion aplicada.
+
+        Al (re)cargar el estado desde disco se notifica {'op': 'recargar'}.
+        Los oyentes se invocan con el almacen bloqueado.
+        """
+        self._oyentes.append(oyente)
+
+    def _notificar(self, op):
+        for oyente in self._oyentes:
+            oyente(op)
+
+    def _cargar(self):
+        if self._elementos is not None:
+            return
+        self._leer_estado()
+        self._notificar({'op': 'recargar'})
+
+    def _leer_estado(self):
+        self._elementos = {e['id']: e for e in leer_json(self.archivo_elementos)}
+        self._siguiente_id = max(self._elementos, default=0) + 1
+        self._capas = {c['id']: c for c in leer_json(self.archivo_capas)}
+        self._siguiente_id_capa = max(self._capas, default=0) + 1
+        if self.archivo_diario and os.path.exists(self.archivo_diario):
+            with open(self.archivo_diario, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        op = json.loads(linea)
+                    except ValueError:
+                        # Linea incompleta por un cierre abrupto: se ignora
+                        continue
+                    self._aplicar(op)
+                    self._ops_diario += 1
+
+    def _marcar_sucio(self, partes):
+        self._sucio.update(partes)
+        if self._timer is None:
+            self._timer = threading.Timer(self.retardo, self.guardar)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _persistir(self, op):
+        if not self.archivo_diario:
+            self._marcar_sucio(partes_operacion(op))
+            return
+        with open(self.archivo_diario, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(op, ensure_ascii=False) + '\n')
+        self._ops_diario += 1
+        if self._ops_diario >= self.compactar_cada:
+            self.compactar()
+
+    def compactar(self):
+        """Escribe la instantanea completa y vacia el diario de operaciones."""
+        with self._lock:
+            if self._elementos is None:
+                return
+            escribir_json(self.archivo_elementos, list(self._elementos.values()))
+            escribir_json(self.archivo_capas, list(self._capas.values()))
+            if self.archivo_diario and os.path.exists(self.archivo_diario):
+                os.remove(self.archivo_diario)
+            self._ops_diario = 0
+            self._sucio.clear()
+
+    def guardar(self):
+        """Escribe a disco los cambios pendientes."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.archivo_diario:
+                if self._ops_diario:
+                    self.compactar()
+                return
+            if 'elementos' in self._sucio:
+                escribir_json(self.archivo_elementos, list(self._elementos.values()))
+            if 'capas' in self._sucio:
+                escribir_json(self.archivo_capas, list(self._capas.values()))
+            self._sucio.clear()
+
+    def descartar(self):
+        """Olvida el estado en memoria para releerlo de disco en el proximo acceso."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._sucio.clear()
+            self._elementos = None
+            self._capas = None
+            self._ops_diario = 0
+            self._historial = []
+            self._rehacer = []
+
+    def _aplicar(self, op):
+        """Aplica una operacion sobre el estado en memoria.
+
+        Devuelve (resultado, efectiva, inversa). `efectiva` es la operacion
+        tal como se aplico (con ids asignados) y es la que se persiste;
+        `inversa` la deshace. Si la operacion no tuvo efecto ambas son None.
+        """
+        tipo = op['op']
+
+        if tipo == 'agregar':
+            elemento = dict(op['elemento'])
+            if 'id' not in elemento:
+                elemento = {'id': self._siguiente_id, **elemento}
+            self._siguiente_id = max(self._siguiente_id, elemento['id'] + 1)
+            previo = self._elementos.get(elemento['id'])
+            self._elementos[elemento['id']] = elemento
+            inversa = ({'op': 'agregar', 'elemento': dict(previo)} if previo
+                       else {'op': 'eliminar', 'id': elemento['id']})
+            return elemento, {'op': 'agregar', 'elemento': elemento}, inversa
+
+        if tipo == 'actualizar':
+            elemento = self._elementos.get(op['id'])
+            if elemento is None:
+                return None, None, None
+            cambios = op.get('cambios', {})
+            quitar = op.get('quitar', [])
+            inversa = {
+                'op': 'actualizar', 'id': op['id'],
+                'cambios': {k: elemento[k] for k in list(cambios) + quitar if k in elemento},
+                'quitar': [k for k in cambios if k not in elemento],
+            }
+            elemento.update(cambios)
+            for k in quitar:
+                elemento.pop(k, None)
+            return elemento, op, inversa
+
+        if tipo == 'eliminar':
+            elemento = self._elementos.pop(op['id'], None)
+            if elemento is None:
+                return None, None, None
+            return elemento, op, {'op': 'agregar', 'elemento': dict(elemento)}
+
+        if tipo == 'reemplazar':
+            previos = [dict(e) for e in self._elementos.values()]
+            if previos == op['elementos']:
+                return None, None, None
+            self._elementos = {e['id']: dict(e) for e in op['elementos']}
+            self._siguiente_id = max(self._siguiente_id, max(self._elementos, default=0) + 1)
+            return None, op, {'op': 'reemplazar', 'elementos': previos}
+
+        if tipo == 'agregar_capa':
+            capa = dict(op['capa'])
+            if 'id' not in capa:
+                capa = {'id': self._siguiente_id_capa, **capa}
+            self._siguiente_id_capa = max(self._siguiente_id_capa, capa['id'] + 1)
+            previa = self._capas.get(capa['id'])
+            self._capas[capa['id']] = capa
+            inversa = ({'op': 'agregar_capa', 'capa': dict(previa)} if previa
+                       else {'op': 'eliminar_capa', 'id': capa['id']})
+            return capa, {'op': 'agregar_capa', 'capa': capa}, inversa
+
+        if tipo == 'actualizar_capa':
+            capa = self._capas.get(op['id'])
+            if capa is None:
+                return None, None, None
+            cambios = op.get('cambios', {})
+            quitar = op.get('quitar', [])
+            inversa = {
+                'op': 'actualizar_capa', 'id': op['id'],
+                'cambios': {k: capa[k] for k in list(cambios) + quitar if k in capa},
+                'quitar': [k for k in cambios if k not in capa],
+            }
+            capa.update(cambios)
+            for k in quitar:
+                capa.pop(k, None)
+            return capa, op, inversa
+
+        if tipo == 'eliminar_capa':
+            capa = self._capas.pop(op['id'], None)
+            desasignados = [e for e in self._elementos.values() if e.get('capa') == op['id']]
+            if capa is None and not desasignados:
+                return None, None, None
+            for elem in desasignados:
+                elem['capa'] = None
+            inversas = [{'op': 'actualizar', 'id': e['id'], 'cambios': {'capa': op['id']}}
+                        for e in desasignados]
+            if capa is not None:
+                inversas.insert(0, {'op': 'agregar_capa', 'capa': dict(capa)})
+            # Los ids desasignados van en la operacion efectiva para quien siga los cambios
+            efectiva = {'op': 'eliminar_capa', 'id': op['id'], 'desasignados': [e['id'] for e in desasignados]}
+            return capa, efectiva, {'op': 'lote', 'operaciones': inversas}
+
+        if tipo == 'reemplazar_capas':
+            previas = [dict(c) for c in self._capas.values()]
+            if previas == op['capas']:
+                return None, None, None
+            self._capas = {c['id']: dict(c) for c in op['capas']}
+            self._siguiente_id_capa = max(self._siguiente_id_capa, max(self._capas, default=0) + 1)
+            return None, op, {'op': 'reemplazar_capas', 'capas': previas}
+
+        if tipo == 'lote':
+            resultados, efectivas, inversas = [], [], []
+            for sub in op['operaciones']:
+                resultado, efectiva, inversa = self._aplicar(sub)
+                resultados.append(resultado)
+                if efectiva is not None:
+                    efectivas.append(efectiva)
+                    inversas.insert(0, inversa)
+            if not efectivas:
+                return resultados, None, None
+            return (resultados, {'op': 'lote', 'operaciones': efectivas},
+                    {'op': 'lote', 'operaciones': inversas})
+
+        raise ValueError(f"Operacion desconocida: {tipo}")
+
+    def aplicar(self, op, deshacible=True):
+        """Aplica y persiste una operacion, registrandola en el historial.
+
+        Con `deshacible=False` la operacion no se puede deshacer: es el nuevo
+        punto de partida (por ejemplo, los elementos sembrados desde el mapa)
+        y se descartan el historial y los rehacer anteriores, que ya no
+        corresponden al estado.
+        """
+        with self._lock:
+            self._cargar()
+            resultado, efectiva, inversa = self._aplicar(op)
+            if efectiva is not None:
+                self._registrar(efectiva, inversa if deshacible else None)
+            return resultado
+
+    def aplicar_lote(self, operaciones):
+        """Aplica una lista de operaciones en orden como una sola: todas o ninguna.
+
+        El estado se carga y se persiste una vez, los oyentes reciben una
+        unica operacion 'lote' y deshacer la revierte entera. Si una
+        actualizacion no encuentra su elemento o capa, o una operacion falla,
+        se revierten las ya aplicadas (y los contadores de ids) y se lanza la
+        excepcion (LoteRechazado en el primer caso); eliminar algo que ya no
+        existe no es un error.
+        Devuelve el resultado de cada operacion.
+        """
+        with self._lock:
+            self._cargar()
+            contadores = self._siguiente_id, self._siguiente_id_capa
+            resultados, efectivas, inversas = [], [], []
+            try:
+                for posicion, op in enumerate(operaciones):
+                    resultado, efectiva, inversa = self._aplicar(op)
+                    if efectiva is None and op['op'] in ('actualizar', 'actualizar_capa'):
+                        raise LoteRechazado(posicion, op)
+                    resultados.append(resultado)
+                    if efectiva is not None:
+                        efectivas.append(efectiva)
+                        inversas.append(inversa)
+            except Exception:
+                for inversa in reversed(inversas):
+                    self._aplicar(inversa)
+                # Un lote rechazado no deja rastro, tampoco en los ids que habria asignado
+                self._siguiente_id, self._siguiente_id_capa = contadores
+                raise
+            if efectivas:
+                self._registrar({'op': 'lote', 'operaciones': efectivas},
+                                {'op': 'lote', 'operaciones': inversas[::-1]})
+            return resultados
+
+    def _registrar(self, efectiva, inversa):
+        """Persiste y notifica una operacion ya aplicada y agrega `inversa` al historial de deshacer.
+
+        Si `inversa` es None la operacion no se puede deshacer y el historial se vacia.
+        """
+        self._persistir(efectiva)
+        self._notificar(efectiva)
+        if inversa is None:
+            self._historial = []
+        else:
+            self._historial.append(inversa)
+            del self._historial[:-self.max_historial]
+        self._rehacer = []
+
+    def _deshacer_desde(self, origen, destino):
+        with self._lock:
+            self._cargar()
+            if not origen:
+                return None
+            op = origen.pop()
+            _, efectiva, inversa = self._aplicar(op)
+            if efectiva is None:
+                return None
+            self._persistir(efectiva)
+            self._notificar(efectiva)
+            destino.append(inversa)
+            return efectiva
+
+    def deshacer(self):
+        """Revierte la ultima operacion; devuelve la operacion aplicada o None."""
+        return self._deshacer_desde(self._historial, self._rehacer)
+
+    def rehacer(self):
+        """Vuelve a aplicar la ultima operacion deshecha."""
+        return self._deshacer_desde(self._rehacer, self._historial)
+
+    def elementos(self):
+        with self._lock:
+            self._cargar()
+            return list(self._elementos.values())
+
+    def obtener(self, elemento_id):
+        with self._lock:
+            self._cargar()
+            return self._elementos.get(elemento_id)
+
+    def contar(self):
+        with self._lock:
+            self._cargar()
+            return len(self._elementos)
+
+    def siguiente_id(self):
+        with self._lock:
+            self._cargar()
+            return self._siguiente_id
+
+    def agregar(self, elemento):
+        """Asigna un id nuevo al elemento y lo agrega al almacen."""
+        return self.aplicar({'op': 'agregar', 'elemento': elemento})
+
+    def actualizar(self, elemento_id, cambios):
+        """Aplica los cambios al elemento; devuelve None si no existe."""
+        return self.aplicar({'op': 'actualizar', 'id': elemento_id, 'cambios': cambios})
+
+    def eliminar(self, elemento_id):
+        return self.aplicar({'op': 'eliminar', 'id': elemento_id})
+
+    def reemplazar(self, elementos):
+        """Sustituye todos los elementos del almacen."""
+        self.aplicar({'op': 'reemplazar', 'elementos': elementos})
+
+    def capas(self):
+        with self._lock:
+            self._cargar()
+            return list(self._capas.values())
+
+    def siguiente_id_capa(self):
+        with self._lock:
+            self._cargar()
+            return self._siguiente_id_capa
+
+    def agregar_capa(self, capa):
+        return self.aplicar({'op': 'agregar_capa', 'capa': capa})
+
+    def actualizar_capa(self, capa_id, cambios):
+        return self.aplicar({'op': 'actualizar_capa', 'id': capa_id, 'cambios': cambios})
+
+    def eliminar_capa(self, capa_id):
+        """Elimina una capa y desasigna los elementos que la usaban."""
+        return self.aplicar({'op': 'eliminar_capa', 'id': capa_id})
+
+    def reemplazar_capas(self, capas):
+        self.aplicar({'op': 'reemplazar_capas', 'capas': capas})
+
+
+class AlmacenSQLite(AlmacenMapa):
+    """Almacen en memoria respaldado por una base SQLite.
+
+    Cada operacion se persiste en su propia transaccion como sentencias SQL
+    puntuales (una fila por elemento), con indices por `tipo` y `capa` y una
+    tabla R*Tree con la caja envolvente de cada elemento. Si los archivos
+    JSON son mas recientes que la ultima importacion (por ejemplo tras
+    importar un KMZ) se migran a la base al cargar.
+    """
+
+    def __init__(self, archivo_db, archivo_elementos, archivo_capas, **kwargs):
+        super().__init__(archivo_elementos, archivo_capas, **kwargs)
+        self.archivo_db = archivo_db
+        self._db = None
+        self._rtree = False
+
+    def _conectar(self):
+        if self._db is not None:
+            return self._db
+        db = sqlite3.connect(self.archivo_db, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS elementos (
+                    id INTEGER PRIMARY KEY,
+                    tipo TEXT,
+                    capa INTEGER,
+                    datos TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_elementos_tipo ON elementos(tipo);
+                CREATE INDEX IF NOT EXISTS idx_elementos_capa ON elementos(capa);
+                CREATE TABLE IF NOT EXISTS capas (
+                    id INTEGER PRIMARY KEY,
+                    datos TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    clave TEXT PRIMARY KEY,
+                    valor TEXT
+                );
+            ''')
+            try:
+                db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS elementos_caja
+                              USING rtree(id, min_lon, max_lon, min_lat, max_lat)''')
+                self._rtree = True
+            except sqlite3.OperationalError:
+                # SQLite compilado sin el modulo R*Tree
+                self._rtree = False
+        self._db = db
+        return db
+
+    def _leer_meta(self, clave):
+        fila = self._db.execute('SELECT valor FROM meta WHERE clave = ?', (clave,)).fetchone()
+        return fila[0] if fila else None
+
+    def _migrar_json(self):
+        """Importa los archivos JSON si cambiaron desde la ultima migracion."""
+        for archivo, clave in ((self.archivo_elementos, 'mtime_elementos'),
+                               (self.archivo_capas, 'mtime_capas')):
+            if not archivo or not os.path.exists(archivo):
+                continue
+            mtime = str(os.path.getmtime(archivo))
+            if self._leer_meta(clave) == mtime:
+                continue
+            datos = leer_json(archivo)
+            with self._db:
+                if clave == 'mtime_elementos':
+                    self._escribir_todos_elementos(datos)
+                else:
+                    self._escribir_todas_capas(datos)
+                self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (clave, mtime))
+
+    def _leer_estado(self):
+        self._conectar()
+        self._migrar_json()
+        self._elementos = {fila[0]: json.loads(fila[1]) for fila in
+                           self._db.execute('SELECT id, datos FROM elementos ORDER BY id')}
+        self._siguiente_id = max(self._elementos, default=0) + 1
+        self._capas = {fila[0]: json.loads(fila[1]) for fila in
+                       self._db.execute('SELECT id, datos FROM capas ORDER BY id')}
+        self._siguiente_id_capa = max(self._capas, default=0) + 1
+
+    def _escribir_elemento(self, elemento_id):
+        elemento = self._elementos.get(elemento_id)
+        if elemento is None:
+            return
+        self._db.execute('INSERT OR REPLACE INTO elementos (id, tipo, capa, datos) VALUES (?, ?, ?, ?)',
+                         (elemento_id, elemento.get('tipo'), elemento.get('capa'),
+                          json.dumps(elemento, ensure_ascii=False)))
+        if self._rtree:
+            self._db.execute('DELETE FROM elementos_caja WHERE id = ?', (elemento_id,))
+            caja = caja_elemento(elemento)
+            if caja:
+                self._db.execute('INSERT INTO elementos_caja VALUES (?, ?, ?, ?, ?)', (elemento_id, *caja))
+
+    def _borrar_elemento(self, elemento_id):
+        self._db.execute('DELETE FROM elementos WHERE id = ?', (elemento_id,))
+        if self._rtree:
+            self._db.execute('DELETE FROM elementos_caja WHERE id = ?', (elemento_id,))
+
+    def _escribir_todos_elementos(self, elementos):
+        self._db.execute('DELETE FROM elementos')
+        self._db.executemany('INSERT INTO elementos (id, tipo, capa, datos) VALUES (?, ?, ?, ?)',
+                             [(e['id'], e.get('tipo'), e.get('capa'), json.dumps(e, ensure_ascii=False))
+                              for e in elementos])
+        if self._rtree:
+            self._db.execute('DELETE FROM elementos_caja')
+            cajas = ((e['id'], caja_elemento(e)) for e in elementos)
+            self._db.executemany('INSERT INTO elementos_caja VALUES (?, ?, ?, ?, ?)',
+                                 [(i, *caja) for i, caja in cajas if caja])
+
+    def _escribir_capa(self, capa_id):
+        capa = self._capas.get(capa_id)
+        if capa is not None:
+            self._db.execute('INSERT OR REPLACE INTO capas (id, datos) VALUES (?, ?)',
+                             (capa_id, json.dumps(capa, ensure_ascii=False)))
+
+    def _escribir_todas_capas(self, capas):
+        self._db.execute('DELETE FROM capas')
+        self._db.executemany('INSERT INTO capas (id, datos) VALUES (?, ?)',
+                             [(c['id'], json.dumps(c, ensure_ascii=False)) for c in capas])
+
+    def _persistir_sql(self, op):
+        tipo = op['op']
+        if tipo == 'agregar':
+            self._escribir_elemento(op['elemento']['id'])
+        elif tipo == 'actualizar':
+            self._escribir_elemento(op['id'])
+        elif tipo == 'eliminar':
+            self._borrar_elemento(op['id'])
+        elif tipo == 'reemplazar':
+            self._escribir_todos_elementos(list(self._elementos.values()))
+        elif tipo == 'agregar_capa':
+            self._escribir_capa(op['capa']['id'])
+        elif tipo == 'actualizar_capa':
+            self._escribir_capa(op['id'])
+        elif tipo == 'eliminar_capa':
+            self._db.execute('DELETE FROM capas WHERE id = ?', (op['id'],))
+            self._db.execute("UPDATE elementos SET capa = NULL, datos = json_set(datos, '$.capa', NULL) "
+                             "WHERE capa = ?", (op['id'],))
+        elif tipo == 'reemplazar_capas':
+            self._escribir_todas_capas(list(self._capas.values()))
+        elif tipo == 'lote':
+            for sub in op['operaciones']:
+                self._persistir_sql(sub)
+
+    def _persistir(self, op):
+        with self._db:
+            self._persistir_sql(op)
+
+    def compactar(self):
+        pass
+
+    def guardar(self):
+        """Los cambios ya se confirman por operacion; solo se vuelca el WAL."""
+        with self._lock:
+            if self._db is not None:
+                self._db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def descartar(self):
+        with self._lock:
+            super().descartar()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def migrar_json_a_sqlite(archivo_db, archivo_elementos, archivo_capas):
+    """Migra los archivos JSON de elementos y capas a una base SQLite."""
+    almacen = AlmacenSQLite(archivo_db, archivo_elementos, archivo_capas)
+    totales = almacen.contar(), len(almacen.capas())
+    almacen.descartar()
+    return totales
+
+
+def reemplazar_instantanea(elementos, capas=None, archivo_elementos=ARCHIVO_ELEMENTOS,
+                           archivo_capas=ARCHIVO_CAPAS, diario=ARCHIVO_DIARIO):
+    """Reemplaza los JSON del editor por un contenido nuevo y descarta el diario.
+
+    Las operaciones del diario se refieren a la instantanea anterior: si
+    quedaran, se reproducirian encima de la nueva al arrancar. Cuando solo
+    se reemplazan los elementos, antes se compacta el diario para no perder
+    los cambios de capas que aun no estaban en la instantanea.
+    """
+    if os.path.exists(diario):
+        if capas is None:
+            anterior = AlmacenMapa(archivo_elementos, archivo_capas, diario=diario)
+            anterior._cargar()
+            anterior.compactar()
+        else:
+            os.remove(diario)
+    escribir_json(archivo_elementos, elementos)
+    if capas is not None:
+        escribir_json(archivo_capas, capas)
+
+
+def crear_almacen(modo=None):
+    """Crea el almacen del editor segun el modo de persistencia.
+
+    `modo` es 'json', 'diario' o 'sqlite'; por defecto el de la variable
+    MAPA_PERSISTENCIA (o 'json'). Lo usan el servidor y los comandos que
+    escriben al almacen sin arrancarlo.
+    """
+    modo = modo or os.environ.get('MAPA_PERSISTENCIA', 'json')
+    if modo == 'diario':
+        return AlmacenMapa(ARCHIVO_ELEMENTOS, ARCHIVO_CAPAS, diario=ARCHIVO_DIARIO)
+    if modo == 'sqlite':
+        return AlmacenSQLite(ARCHIVO_DB, ARCHIVO_ELEMENTOS, ARCHIVO_CAPAS)
+    return AlmacenMapa(ARCHIVO_ELEMENTOS, ARCHIVO_CAPAS)
@@ -0,0 +1,265 @@
+import re
+
+import numpy as np
+import pandas as pd
+from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+
+import geometria
+from espacial import ArbolEsferico
+
+
+MAX_FILAS_EXCEL = 1048575
+MAX_COLUMNAS_EXCEL = 16384
+METODOS_DISTANCIA = {'haversine': geometria.haversine, 'vincenty': geometria.vincenty}
+CELDAS_POR_BLOQUE = 1 << 20
+
+
+def solapes_torres(lats, lons, radios):
+    """Pares de torres cuyos circulos de cobertura se solapan.
+
+    Cada torre se busca en un ArbolEsferico con su radio mas el radio
+    maximo, y los candidatos se filtran con la distancia de haversine:
+    hay solape cuando la distancia es menor que la suma de los radios.
+    Devuelve un DataFrame con 'torre_a' < 'torre_b' (posiciones en los
+    arrays de entrada), 'distancia_m' y 'solape_m' (radio_a + radio_b -
+    distancia), ordenado de mayor a menor solape.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    radios = np.broadcast_to(np.asarray(radios, dtype=float), lats.shape)
+    if len(lats) < 2:
+        return pd.DataFrame({'torre_a': np.empty(0, dtype=np.int64), 'torre_b': np.empty(0, dtype=np.int64),
+                             'distancia_m': np.empty(0), 'solape_m': np.empty(0)})
+    arbol = ArbolEsferico(lats, lons)
+    a, b, distancias = arbol.consultar_radio(lats, lons, radios + radios.max())
+    solape = radios[a] + radios[b] - distancias
+    validos = (a < b) & (solape > 0)
+    resultado = pd.DataFrame({'torre_a': a[validos], 'torre_b': b[validos],
+                              'distancia_m': distancias[validos], 'solape_m': solape[validos]})
+    return resultado.sort_values(['solape_m', 'torre_a', 'torre_b'], ascending=[False, True, True],
+                                 ignore_index=True)
+
+
+def cobertura_puntos(arbol, radios, lats, lons, tam_lote=8192):
+    """Torres de `arbol` (un ArbolEsferico) cuya cobertura contiene cada punto.
+
+    `radios` es el radio de cobertura de cada torre del arbol (o uno comun).
+    Los puntos se buscan con el radio maximo y se filtran con el radio de
+    cada torre, sin bucles por punto. Devuelve un DataFrame con 'punto'
+    (posicion en lats/lons), 'torre' (posicion en el arbol) y 'distancia_m',
+    ordenado por punto y distancia.
+    """
+    radios = np.broadcast_to(np.asarray(radios, dtype=float), (len(arbol),))
+    if len(arbol) == 0:
+        return pd.DataFrame({'punto': np.empty(0, dtype=np.int64), 'torre': np.empty(0, dtype=np.int64),
+                             'distancia_m': np.empty(0)})
+    puntos, torres, distancias = arbol.consultar_radio(lats, lons, radios.max(), tam_lote)
+    dentro = distancias <= radios[torres]
+    puntos, torres, distancias = puntos[dentro], torres[dentro], distancias[dentro]
+    orden = np.lexsort((distancias, puntos))
+    return pd.DataFrame({'punto': puntos[orden], 'torre': torres[orden], 'distancia_m': distancias[orden]})
+
+
+def distancias_por_bloques(lats_a, lons_a, lats_b, lons_b, metodo='haversine', celdas=CELDAS_POR_BLOQUE):
+    """Matriz de distancias en metros entre los puntos A (filas) y B (columnas), por bloques de filas.
+
+    Itera (inicio, bloque): `bloque` son las filas [inicio, inicio +
+    len(bloque)) de la matriz, con unas `celdas` celdas como maximo para
+    acotar la memoria (los temporales de Vincenty son varias veces el
+    bloque). `metodo` es 'haversine' o 'vincenty'.
+    """
+    distancia = METODOS_DISTANCIA[metodo]
+    lats_a, lons_a = np.asarray(lats_a, dtype=float), np.asarray(lons_a, dtype=float)
+    lats_b, lons_b = np.asarray(lats_b, dtype=float), np.asarray(lons_b, dtype=float)
+    filas = max(1, celdas // max(len(lats_b), 1))
+    for inicio in range(0, len(lats_a), filas):
+        fin = inicio + filas
+        yield inicio, distancia(lats_a[inicio:fin, None], lons_a[inicio:fin, None], lats_b, lons_b)
+
+
+def matriz_distancias(lats_a, lons_a, lats_b, lons_b, metodo='haversine'):
+    """Matriz (len(A), len(B)) completa de distancias en metros; ver distancias_por_bloques()."""
+    bloques = [bloque for _, bloque in distancias_por_bloques(lats_a, lons_a, lats_b, lons_b, metodo)]
+    return np.vstack(bloques) if bloques else np.empty((0, len(lats_b)))
+
+
+def normalizar_clave(valor):
+    """Id de celda o de abonado como texto comparable entre archivos: 123, 123.0 y ' 123 ' dan '123'."""
+    if isinstance(valor, (int, np.integer)) or (isinstance(valor, float) and valor.is_integer()):
+        return str(int(valor))
+    texto = str(valor).strip()
+    return texto[:-2] if texto.endswith('.0') and texto[:-2].isdigit() else texto
+
+
+def _claves(serie):
+    """(codigos, claves normalizadas) de una columna; se normalizan solo los valores distintos."""
+    codigos, unicos = pd.factorize(serie)
+    return codigos, np.array([normalizar_clave(v) for v in unicos], dtype=object)
+
+
+def _fechas_fijas(valores):
+    """Lee 'dd/mm/aaaa hh:mm:ss' (o con puntos) con aritmetica de bytes, sin strptime.
+
+    Es el formato de casi todos los CDR y asi se lee unas 7 veces mas rapido
+    que con pd.to_datetime. Devuelve (ns, validos); las filas no validas
+    (otro formato, fechas imposibles) quedan para el lector general.
+    """
+    try:
+        texto = np.asarray(valores).astype('S20')
+    except (UnicodeEncodeError, ValueError):
+        return None, np.zeros(len(valores), dtype=bool)
+    b = texto.view(np.uint8).reshape(-1, 20)
+    digitos = b.astype(np.int64) - 48
+    validos = ((b[:, 2] == b[:, 5]) & np.isin(b[:, 2], (ord('/'), ord('.'))) & (b[:, 10] == ord(' '))
+               & (b[:, 13] == ord(':')) & (b[:, 16] == ord(':')) & (b[:, 19] == 0))
+    posiciones = [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 17, 18]
+    validos &= ((digitos[:, posiciones] >= 0) & (digitos[:, posiciones] <= 9)).all(axis=1)
+
+    def numero(desde, hasta):
+        resultado = np.zeros(len(b), dtype=np.int64)
+        for columna in range(desde, hasta):
+            resultado = resultado * 10 + digitos[:, columna]
+        return resultado
+
+    dia, mes, anio = numero(0, 2), numero(3, 5), numero(6, 10)
+    hora, minuto, segundo = numero(11, 13), numero(14, 16), numero(17, 19)
+    validos &= (mes >= 1) & (mes <= 12) & (dia >= 1) & (hora < 24) & (minuto < 60) & (segundo < 60)
+    meses = np.where(validos, (anio - 1970) * 12 + mes - 1, 0).astype('datetime64[M]')
+    dias = meses.astype('datetime64[D]') + np.where(validos, dia - 1, 0)
+    # 31/02 y similares se saldrian del mes: no son fechas
+    validos &= dias.astype('datetime64[M]') == meses
+    segundos = dias.astype(np.int64) * 86400 + hora * 3600 + minuto * 60 + segundo
+    return segundos * 10**9, validos
+
+
+def _instantes(serie):
+    """Fechas de un CDR como datetime64[ns] (NaT si no se entienden).
+
+    Las fechas con barras o puntos ('05/01/2024 13:00') se leen con el dia
+    primero, como se escriben en la region; las ISO ('2024-01-05') tal cual.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return np.asarray(serie, dtype='datetime64[ns]')
+    muestra = serie.dropna().head(1).astype(str).str.strip()
+    dia_primero = bool(len(muestra) and re.match(r'\d{1,2}[/.]\d{1,2}[/.]\d{2,4}', muestra.iloc[0]))
+    if not dia_primero:
+        return np.asarray(pd.to_datetime(serie, errors='coerce'), dtype='datetime64[ns]')
+    instantes, validos = _fechas_fijas(serie.to_numpy())
+    if validos.all():
+        return instantes.view('datetime64[ns]')
+    resto = serie[~validos].astype(str).str.strip()
+    # dayfirst tambien invierte las ISO ('2024-01-05' -> 1 de mayo): esas van aparte
+    iso = resto.str.match(r'\d{4}-').to_numpy()
+    ymd = pd.to_datetime(resto.where(iso), errors='coerce')
+    dmy = pd.to_datetime(resto.where(~iso), errors='coerce', dayfirst=True)
+    resto = np.where(iso, np.asarray(ymd, dtype='datetime64[ns]'), np.asarray(dmy, dtype='datetime64[ns]'))
+    if instantes is None:
+        return resto
+    instantes = instantes.view('datetime64[ns]')
+    instantes[~validos] = resto
+    return instantes
+
+
+class TrayectoriasCDR:
+    """Une registros de llamadas (CDR) con la tabla de torres y reconstruye trayectorias.
+
+    Los CDR se agregan por bloques con `agregar()`: el id de celda de cada
+    registro se busca en un indice hash de los ids de torre (solo se
+    normalizan los valores distintos del bloque) y se guardan tres arrays
+    compactos por registro: abonado (codigo entero), instante (ns) y torre.
+    `trayectorias()` ordena por abonado y tiempo y descarta los registros
+    consecutivos en la misma torre. Todo es vectorizado; la memoria es de
+    unos 20 bytes por registro unido.
+    """
+
+    def __init__(self, ids_torre, abonados=None):
+        _, claves = _claves(pd.Series(ids_torre))
+        # Si un id de torre se repite vale su primera aparicion
+        primeras = ~pd.Index(claves).duplicated()
+        self._indice_torres = pd.Index(claves[primeras])
+        self._posiciones_torres = np.flatnonzero(primeras)
+        self._filtro = None if abonados is None else np.array([normalizar_clave(a) for a in abonados], dtype=object)
+        self._indice_abonados = pd.Index([], dtype=object)
+        self._abonados, self._tiempos, self._torres = [], [], []
+        self.leidos = 0
+        self.sin_torre = 0
+        self.sin_tiempo = 0
+
+    def agregar(self, abonados, celdas, tiempos):
+        """Une un bloque de CDR (columnas de abonado, id de celda e instante) con las torres.
+
+        Devuelve cuantos registros del bloque se unieron; con `abonados` en
+        el constructor solo se guardan los de esos abonados.
+        """
+        self.leidos += len(celdas)
+        codigos, claves = _claves(celdas)
+        posiciones = self._indice_torres.get_indexer(claves)
+        # Centinelas al final: el codigo -1 (celda vacia o desconocida) cae en "sin torre"
+        posiciones = np.append(self._posiciones_torres, -1)[posiciones]
+        torres = np.append(posiciones, -1)[codigos]
+        instantes = _instantes(pd.Series(tiempos)).view(np.int64)
+        con_tiempo = instantes != np.iinfo(np.int64).min
+        codigos, claves = _claves(abonados)
+        permitidos = np.ones(len(claves), dtype=bool) if self._filtro is None else np.isin(claves, self._filtro)
+        codigos = np.where(np.append(permitidos, False)[codigos], codigos, -1)
+        globales = self._indice_abonados.get_indexer(claves)
+        nuevos = (globales < 0) & permitidos
+        if nuevos.any():
+            globales[nuevos] = len(self._indice_abonados) + np.arange(nuevos.sum())
+            self._indice_abonados = self._indice_abonados.append(pd.Index(claves[nuevos]))
+        validos = (torres >= 0) & con_tiempo & (codigos >= 0)
+        self.sin_torre += int((torres < 0).sum())
+        self.sin_tiempo += int((~con_tiempo & (torres >= 0)).sum())
+        self._abonados.append(globales[codigos[validos]])
+        self._tiempos.append(instantes[validos])
+        self._torres.append(torres[validos].astype(np.int32))
+        return int(validos.sum())
+
+    def trayectorias(self, min_puntos=2):
+        """Trayectorias de los abonados con al menos `min_puntos` cambios de torre.
+
+        Devuelve (abonados, torres, instantes, limites): la trayectoria k es
+        torres[limites[k]:limites[k + 1]] (posiciones en la tabla de torres)
+        con sus instantes (datetime64[ns]), del abonado abonados[k].
+        """
+        abonados = np.concatenate(self._abonados) if self._abonados else np.empty(0, dtype=np.int64)
+        tiempos = np.concatenate(self._tiempos) if self._tiempos else np.empty(0, dtype=np.int64)
+        torres = np.concatenate(self._torres) if self._torres else np.empty(0, dtype=np.int32)
+        orden = np.lexsort((tiempos, abonados))
+        abonados, tiempos, torres = abonados[orden], tiempos[orden], torres[orden]
+        nuevo_abonado = np.r_[True, abonados[1:] != abonados[:-1]]
+        cambio = nuevo_abonado | np.r_[True, torres[1:] != torres[:-1]]
+        abonados, tiempos, torres = abonados[cambio], tiempos[cambio], torres[cambio]
+        inicios = np.flatnonzero(nuevo_abonado[cambio])
+        largos = np.diff(np.r_[inicios, len(abonados)])
+        suficientes = largos >= min_puntos
+        filas = np.repeat(suficientes, largos)
+        limites = np.r_[0, np.cumsum(largos[suficientes])]
+        nombres = self._indice_abonados.to_numpy()[abonados[inicios[suficientes]]]
+        return nombres, torres[filas], tiempos[filas].view('datetime64[ns]'), limites
+
+
+def escribir_excel(hojas, destino):
+    """Escribe {nombre: DataFrame} en un .xlsx con la cabecera del resto de exportaciones.
+
+    `destino` es una ruta o un buffer. Las tablas que no caben en una hoja
+    de Excel se reparten en hojas 'nombre 2', 'nombre 3', ...
+    """
+    cabecera_font = Font(bold=True, color="FFFFFF")
+    cabecera_fill = PatternFill(start_color="2C3E50", end_color="2C3E50", fill_type="solid")
+    cabecera_alineacion = Alignment(horizontal="center", vertical="center")
+    borde = Border(left=Side(style='thin'), right=Side(style='thin'),
+                   top=Side(style='thin'), bottom=Side(style='thin'))
+    with pd.ExcelWriter(destino, engine='openpyxl') as writer:
+        for nombre, df in hojas.items():
+            partes = range(0, max(len(df), 1), MAX_FILAS_EXCEL)
+            for numero, inicio in enumerate(partes, 1):
+                titulo = nombre if numero == 1 else f"{nombre} {numero}"
+                df.iloc[inicio:inicio + MAX_FILAS_EXCEL].to_excel(writer, sheet_name=titulo, index=False)
+                hoja = writer.sheets[titulo]
+                for celda in hoja[1]:
+                    celda.font = cabecera_font
+                    celda.fill = cabecera_fill
+                    celda.alignment = cabecera_alineacion
+                    celda.border = borde
+                    hoja.column_dimensions[celda.column_letter].width = max(12, len(str(celda.value)) + 4)
@@ -1,38 +1,162 @@
-from flask import Flask, render_template, request, jsonify, send_file, Response
+from flask import Flask, render_template, request, jsonify, send_file, Response, make_response
 import os
 import json
 import re
 import zipfile
 import io
-import math
+import gzip
+import hashlib
+import functools
+import threading
+import tempfile
 from datetime import datetime
+from xml.sax.saxutils import escape
+import numpy as np
+import pandas as pd
+from almacen import (RegistroCambios, LoteRechazado, crear_almacen, internar_icono, decodificar_icono, buscar_icono, leer_json,
+                     escribir_json, ARCHIVO_ELEMENTOS, ARCHIVO_DIARIO, ARCHIVO_DB)
+from espacial import IndiceRejilla, IndiceTorres, ClustersJerarquicos, ArbolEsferico
+import geometria
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from analisis import (solapes_torres, cobertura_puntos, escribir_excel, distancias_por_bloques, matriz_distancias,
+                      METODOS_DISTANCIA, MAX_COLUMNAS_EXCEL)
 
 app = Flask(__name__)
 
-ARCHIVO_ELEMENTOS = 'elementos_mapa.json'
-ARCHIVO_CAPAS = 'capas_mapa.json'
+ARCHIVO_SEMILLA = 'elementos_mapa.semilla.json'
+
+almacen = crear_almacen()
+indice = IndiceRejilla()
+almacen.suscribir(lambda op: indice.sincronizar(op, almacen))
+indice_torres = IndiceTorres()
+almacen.suscribir(lambda op: indice_torres.sincronizar(op, almacen))
+
+TIPOS_AGRUPABLES = ('torre', 'etiqueta')
+RADIOS_POR_DEFECTO = {'torre': 500, 'circulo': 100}
+TAM_BLOQUE_GEOMETRIA = 2000
+MAX_TORRES_CERCANAS = 1000
+MAX_CELDAS_DISTANCIAS = {'json': 1000000, 'excel': 5000000}
+MAX_OPERACIONES_LOTE = 50000
+_clusters = {'version': 0, 'indice': None, 'ids': None}
+_clusters_lock = threading.Lock()
+
+def invalidar_clusters(op):
+    """Descarta la jerarquía de clusters tras cualquier cambio en el almacén."""
+    _clusters['version'] += 1
+    _clusters['indice'] = None
+
+almacen.suscribir(invalidar_clusters)
+
+# Cada cambio del almacen avanza la revision global; las respuestas que
+# dependen de los datos se validan con ETags de esa revision.
+registro = RegistroCambios()
+almacen.suscribir(registro.registrar)
+MAX_CAMBIOS_DELTA = 20000
+INTERVALO_LATIDO_SSE = 15
+MAX_EVENTOS_SSE = 32
+# Cada flujo SSE abierto ocupa un hilo del servidor; por encima de este limite
+# /api/stream responde 503 y el editor consulta /api/cambios periodicamente
+MAX_FLUJOS_SSE = int(os.environ.get('MAPA_MAX_FLUJOS_SSE', 32))
+_flujos_sse = threading.BoundedSemaphore(MAX_FLUJOS_SSE)
+_eventos_sse = {}
+_eventos_lock = threading.Lock()
+TIPOS_COMPRIMIBLES = ('application/json', 'text/html', 'text/csv', 'text/plain')
+MIN_BYTES_COMPRESION = 1024
+MAX_COMPRIMIDOS = 16
+_comprimidos = {}
+_comprimidos_lock = threading.Lock()
+_mapa = {'actual': None}
+_semilla = {'clave': None}
+_semilla_lock = threading.Lock()
+
+def codificacion_aceptada():
+    """'br' o 'gzip' según Accept-Encoding (br solo si está instalado el paquete brotli), o None."""
+    if brotli is not None and 'br' in request.accept_encodings:
+        return 'br'
+    if 'gzip' in request.accept_encodings:
+        return 'gzip'
+    return None
+
+def cliente_tiene(etag):
+    """El cliente ya tiene la representación `etag`, sin comprimir o en cualquier codificación."""
+    return any(request.if_none_match.contains(e) for e in (etag, f'{etag}-gzip', f'{etag}-br'))
+
+def no_modificado(etag):
+    """Respuesta 304 con el ETag de la representación que corresponde a este cliente."""
+    codificacion = codificacion_aceptada()
+    respuesta = Response(status=304)
+    respuesta.set_etag(f'{etag}-{codificacion}' if codificacion else etag)
+    respuesta.cache_control.no_cache = True
+    respuesta.vary.add('Accept-Encoding')
+    return respuesta
+
+def validar_por_version(vista):
+    """Sirve la vista GET con un ETag de la revisión del almacén y la URL, y 304 si no cambió."""
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        almacen.contar()
+        etag = hashlib.sha1(f"{registro.revision}:{request.full_path}".encode()).hexdigest()
+        if cliente_tiene(etag):
+            return no_modificado(etag)
+        respuesta = make_response(vista(*args, **kwargs))
+        if respuesta.status_code == 200:
+            respuesta.set_etag(etag)
+            respuesta.cache_control.no_cache = True
+        return respuesta
+    return envoltura
+
+def comprimir(datos, codificacion):
+    if codificacion == 'br':
+        return brotli.compress(datos, quality=5)
+    return gzip.compress(datos, compresslevel=6)
+
+@app.after_request
+def anotar_revision(respuesta):
+    """Cabecera X-Revision con la revisión del almacén tras atender la petición."""
+    respuesta.headers['X-Revision'] = str(registro.revision)
+    return respuesta
+
+@app.after_request
+def comprimir_respuesta(respuesta):
+    """Comprime con br/gzip las respuestas JSON, HTML y CSV; las que llevan ETag se cachean ya comprimidas."""
+    if (respuesta.mimetype not in TIPOS_COMPRIMIBLES or respuesta.status_code != 200
+            or respuesta.direct_passthrough or respuesta.is_streamed or 'Content-Encoding' in respuesta.headers):
+        return respuesta
+    respuesta.vary.add('Accept-Encoding')
+    codificacion = codificacion_aceptada()
+    if codificacion is None or (respuesta.content_length or 0) < MIN_BYTES_COMPRESION:
+        return respuesta
+    etag, debil = respuesta.get_etag()
+    if etag is None:
+        respuesta.set_data(comprimir(respuesta.get_data(), codificacion))
+    else:
+        with _comprimidos_lock:
+            datos = _comprimidos.get((etag, codificacion))
+        if datos is None:
+            datos = comprimir(respuesta.get_data(), codificacion)
+            with _comprimidos_lock:
+                _comprimidos[(etag, codificacion)] = datos
+                while len(_comprimidos) > MAX_COMPRIMIDOS:
+                    del _comprimidos[next(iter(_comprimidos))]
+        respuesta.set_data(datos)
+        respuesta.set_etag(f'{etag}-{codificacion}', debil)
+    respuesta.headers['Content-Encoding'] = codificacion
+    return respuesta
 
 def cargar_capas():
-    """Carga las capas desde el archivo JSON."""
-    if os.path.exists(ARCHIVO_CAPAS):
-        try:
-            with open(ARCHIVO_CAPAS, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    """Carga las capas desde el almacen en memoria."""
+    return almacen.capas()
 
 def guardar_capas(capas):
-    """Guarda las capas en el archivo JSON."""
-    with open(ARCHIVO_CAPAS, 'w', encoding='utf-8') as f:
-        json.dump(capas, f, ensure_ascii=False, indent=2)
+    """Reemplaza las capas del almacen (se escriben a disco en diferido)."""
+    almacen.reemplazar_capas(capas)
 
 def obtener_siguiente_id_capa():
     """Obtiene el siguiente ID para una capa."""
-    capas = cargar_capas()
-    if not capas:
-        return 1
-    return max(c.get('id', 0) for c in capas) + 1
+    return almacen.siguiente_id_capa()
 
 def obtener_archivo_mapa():
     """Obtiene el archivo de mapa actual desde variable de entorno."""
@@ -41,28 +165,36 @@ def obtener_archivo_mapa():
         return mapa_env
     return None
 
+def mapa_parseado():
+    """(clave, bytes del HTML, elementos guardados en él) del mapa actual, o None si no hay mapa.
+
+    La clave es (ruta, fecha de modificación, tamaño): el archivo se lee y
+    se parsea una sola vez por versión y después solo cuesta un stat().
+    """
+    archivo = obtener_archivo_mapa()
+    if not archivo:
+        return None
+    info = os.stat(archivo)
+    clave = (os.path.abspath(archivo), info.st_mtime_ns, info.st_size)
+    actual = _mapa['actual']
+    if actual is None or actual[0] != clave:
+        with open(archivo, 'rb') as f:
+            datos = f.read()
+        actual = _mapa['actual'] = (clave, datos, extraer_elementos_de_html(datos.decode('utf-8')))
+    return actual
+
 def cargar_contenido_mapa():
     """Carga el contenido HTML del mapa."""
-    archivo = obtener_archivo_mapa()
-    if archivo:
-        with open(archivo, 'r', encoding='utf-8') as f:
-            return f.read()
-    return None
+    mapa = mapa_parseado()
+    return mapa[1].decode('utf-8') if mapa else None
 
 def cargar_elementos():
-    """Carga los elementos desde el archivo JSON de persistencia."""
-    if os.path.exists(ARCHIVO_ELEMENTOS):
-        try:
-            with open(ARCHIVO_ELEMENTOS, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    """Carga los elementos desde el almacen en memoria."""
+    return almacen.elementos()
 
 def guardar_elementos(elementos):
-    """Guarda los elementos en el archivo JSON de persistencia."""
-    with open(ARCHIVO_ELEMENTOS, 'w', encoding='utf-8') as f:
-        json.dump(elementos, f, ensure_ascii=False, indent=2)
+    """Reemplaza los elementos del almacen (se escriben a disco en diferido)."""
+    almacen.reemplazar(elementos)
 
 def extraer_elementos_de_html(contenido_html):
     """Extrae elementos guardados previamente del HTML."""
@@ -76,158 +208,468 @@ def extraer_elementos_de_html(contenido_html):
             pass
     return elementos
 
+def migrar_iconos_embebidos():
+    """Pasa los iconos base64 embebidos en elementos al almacen de iconos por hash."""
+    operaciones = []
+    for elem in cargar_elementos():
+        icono = internar_icono(elem.get('icono'))
+        if icono != elem.get('icono'):
+            operaciones.append({'op': 'actualizar', 'id': elem['id'], 'cambios': {'icono': icono}})
+    if operaciones:
+        almacen.aplicar({'op': 'lote', 'operaciones': operaciones}, deshacible=False)
+
 def inicializar_elementos():
-    """Inicializa los elementos al cargar un mapa."""
-    contenido = cargar_contenido_mapa()
-    if contenido:
-        elementos_html = extraer_elementos_de_html(contenido)
-        if elementos_html:
-            guardar_elementos(elementos_html)
-            return elementos_html
-    elementos_existentes = cargar_elementos()
-    return elementos_existentes
+    """Siembra en el almacén los elementos guardados en el HTML del mapa, una sola vez por archivo.
+
+    La versión del mapa ya sembrada se recuerda en ARCHIVO_SEMILLA, así que
+    recargar el editor o reiniciar el servidor no pisa lo editado después.
+    La siembra y la migración de iconos no se pueden deshacer: son el punto
+    de partida del caso.
+    """
+    mapa = mapa_parseado()
+    if mapa is None or _semilla['clave'] == mapa[0]:
+        return
+    with _semilla_lock:
+        clave, _, elementos_html = mapa
+        if _semilla['clave'] == clave:
+            return
+        if elementos_html and leer_json(ARCHIVO_SEMILLA) != list(clave):
+            almacen.aplicar({'op': 'reemplazar', 'elementos': elementos_html}, deshacible=False)
+            escribir_json(ARCHIVO_SEMILLA, list(clave))
+        migrar_iconos_embebidos()
+        _semilla['clave'] = clave
 
 @app.route('/')
 def editor():
-    """Página principal del editor."""
-    mapa_html = cargar_contenido_mapa()
-    if not mapa_html:
+    """Página principal del editor: solo la interfaz; el mapa base y los datos se piden aparte."""
+    if not obtener_archivo_mapa():
         return "Error: No se ha cargado ningún mapa. Ejecute el script con la opción de servidor.", 404
     
-    elementos = inicializar_elementos()
-    capas = cargar_capas()
-    return render_template('editor.html', mapa_contenido=mapa_html, elementos=json.dumps(elementos), capas=json.dumps(capas))
+    inicializar_elementos()
+    html = render_template('editor.html').encode('utf-8')
+    etag = hashlib.sha1(html).hexdigest()
+    if cliente_tiene(etag):
+        return no_modificado(etag)
+    respuesta = Response(html, mimetype='text/html')
+    respuesta.set_etag(etag)
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+@app.route('/mapa-base')
+def mapa_base():
+    """HTML del mapa base (iframe del editor), validado por ruta, fecha y tamaño del archivo."""
+    mapa = mapa_parseado()
+    if not mapa:
+        return "Error: No se ha cargado ningún mapa.", 404
+    clave, datos, _ = mapa
+    etag = hashlib.sha1(repr(clave).encode()).hexdigest()
+    if cliente_tiene(etag):
+        return no_modificado(etag)
+    respuesta = Response(datos, mimetype='text/html')
+    respuesta.set_etag(etag)
+    respuesta.cache_control.no_cache = True
+    return respuesta
 
 def obtener_siguiente_id():
     """Obtiene el siguiente ID para un elemento."""
-    elementos = cargar_elementos()
-    if not elementos:
-        return 1
-    return max(e.get('id', 0) for e in elementos) + 1
+    return almacen.siguiente_id()
 
-@app.route('/api/agregar-ruta', methods=['POST'])
-def agregar_ruta():
-    """Agrega una nueva ruta al mapa."""
-    elementos = cargar_elementos()
-    data = request.json
-    elemento = {
-        'id': obtener_siguiente_id(),
+def nueva_ruta(data, numero):
+    """Ruta con los valores por defecto del editor."""
+    return {
         'tipo': 'ruta',
         'puntos': data.get('puntos', []),
         'color': data.get('color', '#FF0000'),
         'grosor': data.get('grosor', 3),
-        'nombre': data.get('nombre', f'Ruta {len(elementos) + 1}')
+        'nombre': data.get('nombre', f'Ruta {numero}')
     }
-    elementos.append(elemento)
-    guardar_elementos(elementos)
-    return jsonify({'success': True, 'elemento': elemento})
 
-@app.route('/api/agregar-etiqueta', methods=['POST'])
-def agregar_etiqueta():
-    """Agrega una nueva etiqueta al mapa."""
-    elementos = cargar_elementos()
-    data = request.json
-    elemento = {
-        'id': obtener_siguiente_id(),
+def nueva_etiqueta(data, numero):
+    """Etiqueta con los valores por defecto del editor."""
+    return {
         'tipo': 'etiqueta',
         'lat': data.get('lat'),
         'lon': data.get('lon'),
         'texto': data.get('texto', 'Etiqueta'),
         'color': data.get('color', '#000000'),
-        'icono': data.get('icono', '')
+        'icono': internar_icono(data.get('icono', ''))
     }
-    elementos.append(elemento)
-    guardar_elementos(elementos)
-    return jsonify({'success': True, 'elemento': elemento})
 
-@app.route('/api/agregar-circulo', methods=['POST'])
-def agregar_circulo():
-    """Agrega un nuevo círculo al mapa."""
-    elementos = cargar_elementos()
-    data = request.json
-    elemento = {
-        'id': obtener_siguiente_id(),
+def nuevo_circulo(data, numero):
+    """Círculo con los valores por defecto del editor."""
+    return {
         'tipo': 'circulo',
         'lat': data.get('lat'),
         'lon': data.get('lon'),
         'radio': data.get('radio', 100),
         'color': data.get('color', '#3388ff'),
-        'nombre': data.get('nombre', f'Circulo {len(elementos) + 1}')
+        'nombre': data.get('nombre', f'Circulo {numero}')
     }
-    elementos.append(elemento)
-    guardar_elementos(elementos)
-    return jsonify({'success': True, 'elemento': elemento})
 
-@app.route('/api/agregar-torre', methods=['POST'])
-def agregar_torre():
-    """Agrega una nueva torre telefónica al mapa."""
-    elementos = cargar_elementos()
-    data = request.json
-    elemento = {
-        'id': obtener_siguiente_id(),
+def nueva_torre(data, numero):
+    """Torre con los valores por defecto del editor; ValueError si los sectores no son numéricos."""
+    return {
         'tipo': 'torre',
         'lat': data.get('lat'),
         'lon': data.get('lon'),
         'radio': data.get('radio', 500),
         'color': data.get('color', '#e74c3c'),
         'grosor': data.get('grosor', 2),
-        'nombre': data.get('nombre', f'Torre Telefonica {len(elementos) + 1}')
+        'nombre': data.get('nombre', f'Torre Telefonica {numero}'),
+        **parsear_sectores(data)
     }
-    elementos.append(elemento)
-    guardar_elementos(elementos)
+
+# Constructores de elementos nuevos por tipo; `numero` es el que toma el nombre por defecto
+NUEVOS_ELEMENTOS = {'ruta': nueva_ruta, 'etiqueta': nueva_etiqueta, 'circulo': nuevo_circulo, 'torre': nueva_torre}
+# Campos de estilo que /api/lote puede cambiar según el tipo (las torres usan cambios_torre)
+CAMPOS_POR_TIPO = {'ruta': ('color', 'grosor'), 'circulo': ('color', 'radio'), 'etiqueta': ('color',)}
+
+@app.route('/api/agregar-ruta', methods=['POST'])
+def agregar_ruta():
+    """Agrega una nueva ruta al mapa."""
+    elemento = almacen.agregar(nueva_ruta(request.json, almacen.contar() + 1))
+    return jsonify({'success': True, 'elemento': elemento})
+
+@app.route('/api/agregar-etiqueta', methods=['POST'])
+def agregar_etiqueta():
+    """Agrega una nueva etiqueta al mapa."""
+    elemento = almacen.agregar(nueva_etiqueta(request.json, almacen.contar() + 1))
+    return jsonify({'success': True, 'elemento': elemento})
+
+@app.route('/api/agregar-circulo', methods=['POST'])
+def agregar_circulo():
+    """Agrega un nuevo círculo al mapa."""
+    elemento = almacen.agregar(nuevo_circulo(request.json, almacen.contar() + 1))
+    return jsonify({'success': True, 'elemento': elemento})
+
+def parsear_sectores(data):
+    """Extrae 'azimuts' (lista de grados) y 'ancho_sector' opcionales de una torre; ValueError si no son válidos."""
+    sectores = {}
+    if data.get('azimuts') is not None:
+        sectores['azimuts'] = [float(a) % 360 for a in data['azimuts']]
+    if data.get('ancho_sector') is not None:
+        ancho = float(data['ancho_sector'])
+        if not 0 < ancho <= 360:
+            raise ValueError(ancho)
+        sectores['ancho_sector'] = ancho
+    return sectores
+
+@app.route('/api/agregar-torre', methods=['POST'])
+def agregar_torre():
+    """Agrega una nueva torre telefónica al mapa."""
+    try:
+        torre = nueva_torre(request.json, almacen.contar() + 1)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'mensaje': 'azimuts y ancho_sector deben ser numéricos'}), 400
+    elemento = almacen.agregar(torre)
     return jsonify({'success': True, 'elemento': elemento})
 
+def cambios_torre(data):
+    """Cambios de nombre, radio, estilo, posición y sectores de una torre; ValueError si no son válidos."""
+    cambios = {k: data[k] for k in ('nombre', 'radio', 'color', 'grosor') if k in data}
+    cambios.update(parsear_sectores(data))
+    cambios.update({k: float(data[k]) for k in ('lat', 'lon') if data.get(k) is not None})
+    return cambios
+
+def cambios_elemento(data):
+    """Cambios de nombre, texto e icono de cualquier elemento."""
+    cambios = {k: data[k] for k in ('nombre', 'texto', 'icono') if k in data}
+    if 'icono' in cambios:
+        cambios['icono'] = internar_icono(cambios['icono'])
+    return cambios
+
+def cambios_por_tipo(tipo, data):
+    """Cambios admitidos para un elemento de `tipo`: nombre, texto e icono en todos y los campos propios del tipo.
+
+    Los demás campos se ignoran, como en los endpoints de un solo elemento;
+    ValueError si los de una torre no son válidos.
+    """
+    cambios = cambios_elemento(data)
+    if tipo == 'torre':
+        cambios.update(cambios_torre(data))
+    else:
+        cambios.update({k: data[k] for k in CAMPOS_POR_TIPO.get(tipo, ()) if k in data})
+    return cambios
+
 @app.route('/api/actualizar-torre/<int:elemento_id>', methods=['PATCH'])
 def actualizar_torre(elemento_id):
     """Actualiza una torre telefónica existente."""
-    elementos = cargar_elementos()
-    data = request.json
-    
-    for elem in elementos:
-        if elem['id'] == elemento_id:
-            if 'nombre' in data:
-                elem['nombre'] = data['nombre']
-            if 'radio' in data:
-                elem['radio'] = data['radio']
-            if 'color' in data:
-                elem['color'] = data['color']
-            if 'grosor' in data:
-                elem['grosor'] = data['grosor']
-            guardar_elementos(elementos)
-            return jsonify({'success': True, 'elemento': elem})
+    try:
+        cambios = cambios_torre(request.json)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'mensaje': 'lat, lon, azimuts y ancho_sector deben ser numéricos'}), 400
+    elem = almacen.actualizar(elemento_id, cambios)
+    if elem:
+        return jsonify({'success': True, 'elemento': elem})
     
     return jsonify({'success': False, 'mensaje': 'Elemento no encontrado'}), 404
 
 @app.route('/api/eliminar-elemento/<int:elemento_id>', methods=['DELETE'])
 def eliminar_elemento(elemento_id):
     """Elimina un elemento del mapa."""
-    elementos = cargar_elementos()
-    elementos = [e for e in elementos if e['id'] != elemento_id]
-    guardar_elementos(elementos)
+    almacen.eliminar(elemento_id)
     return jsonify({'success': True})
 
+def operacion_lote(data, numero):
+    """Traduce una operación de /api/lote a la del almacén; KeyError/TypeError/ValueError si no es válida."""
+    tipo = data['op']
+    if tipo == 'agregar':
+        return {'op': 'agregar', 'elemento': NUEVOS_ELEMENTOS[data['tipo']](data, numero)}
+    elemento_id = int(data['id'])
+    if tipo == 'actualizar':
+        # Si el elemento no existe, aplicar_lote rechaza el lote entero
+        elemento = almacen.obtener(elemento_id) or {}
+        return {'op': 'actualizar', 'id': elemento_id, 'cambios': cambios_por_tipo(elemento.get('tipo'), data)}
+    if tipo == 'asignar_capa':
+        return {'op': 'actualizar', 'id': elemento_id, 'cambios': {'capa': data.get('capa_id')}}
+    if tipo == 'eliminar':
+        return {'op': 'eliminar', 'id': elemento_id}
+    raise ValueError(tipo)
+
+@app.route('/api/lote', methods=['POST'])
+def aplicar_lote():
+    """Aplica en orden y de forma atómica una lista de altas, cambios, bajas y asignaciones de capa.
+
+    Cuerpo: {"operaciones": [{"op": "agregar", "tipo": "torre", ...},
+    {"op": "actualizar", "id": 3, "color": ...}, {"op": "asignar_capa",
+    "id": 3, "capa_id": 2}, {"op": "eliminar", "id": 4}]}. Todo el lote se
+    guarda una vez y se deshace como un solo cambio; si una operación no es
+    válida o su elemento no existe no se aplica ninguna.
+    """
+    data = request.get_json(silent=True) or {}
+    operaciones = data.get('operaciones')
+    if not isinstance(operaciones, list) or not 0 < len(operaciones) <= MAX_OPERACIONES_LOTE:
+        return jsonify({'success': False, 'mensaje': f'operaciones debe ser una lista de 1 a {MAX_OPERACIONES_LOTE} operaciones'}), 400
+    numero = almacen.contar() + 1
+    ops = []
+    for posicion, sub in enumerate(operaciones):
+        try:
+            ops.append(operacion_lote(sub, numero))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'posicion': posicion,
+                            'mensaje': f'Operación {posicion} inválida; no se aplicó ningún cambio'}), 400
+        if ops[-1]['op'] == 'agregar':
+            numero += 1
+    try:
+        resultados = almacen.aplicar_lote(ops)
+    except LoteRechazado as e:
+        return jsonify({'success': False, 'posicion': e.posicion,
+                        'mensaje': f'Operación {e.posicion}: elemento {e.op["id"]} no encontrado; no se aplicó ningún cambio'}), 404
+    return jsonify({
+        'success': True,
+        'elementos': [None if op['op'] == 'eliminar' else r for op, r in zip(ops, resultados)],
+        'ids_nuevos': [r['id'] for op, r in zip(ops, resultados) if op['op'] == 'agregar']
+    })
+
 @app.route('/api/deshacer', methods=['POST'])
 def deshacer():
-    """Elimina el último elemento agregado."""
-    elementos = cargar_elementos()
-    if elementos:
-        eliminado = elementos.pop()
-        guardar_elementos(elementos)
-        return jsonify({'success': True, 'eliminado': eliminado})
-    return jsonify({'success': False, 'mensaje': 'No hay elementos para deshacer'})
+    """Deshace la última operación realizada sobre elementos o capas."""
+    operacion = almacen.deshacer()
+    if operacion:
+        return jsonify({'success': True, 'operacion': operacion})
+    return jsonify({'success': False, 'mensaje': 'No hay cambios para deshacer'})
+
+@app.route('/api/rehacer', methods=['POST'])
+def rehacer():
+    """Vuelve a aplicar la última operación deshecha."""
+    operacion = almacen.rehacer()
+    if operacion:
+        return jsonify({'success': True, 'operacion': operacion})
+    return jsonify({'success': False, 'mensaje': 'No hay cambios para rehacer'})
 
 @app.route('/api/limpiar', methods=['POST'])
 def limpiar():
     """Limpia todos los elementos agregados."""
-    guardar_elementos([])
+    almacen.reemplazar([])
     return jsonify({'success': True})
 
+def parsear_bbox(valor):
+    """Convierte 'minLon,minLat,maxLon,maxLat' en tupla de floats (o None si es inválido)."""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in valor.split(','))
+    except (ValueError, AttributeError):
+        return None
+    if min_lon > max_lon or min_lat > max_lat:
+        return None
+    return min_lon, min_lat, max_lon, max_lat
+
+def elementos_en_bbox(bbox):
+    """Obtiene los elementos cuya caja envolvente intersecta el bbox."""
+    almacen.contar()
+    ids = indice.consultar(*bbox)
+    return [e for e in (almacen.obtener(i) for i in sorted(ids)) if e is not None]
+
 @app.route('/api/elementos', methods=['GET'])
+@validar_por_version
 def obtener_elementos_api():
-    """Obtiene todos los elementos agregados."""
-    return jsonify(cargar_elementos())
+    """Obtiene los elementos agregados; con ?bbox=minLon,minLat,maxLon,maxLat solo los visibles."""
+    if 'bbox' not in request.args:
+        return jsonify(cargar_elementos())
+    bbox = parsear_bbox(request.args['bbox'])
+    if not bbox:
+        return jsonify({'success': False, 'mensaje': 'bbox inválido, use minLon,minLat,maxLon,maxLat'}), 400
+    return jsonify(elementos_en_bbox(bbox))
+
+@app.route('/api/cambios', methods=['GET'])
+@validar_por_version
+def obtener_cambios_api():
+    """Elementos y capas cambiados después de la revisión ?desde=; sin ella, o si ya no hay registro, todo."""
+    try:
+        desde = int(request.args['desde']) if request.args.get('desde') else None
+    except ValueError:
+        return jsonify({'success': False, 'mensaje': 'desde debe ser un número de revisión'}), 400
+    return jsonify({'success': True, **cambios_desde(-1 if desde is None else desde)})
+
+def cambios_desde(desde, completo=True, geometria=False):
+    """Cambios posteriores a la revisión `desde`, como los devuelve /api/cambios.
+
+    Si el registro ya no cubre `desde` la respuesta es el estado completo
+    ('completo': True), o solo la revisión si `completo` es False. Con
+    `geometria` las torres llevan sus polígonos, como en /api/clusters.
+    """
+    revision, ids_elementos, ids_capas = registro.desde(desde)
+    if ids_elementos is None or len(ids_elementos) > MAX_CAMBIOS_DELTA:
+        if not completo:
+            return {'revision': revision, 'completo': True}
+        return {'revision': revision, 'completo': True, 'elementos': cargar_elementos(), 'capas': cargar_capas()}
+    elementos = {i: almacen.obtener(i) for i in sorted(ids_elementos)}
+    vigentes = [e for e in elementos.values() if e is not None]
+    capas = {c['id']: c for c in cargar_capas()}
+    return {
+        'revision': revision, 'completo': False,
+        'elementos': con_geometria_torres(vigentes) if geometria else vigentes,
+        'elementos_eliminados': [i for i, e in elementos.items() if e is None],
+        'capas': [capas[i] for i in sorted(ids_capas) if i in capas],
+        'capas_eliminadas': [i for i in sorted(ids_capas) if i not in capas]
+    }
+
+def evento_cambios(desde):
+    """(revisión, texto SSE) con los cambios posteriores a `desde`.
+
+    Todos los suscriptores que iban por la misma revisión reciben el mismo
+    evento, así que se calcula y se serializa una sola vez. Si el registro
+    ya no cubre `desde` el evento es 'resincronizar' y el editor recarga todo.
+    """
+    with _eventos_lock:
+        evento = _eventos_sse.get(desde)
+    if evento is not None and evento[0] == registro.revision:
+        return evento
+    cambios = cambios_desde(desde, completo=False, geometria=True)
+    tipo = 'resincronizar' if cambios['completo'] else 'cambios'
+    evento = (cambios['revision'], f"id: {cambios['revision']}\nevent: {tipo}\ndata: {json.dumps(cambios)}\n\n")
+    with _eventos_lock:
+        _eventos_sse[desde] = evento
+        while len(_eventos_sse) > MAX_EVENTOS_SSE:
+            del _eventos_sse[next(iter(_eventos_sse))]
+    return evento
+
+@app.route('/api/stream')
+def stream_cambios():
+    """Flujo SSE con los cambios de elementos y capas a medida que ocurren (evento 'cambios', como /api/cambios).
+
+    Empieza en la revisión de la cabecera Last-Event-ID (reconexión), en
+    ?desde= o en la actual. Cada conexión ocupa un hilo del servidor, así
+    que se admiten como mucho MAX_FLUJOS_SSE a la vez; las demás reciben 503.
+    """
+    try:
+        desde = int(request.headers.get('Last-Event-ID') or request.args.get('desde') or 0)
+    except ValueError:
+        return jsonify({'success': False, 'mensaje': 'desde debe ser un número de revisión'}), 400
+    if not _flujos_sse.acquire(blocking=False):
+        respuesta = jsonify({'success': False, 'mensaje': 'Demasiados editores conectados en vivo; use /api/cambios'})
+        respuesta.headers['Retry-After'] = str(INTERVALO_LATIDO_SSE)
+        return respuesta, 503
+    almacen.contar()
+    desde = desde or registro.revision
+
+    def generar(desde):
+        yield 'retry: 3000\n\n'
+        while True:
+            revision = registro.esperar(desde, INTERVALO_LATIDO_SSE)
+            if revision == desde:
+                yield ': latido\n\n'
+                continue
+            desde, texto = evento_cambios(desde)
+            yield texto
+
+    respuesta = Response(generar(desde), mimetype='text/event-stream')
+    # El servidor cierra la respuesta cuando el cliente se va (se nota al enviar el siguiente latido)
+    respuesta.call_on_close(_flujos_sse.release)
+    respuesta.cache_control.no_cache = True
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+@app.route('/api/torres/cercanas', methods=['GET'])
+def torres_cercanas_api():
+    """Las k torres más cercanas a lat/lon (k=5 por defecto); ?max_m= limita la distancia en metros."""
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        k = int(request.args.get('k', 5))
+        max_m = float(request.args['max_m']) if request.args.get('max_m') else None
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'mensaje': 'Parámetros requeridos: lat y lon; opcionales k (entero) y max_m (metros)'}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or not 1 <= k <= MAX_TORRES_CERCANAS or (max_m is not None and max_m < 0):
+        return jsonify({'success': False, 'mensaje': f'lat/lon fuera de rango, k entre 1 y {MAX_TORRES_CERCANAS} o max_m negativo'}), 400
+
+    almacen.contar()
+    ids, distancias = indice_torres.cercanas(lat, lon, k, max_m)
+    torres = [{**e, 'distancia_m': round(float(d), 1)}
+              for e, d in ((almacen.obtener(int(i)), d) for i, d in zip(ids, distancias)) if e is not None]
+    return jsonify({'success': True, 'total': len(torres), 'torres': torres})
+
+@app.route('/api/iconos/<clave>')
+def obtener_icono(clave):
+    """Sirve un icono por su hash SHA-256 (contenido inmutable, cacheable)."""
+    encontrado = buscar_icono(clave)
+    if not encontrado:
+        return jsonify({'success': False, 'mensaje': 'Icono no encontrado'}), 404
+    ruta, mimetype = encontrado
+    respuesta = send_file(os.path.abspath(ruta), mimetype=mimetype, max_age=31536000)
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+def obtener_indice_clusters():
+    """Devuelve (jerarquía, ids) de torres y etiquetas en capas visibles, recalculándola si cambió."""
+    with _clusters_lock:
+        if _clusters['indice'] is not None:
+            return _clusters['indice'], _clusters['ids']
+        version = _clusters['version']
+        ocultas = {c['id'] for c in cargar_capas() if not c.get('visible', True)}
+        puntos = [e for e in cargar_elementos()
+                  if e.get('tipo') in TIPOS_AGRUPABLES and e.get('capa') not in ocultas
+                  and e.get('lat') is not None and e.get('lon') is not None]
+        ids = np.array([e['id'] for e in puntos], dtype=np.int64)
+        indice_clusters = ClustersJerarquicos([e['lat'] for e in puntos], [e['lon'] for e in puntos])
+        if _clusters['version'] == version:
+            _clusters['indice'], _clusters['ids'] = indice_clusters, ids
+        return indice_clusters, ids
+
+@app.route('/api/clusters', methods=['GET'])
+@validar_por_version
+def obtener_clusters_api():
+    """Agrupa torres y etiquetas del bbox según el zoom; devuelve clusters y elementos sueltos."""
+    bbox = parsear_bbox(request.args.get('bbox'))
+    try:
+        zoom = int(request.args.get('zoom', ''))
+    except ValueError:
+        zoom = None
+    if not bbox or zoom is None:
+        return jsonify({'success': False, 'mensaje': 'Parámetros requeridos: bbox=minLon,minLat,maxLon,maxLat y zoom'}), 400
+    
+    indice_clusters, ids = obtener_indice_clusters()
+    lats, lons, cantidades, representantes = indice_clusters.consultar(*bbox, zoom)
+    agrupados = cantidades > 1
+    clusters = [{'lat': float(lat), 'lon': float(lon), 'cantidad': int(cantidad)}
+                for lat, lon, cantidad in zip(lats[agrupados], lons[agrupados], cantidades[agrupados])]
+    sueltos = sorted(int(i) for i in ids[representantes[~agrupados]])
+    elementos = [e for e in elementos_en_bbox(bbox) if e.get('tipo') not in TIPOS_AGRUPABLES]
+    elementos += [e for e in (almacen.obtener(i) for i in sueltos) if e is not None]
+    return jsonify({'clusters': clusters, 'elementos': con_geometria_torres(elementos)})
 
 @app.route('/api/capas', methods=['GET'])
+@validar_por_version
 def obtener_capas_api():
     """Obtiene todas las capas."""
     return jsonify(cargar_capas())
@@ -236,75 +678,44 @@ def obtener_capas_api():
 def crear_capa():
     """Crea una nueva capa."""
     data = request.json
-    capas = cargar_capas()
-    capa = {
-        'id': obtener_siguiente_id_capa(),
-        'nombre': data.get('nombre', f'Capa {len(capas) + 1}'),
+    capa = almacen.agregar_capa({
+        'nombre': data.get('nombre', f'Capa {len(cargar_capas()) + 1}'),
         'color': data.get('color', '#3498db'),
         'visible': True
-    }
-    capas.append(capa)
-    guardar_capas(capas)
+    })
     return jsonify({'success': True, 'capa': capa})
 
 @app.route('/api/capas/<int:capa_id>', methods=['DELETE'])
 def eliminar_capa(capa_id):
     """Elimina una capa y desasigna los elementos."""
-    capas = cargar_capas()
-    capas = [c for c in capas if c['id'] != capa_id]
-    guardar_capas(capas)
-    elementos = cargar_elementos()
-    for elem in elementos:
-        if elem.get('capa') == capa_id:
-            elem['capa'] = None
-    guardar_elementos(elementos)
+    almacen.eliminar_capa(capa_id)
     return jsonify({'success': True})
 
 @app.route('/api/capas/<int:capa_id>', methods=['PATCH'])
 def actualizar_capa(capa_id):
     """Actualiza una capa existente."""
     data = request.json
-    capas = cargar_capas()
-    for capa in capas:
-        if capa['id'] == capa_id:
-            if 'nombre' in data:
-                capa['nombre'] = data['nombre']
-            if 'color' in data:
-                capa['color'] = data['color']
-            if 'visible' in data:
-                capa['visible'] = data['visible']
-            guardar_capas(capas)
-            return jsonify({'success': True, 'capa': capa})
+    cambios = {k: data[k] for k in ('nombre', 'color', 'visible') if k in data}
+    capa = almacen.actualizar_capa(capa_id, cambios)
+    if capa:
+        return jsonify({'success': True, 'capa': capa})
     return jsonify({'success': False, 'mensaje': 'Capa no encontrada'}), 404
 
 @app.route('/api/elemento/<int:elemento_id>/capa', methods=['PATCH'])
 def asignar_capa_elemento(elemento_id):
     """Asigna una capa a un elemento."""
     data = request.json
-    elementos = cargar_elementos()
-    for elem in elementos:
-        if elem['id'] == elemento_id:
-            elem['capa'] = data.get('capa_id')
-            guardar_elementos(elementos)
-            return jsonify({'success': True, 'elemento': elem})
+    elem = almacen.actualizar(elemento_id, {'capa': data.get('capa_id')})
+    if elem:
+        return jsonify({'success': True, 'elemento': elem})
     return jsonify({'success': False, 'mensaje': 'Elemento no encontrado'}), 404
 
 @app.route('/api/actualizar-elemento/<int:elemento_id>', methods=['PATCH'])
 def actualizar_elemento(elemento_id):
     """Actualiza un elemento existente (renombrar)."""
-    elementos = cargar_elementos()
-    data = request.json
-    
-    for elem in elementos:
-        if elem['id'] == elemento_id:
-            if 'nombre' in data:
-                elem['nombre'] = data['nombre']
-            if 'texto' in data:
-                elem['texto'] = data['texto']
-            if 'icono' in data:
-                elem['icono'] = data['icono']
-            guardar_elementos(elementos)
-            return jsonify({'success': True, 'elemento': elem})
+    elem = almacen.actualizar(elemento_id, cambios_elemento(request.json))
+    if elem:
+        return jsonify({'success': True, 'elemento': elem})
     
     return jsonify({'success': False, 'mensaje': 'Elemento no encontrado'}), 404
 
@@ -343,30 +754,93 @@ def guardar_mapa():
         'mensaje': f'Mapa guardado como {nombre_salida}'
     })
 
+def matriz_azimuts(torres):
+    """Azimuts de cada torre como matriz (n, s), completando con NaN las torres con menos sectores."""
+    listas = [t.get('azimuts') or geometria.AZIMUTS_SECTORES for t in torres]
+    matriz = np.full((len(listas), max(len(l) for l in listas)), np.nan)
+    for fila, azimuts in zip(matriz, listas):
+        fila[:len(azimuts)] = azimuts
+    return matriz
+
+def calcular_geometria(elementos, poligonos=True):
+    """Calcula en un solo paso vectorizado la geometría geodésica de torres y círculos.
+
+    Devuelve una lista paralela a `elementos`: None para los demás tipos y,
+    para torres y círculos, un dict con 'radio' y 'anillo' (cobertura); las
+    torres añaden 'azimuts', 'ejes', 'sectores' (cuñas) y 'cardinales'.
+    Con poligonos=False se omiten 'anillo' y 'sectores', que solo usa el KML.
+    """
+    geometrias = [None] * len(elementos)
+    posiciones = [i for i, e in enumerate(elementos) if e.get('tipo') in RADIOS_POR_DEFECTO]
+    if not posiciones:
+        return geometrias
+    con_geometria = [elementos[i] for i in posiciones]
+    lats = np.array([float(e.get('lat') or 0) for e in con_geometria])
+    lons = np.array([float(e.get('lon') or 0) for e in con_geometria])
+    radios = np.array([float(e.get('radio') or RADIOS_POR_DEFECTO[e['tipo']]) for e in con_geometria])
+    anillos = geometria.circulos(lats, lons, radios) if poligonos else [None] * len(posiciones)
+    for i, radio, anillo in zip(posiciones, radios.tolist(), anillos):
+        geometrias[i] = {'radio': radio, 'anillo': anillo}
+    
+    sel = np.array([k for k, e in enumerate(con_geometria) if e['tipo'] == 'torre'], dtype=int)
+    if len(sel) == 0:
+        return geometrias
+    torres = [con_geometria[k] for k in sel]
+    azimuts = matriz_azimuts(torres)
+    anchos = np.array([float(t.get('ancho_sector') or geometria.ANCHO_SECTOR) for t in torres])
+    ejes = geometria.ejes_sectores(lats[sel], lons[sel], radios[sel], azimuts)
+    sectores = (geometria.poligonos_sectores(lats[sel], lons[sel], radios[sel], azimuts, anchos)
+                if poligonos else [None] * len(sel))
+    # Ejes y cardinales se pasan a listas de una vez, redondeados a 6 decimales (~0.1 m)
+    ejes = np.round(ejes, 6).tolist()
+    cardinales = np.round(geometria.puntos_cardinales(lats[sel], lons[sel], radios[sel]), 6).tolist()
+    for k, fila in enumerate(azimuts.tolist()):
+        validos = [j for j, azimut in enumerate(fila) if not np.isnan(azimut)]
+        geometrias[posiciones[sel[k]]].update(
+            azimuts=[fila[j] for j in validos], ejes=[ejes[k][j] for j in validos],
+            sectores=sectores[k], cardinales=cardinales[k])
+    return geometrias
+
+def geometria_por_bloques(elementos, tam_bloque=TAM_BLOQUE_GEOMETRIA, poligonos=True):
+    """Itera (elemento, geometría) calculando la geometría por bloques para acotar la memoria."""
+    bloque = []
+    for elem in elementos:
+        bloque.append(elem)
+        if len(bloque) >= tam_bloque:
+            yield from zip(bloque, calcular_geometria(bloque, poligonos))
+            bloque = []
+    if bloque:
+        yield from zip(bloque, calcular_geometria(bloque, poligonos))
+
+def geometria_para_mapa(geo):
+    """Versión JSON compacta de la geometría de una torre para dibujarla en el navegador."""
+    return {
+        'radio': geo['radio'],
+        'ejes': [[lat, lon, azimut] for (lat, lon), azimut in zip(geo['ejes'], geo['azimuts'])],
+        'cardinales': [[etiqueta, lat, lon] for (etiqueta, _), (lat, lon) in zip(geometria.CARDINALES, geo['cardinales'])]
+    }
+
+def con_geometria_torres(elementos):
+    """Copias de los elementos con la geometría precalculada de las torres en 'geometria'."""
+    resultado = []
+    for elem, geo in geometria_por_bloques(elementos, poligonos=False):
+        elem = {k: v for k, v in elem.items() if not k.startswith('_')}
+        if elem.get('tipo') == 'torre':
+            elem['geometria'] = geometria_para_mapa(geo)
+        resultado.append(elem)
+    return resultado
+
 def generar_script_elementos(elementos):
     """Genera el script JavaScript para los elementos agregados."""
     if not elementos:
         return ''
     
-    elementos_limpios = []
-    for elem in elementos:
-        elem_limpio = {k: v for k, v in elem.items() if not k.startswith('_')}
-        elementos_limpios.append(elem_limpio)
-    
-    elementos_json = json.dumps(elementos_limpios, ensure_ascii=False)
+    elementos_json = json.dumps(con_geometria_torres(elementos), ensure_ascii=False)
     return f'''
 <script>
 (function() {{
     var elementosGuardados = {elementos_json};
     
-    function calcularPuntoFinal(lat, lon, distKm, angulo) {{
-        var R = 6371, distRad = distKm / R, brngRad = angulo * Math.PI / 180;
-        var lat1Rad = lat * Math.PI / 180, lon1Rad = lon * Math.PI / 180;
-        var lat2Rad = Math.asin(Math.sin(lat1Rad) * Math.cos(distRad) + Math.cos(lat1Rad) * Math.sin(distRad) * Math.cos(brngRad));
-        var lon2Rad = lon1Rad + Math.atan2(Math.sin(brngRad) * Math.sin(distRad) * Math.cos(lat1Rad), Math.cos(distRad) - Math.sin(lat1Rad) * Math.sin(lat2Rad));
-        return [lat2Rad * 180 / Math.PI, lon2Rad * 180 / Math.PI];
-    }}
-    
     function esperarMapa() {{
         var mapInstance = null;
         for (var key in window) {{
@@ -411,29 +885,25 @@ def generar_script_elementos(elementos):
                     fillOpacity: 0.15,
                     weight: torreGrosor
                 }}).addTo(mapInstance);
-                var angulos = [180, 300, 60];
                 var colores = ['blue', 'green', 'red'];
-                angulos.forEach(function(angulo, i) {{
-                    var pf = calcularPuntoFinal(elem.lat, elem.lon, elem.radio / 1000, angulo);
-                    L.polyline([[elem.lat, elem.lon], pf], {{
-                        color: colores[i],
+                elem.geometria.ejes.forEach(function(eje, i) {{
+                    L.polyline([[elem.lat, elem.lon], [eje[0], eje[1]]], {{
+                        color: colores[i % colores.length],
                         weight: 2,
                         opacity: 0.8,
                         dashArray: '5, 5'
                     }}).addTo(mapInstance);
                 }});
-                var cardinales = {{'N': 0, 'E': 90, 'S': 180, 'O': 270}};
-                for (var p in cardinales) {{
-                    var pc = calcularPuntoFinal(elem.lat, elem.lon, (elem.radio * 0.9) / 1000, cardinales[p]);
-                    L.marker(pc, {{
+                elem.geometria.cardinales.forEach(function(cardinal) {{
+                    L.marker([cardinal[1], cardinal[2]], {{
                         icon: L.divIcon({{
                             className: 'cardinal-label',
-                            html: '<div style="font-size:10pt;font-weight:bold;color:black;background:white;padding:2px;border-radius:3px;">' + p + '</div>',
+                            html: '<div style="font-size:10pt;font-weight:bold;color:black;background:white;padding:2px;border-radius:3px;">' + cardinal[0] + '</div>',
                             iconSize: [20, 20],
                             iconAnchor: [10, 10]
                         }})
                     }}).addTo(mapInstance);
-                }}
+                }});
             }} else if (elem.tipo === 'circulo') {{
                 L.circle([elem.lat, elem.lon], {{
                     radius: elem.radio,
@@ -458,18 +928,14 @@ def descargar_archivo(nombre_archivo):
         return send_file(nombre_archivo, as_attachment=True)
     return jsonify({'success': False, 'mensaje': 'Archivo no encontrado'}), 404
 
-def generar_kml_contenido():
-    """Genera el contenido KML desde los elementos guardados."""
-    elementos = cargar_elementos()
-    
-    kml_header = '''<?xml version="1.0" encoding="UTF-8"?>
+KML_CABECERA = '''<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
 <Document>
     <name>Mapa Exportado</name>
     <description>Mapa exportado desde Editor de Mapa de Inteligencia</description>
 '''
-    
-    kml_styles = '''
+
+KML_ESTILOS = '''
     <Style id="rutaStyle">
         <LineStyle>
             <color>ff0000ff</color>
@@ -500,48 +966,129 @@ def generar_kml_contenido():
         </IconStyle>
     </Style>
 '''
+
+KML_PIE = '''
+</Document>
+</kml>'''
+
+def color_kml(color, alfa='ff'):
+    """Convierte un color '#RRGGBB' al formato KML 'AABBGGRR'."""
+    color_hex = str(color).lstrip('#')
+    return alfa + color_hex[4:6] + color_hex[2:4] + color_hex[0:2]
+
+def estilo_elemento(elem, iconos_kmz=None):
+    """Devuelve (id, xml) del estilo compartido de un elemento; xml es None para los estilos fijos.
+
+    Los elementos con el mismo tipo, color y grosor comparten un único <Style>.
+    Con `iconos_kmz` ({valor de 'icono': 'images/...'}) las etiquetas con
+    icono importado usan un estilo que apunta al icono dentro del KMZ.
+    """
+    tipo = elem['tipo']
+    if tipo == 'etiqueta':
+        href = (iconos_kmz or {}).get(elem.get('icono'))
+        if not href:
+            return 'etiquetaStyle', None
+        estilo_id = 'icono-' + os.path.basename(href)[:16]
+        return estilo_id, f'''
+    <Style id="{estilo_id}">
+        <IconStyle>
+            <Icon>
+                <href>{href}</href>
+            </Icon>
+        </IconStyle>
+    </Style>
+'''
+    if tipo == 'ruta':
+        color, grosor = elem.get('color', '#FF0000'), elem.get('grosor', 3)
+        relleno = None
+    elif tipo == 'torre':
+        color, grosor = elem.get('color', '#e74c3c'), elem.get('grosor', 2)
+        relleno = color
+    elif tipo == 'circulo':
+        color, grosor = elem.get('color', '#3388ff'), 2
+        relleno = color
+    else:
+        return None, None
+    estilo_id = f"{tipo}-{str(color).lstrip('#')}-{grosor}"
+    poly = f'''
+        <PolyStyle>
+            <color>{color_kml(relleno, '44')}</color>
+        </PolyStyle>''' if relleno else ''
+    return estilo_id, f'''
+    <Style id="{escape(estilo_id)}">
+        <LineStyle>
+            <color>{color_kml(color)}</color>
+            <width>{grosor}</width>
+        </LineStyle>{poly}
+    </Style>
+'''
+
+_FORMATOS_COORDENADAS = {}
+
+def poligono_kml(anillo):
+    """<Polygon> KML de un anillo [[lat, lon], ...] ya cerrado."""
+    n = len(anillo)
+    formato = _FORMATOS_COORDENADAS.get(n)
+    if formato is None:
+        formato = _FORMATOS_COORDENADAS.setdefault(n, ' '.join(['%.7f,%.7f,0'] * n))
+    coords = formato % tuple(anillo[:, ::-1].ravel().tolist())
+    return f'''<Polygon>
+            <outerBoundaryIs>
+                <LinearRing>
+                    <coordinates>{coords}</coordinates>
+                </LinearRing>
+            </outerBoundaryIs>
+        </Polygon>'''
+
+def generar_kml(elementos, iconos_kmz=None):
+    """Genera el documento KML por partes: cabecera, estilos, un placemark por vez y cierre.
+
+    Una primera pasada sobre los elementos reúne los estilos distintos, que
+    se escriben una sola vez y se referencian con <styleUrl>. Los círculos
+    y las cuñas de sector se calculan por bloques con el módulo geometria.
+    """
+    estilos = {}
+    for elem in elementos:
+        estilo_id, estilo_xml = estilo_elemento(elem, iconos_kmz)
+        if estilo_xml and estilo_id not in estilos:
+            estilos[estilo_id] = estilo_xml
     
-    kml_placemarks = ''
+    yield KML_CABECERA
+    yield KML_ESTILOS
+    yield ''.join(estilos.values())
     
-    for elem in elementos:
+    for elem, geo in geometria_por_bloques(elementos):
+        estilo_id = escape(estilo_elemento(elem, iconos_kmz)[0] or '')
         if elem['tipo'] == 'ruta':
-            color_hex = elem.get('color', '#FF0000').lstrip('#')
-            kml_color = 'ff' + color_hex[4:6] + color_hex[2:4] + color_hex[0:2]
             coords = ' '.join([f"{p[1]},{p[0]},0" for p in elem.get('puntos', [])])
-            kml_placemarks += f'''
+            yield f'''
     <Placemark>
-        <name>{elem.get('nombre', 'Ruta')}</name>
-        <Style>
-            <LineStyle>
-                <color>{kml_color}</color>
-                <width>{elem.get('grosor', 3)}</width>
-            </LineStyle>
-        </Style>
+        <name>{escape(str(elem.get('nombre', 'Ruta')))}</name>
+        <styleUrl>#{estilo_id}</styleUrl>
         <LineString>
             <coordinates>{coords}</coordinates>
         </LineString>
     </Placemark>
 '''
         elif elem['tipo'] == 'etiqueta':
-            kml_placemarks += f'''
+            yield f'''
     <Placemark>
-        <name>{elem.get('texto', 'Etiqueta')}</name>
-        <styleUrl>#etiquetaStyle</styleUrl>
+        <name>{escape(str(elem.get('texto', 'Etiqueta')))}</name>
+        <styleUrl>#{estilo_id}</styleUrl>
         <Point>
             <coordinates>{elem.get('lon', 0)},{elem.get('lat', 0)},0</coordinates>
         </Point>
     </Placemark>
 '''
         elif elem['tipo'] == 'torre':
-            color_hex = elem.get('color', '#e74c3c').lstrip('#')
-            kml_color = 'ff' + color_hex[4:6] + color_hex[2:4] + color_hex[0:2]
             lat = elem.get('lat', 0)
             lon = elem.get('lon', 0)
             radio = elem.get('radio', 500)
+            nombre = escape(str(elem.get('nombre', 'Torre Telefonica')))
             
-            kml_placemarks += f'''
+            yield f'''
     <Placemark>
-        <name>{elem.get('nombre', 'Torre Telefonica')}</name>
+        <name>{nombre}</name>
         <description>Radio: {radio}m</description>
         <styleUrl>#torreStyle</styleUrl>
         <Point>
@@ -549,121 +1096,153 @@ def generar_kml_contenido():
         </Point>
     </Placemark>
 '''
-            circle_coords = generar_circulo_coords(lat, lon, radio)
-            kml_placemarks += f'''
+            yield f'''
     <Placemark>
-        <name>{elem.get('nombre', 'Torre')} - Cobertura</name>
-        <Style>
-            <LineStyle>
-                <color>{kml_color}</color>
-                <width>{elem.get('grosor', 2)}</width>
-            </LineStyle>
-            <PolyStyle>
-                <color>44{color_hex[4:6]}{color_hex[2:4]}{color_hex[0:2]}</color>
-            </PolyStyle>
-        </Style>
-        <Polygon>
-            <outerBoundaryIs>
-                <LinearRing>
-                    <coordinates>{circle_coords}</coordinates>
-                </LinearRing>
-            </outerBoundaryIs>
-        </Polygon>
+        <name>{escape(str(elem.get('nombre', 'Torre')))} - Cobertura</name>
+        <styleUrl>#{estilo_id}</styleUrl>
+        {poligono_kml(geo['anillo'])}
+    </Placemark>
+'''
+            if geo['sectores']:
+                cunas = ''.join(poligono_kml(cuna) for cuna in geo['sectores'])
+                yield f'''
+    <Placemark>
+        <name>{escape(str(elem.get('nombre', 'Torre')))} - Sectores</name>
+        <styleUrl>#{estilo_id}</styleUrl>
+        <MultiGeometry>{cunas}</MultiGeometry>
     </Placemark>
 '''
         elif elem['tipo'] == 'circulo':
-            color_hex = elem.get('color', '#3388ff').lstrip('#')
-            kml_color = 'ff' + color_hex[4:6] + color_hex[2:4] + color_hex[0:2]
-            lat = elem.get('lat', 0)
-            lon = elem.get('lon', 0)
-            radio = elem.get('radio', 100)
-            
-            circle_coords = generar_circulo_coords(lat, lon, radio)
-            kml_placemarks += f'''
+            yield f'''
     <Placemark>
-        <name>{elem.get('nombre', 'Circulo')}</name>
-        <Style>
-            <LineStyle>
-                <color>{kml_color}</color>
-                <width>2</width>
-            </LineStyle>
-            <PolyStyle>
-                <color>44{color_hex[4:6]}{color_hex[2:4]}{color_hex[0:2]}</color>
-            </PolyStyle>
-        </Style>
-        <Polygon>
-            <outerBoundaryIs>
-                <LinearRing>
-                    <coordinates>{circle_coords}</coordinates>
-                </LinearRing>
-            </outerBoundaryIs>
-        </Polygon>
+        <name>{escape(str(elem.get('nombre', 'Circulo')))}</name>
+        <styleUrl>#{estilo_id}</styleUrl>
+        {poligono_kml(geo['anillo'])}
     </Placemark>
 '''
     
-    kml_footer = '''
-</Document>
-</kml>'''
-    
-    return kml_header + kml_styles + kml_placemarks + kml_footer
+    yield KML_PIE
 
-def generar_circulo_coords(lat, lon, radio_metros, num_puntos=64):
-    """Genera coordenadas de un círculo cerrado para KML."""
-    coords = []
-    R = 6371000
-    lat_rad = math.radians(lat)
-    
-    for i in range(num_puntos):
-        angulo = (2 * math.pi * i) / num_puntos
-        d_lat = (radio_metros / R) * math.cos(angulo)
-        d_lon = (radio_metros / (R * math.cos(lat_rad))) * math.sin(angulo)
-        
-        nuevo_lat = lat + math.degrees(d_lat)
-        nuevo_lon = lon + math.degrees(d_lon)
-        coords.append(f"{nuevo_lon},{nuevo_lat},0")
-    
-    if coords:
-        coords.append(coords[0])
-    
-    return ' '.join(coords)
+def agrupar_bloques(partes, tam_bloque=65536):
+    """Agrupa las partes pequeñas de un generador en bloques de ~tam_bloque caracteres."""
+    bloque = []
+    tam = 0
+    for parte in partes:
+        bloque.append(parte)
+        tam += len(parte)
+        if tam >= tam_bloque:
+            yield ''.join(bloque)
+            bloque = []
+            tam = 0
+    if bloque:
+        yield ''.join(bloque)
+
+def generar_kml_contenido():
+    """Genera el contenido KML completo desde los elementos guardados."""
+    return ''.join(generar_kml(cargar_elementos()))
 
 @app.route('/api/export/kml')
 def exportar_kml():
     """Exporta el mapa a formato KML."""
+    # Los errores se atajan antes de empezar a enviar: una vez en marcha
+    # la respuesta ya no puede convertirse en un 500
     try:
-        kml_content = generar_kml_contenido()
-        
-        return Response(
-            kml_content,
-            mimetype='application/vnd.google-earth.kml+xml',
-            headers={
-                'Content-Disposition': 'attachment; filename=mapa_exportado.kml'
-            }
-        )
+        elementos = cargar_elementos()
     except Exception as e:
         return jsonify({'success': False, 'mensaje': str(e)}), 500
+    
+    return Response(
+        agrupar_bloques(generar_kml(elementos)),
+        mimetype='application/vnd.google-earth.kml+xml',
+        headers={
+            'Content-Disposition': 'attachment; filename=mapa_exportado.kml'
+        }
+    )
+
+class SalidaEnBloques(io.RawIOBase):
+    """Flujo de solo escritura que acumula bytes para entregarlos por partes.
+
+    Permite escribir un ZIP con zipfile sin mantenerlo completo en memoria:
+    tras cada escritura se vacía lo acumulado y se envía al cliente.
+    """
+
+    def __init__(self):
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+def iconos_kmz(elementos):
+    """Reúne los iconos de las etiquetas para el KMZ sin escribir nada en disco.
+
+    Devuelve (hrefs, archivos): hrefs asocia cada icono a su nombre dentro de
+    images/ y archivos asocia ese nombre a la ruta del icono guardado o a
+    sus bytes, si el elemento aún lleva el icono como 'data:' URI.
+    """
+    hrefs = {}
+    archivos = {}
+    for elem in elementos:
+        icono = elem.get('icono')
+        if elem.get('tipo') != 'etiqueta' or not icono or icono in hrefs:
+            continue
+        decodificado = decodificar_icono(icono)
+        if decodificado:
+            datos, extension = decodificado
+            nombre = f"images/{hashlib.sha256(datos).hexdigest()}.{extension}"
+            hrefs[icono] = nombre
+            archivos[nombre] = datos
+            continue
+        encontrado = buscar_icono(icono)
+        if encontrado:
+            nombre = 'images/' + os.path.basename(encontrado[0])
+            hrefs[icono] = nombre
+            archivos[nombre] = encontrado[0]
+    return hrefs, archivos
+
+def generar_kmz(elementos, hrefs, archivos):
+    """Genera un KMZ por partes: doc.kml escrito incrementalmente y cada icono una sola vez en images/."""
+    salida = SalidaEnBloques()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as kmz:
+        # El tamaño de doc.kml no se conoce al abrir la entrada: sin ZIP64
+        # zipfile fallaría al cerrarla si pasa de 2 GiB
+        with kmz.open('doc.kml', 'w', force_zip64=True) as doc:
+            for bloque in agrupar_bloques(generar_kml(elementos, hrefs)):
+                doc.write(bloque.encode('utf-8'))
+                yield salida.vaciar()
+        for nombre, origen in archivos.items():
+            if isinstance(origen, bytes):
+                kmz.writestr(nombre, origen)
+            else:
+                kmz.write(origen, nombre)
+            yield salida.vaciar()
+    yield salida.vaciar()
 
 @app.route('/api/export/kmz')
 def exportar_kmz():
-    """Exporta el mapa a formato KMZ (KML comprimido)."""
+    """Exporta el mapa a formato KMZ (KML comprimido con sus iconos)."""
+    # Como en el KML, todo lo que puede fallar se resuelve antes de enviar
     try:
-        kml_content = generar_kml_contenido()
-        
-        kmz_buffer = io.BytesIO()
-        with zipfile.ZipFile(kmz_buffer, 'w', zipfile.ZIP_DEFLATED) as kmz:
-            kmz.writestr('doc.kml', kml_content)
-        
-        kmz_buffer.seek(0)
-        
-        return Response(
-            kmz_buffer.getvalue(),
-            mimetype='application/vnd.google-earth.kmz',
-            headers={
-                'Content-Disposition': 'attachment; filename=mapa_exportado.kmz'
-            }
-        )
+        elementos = cargar_elementos()
+        hrefs, archivos = iconos_kmz(elementos)
     except Exception as e:
         return jsonify({'success': False, 'mensaje': str(e)}), 500
+    
+    return Response(
+        generar_kmz(elementos, hrefs, archivos),
+        mimetype='application/vnd.google-earth.kmz',
+        headers={
+            'Content-Disposition': 'attachment; filename=mapa_exportado.kmz'
+        }
+    )
 
 @app.route('/api/export/radio-bts-excel')
 def exportar_radio_bts_excel():
@@ -731,11 +1310,206 @@ def exportar_radio_bts_excel():
     except Exception as e:
         return jsonify({'success': False, 'mensaje': str(e)}), 500
 
+def torres_del_mapa():
+    """Torres con coordenadas del mapa: (ids, nombres, lats, lons, radios) como arrays."""
+    torres = [e for e in cargar_elementos()
+              if e.get('tipo') == 'torre' and e.get('lat') is not None and e.get('lon') is not None]
+    return (np.array([t['id'] for t in torres], dtype=np.int64),
+            np.array([t.get('nombre', '') for t in torres], dtype=object),
+            np.array([float(t['lat']) for t in torres]),
+            np.array([float(t['lon']) for t in torres]),
+            np.array([float(t.get('radio') or RADIOS_POR_DEFECTO['torre']) for t in torres]))
+
+def respuesta_excel(hojas, nombre_archivo):
+    """Respuesta de descarga con {nombre_hoja: DataFrame} escrito en un .xlsx."""
+    excel_buffer = io.BytesIO()
+    escribir_excel(hojas, excel_buffer)
+    return Response(
+        excel_buffer.getvalue(),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={
+            'Content-Disposition': f'attachment; filename={nombre_archivo}'
+        }
+    )
+
+def calcular_solapes():
+    """Solapes entre las torres del mapa, con ids, nombres y radios de cada par."""
+    ids, nombres, lats, lons, radios = torres_del_mapa()
+    solapes = solapes_torres(lats, lons, radios)
+    a, b = solapes['torre_a'].to_numpy(), solapes['torre_b'].to_numpy()
+    return pd.DataFrame({
+        'id_a': ids[a], 'nombre_a': nombres[a], 'radio_a': radios[a],
+        'id_b': ids[b], 'nombre_b': nombres[b], 'radio_b': radios[b],
+        'distancia_m': solapes['distancia_m'].round(1), 'solape_m': solapes['solape_m'].round(1)
+    })
+
+@app.route('/api/analisis/solapes', methods=['GET'])
+def analizar_solapes_api():
+    """Pares de torres cuyas coberturas se solapan; ?min_solape=metros filtra los solapes pequeños."""
+    try:
+        min_solape = float(request.args.get('min_solape', 0))
+    except ValueError:
+        return jsonify({'success': False, 'mensaje': 'min_solape debe ser numérico'}), 400
+    solapes = calcular_solapes()
+    solapes = solapes[solapes['solape_m'] >= min_solape]
+    return jsonify({'success': True, 'total': len(solapes), 'solapes': solapes.to_dict('records')})
+
+@app.route('/api/export/solapes-excel')
+def exportar_solapes_excel():
+    """Exporta a Excel los solapes de cobertura entre Radio BTS."""
+    try:
+        solapes = calcular_solapes()
+        if solapes.empty:
+            return jsonify({'success': False, 'mensaje': 'No hay Radio BTS con coberturas solapadas'}), 400
+        solapes.columns = ['ID A', 'Nombre A', 'Radio A (m)', 'ID B', 'Nombre B', 'Radio B (m)',
+                           'Distancia (m)', 'Solape (m)']
+        return respuesta_excel({'Solapes BTS': solapes}, 'solapes_bts.xlsx')
+    except Exception as e:
+        return jsonify({'success': False, 'mensaje': str(e)}), 500
+
+def leer_puntos_peticion():
+    """Puntos enviados como JSON {'puntos': [[lat, lon], ...]} o como archivo 'archivo' (Excel, CSV o Parquet).
+
+    Devuelve (puntos, lats, lons), donde `puntos` identifica cada punto: su
+    posición en la lista JSON o su fila en el archivo (contando la cabecera).
+    """
+    if 'archivo' in request.files:
+        from mapa_torres import buscar_columnas_coordenadas, leer_bloques_coordenadas
+        subido = request.files['archivo']
+        descriptor, ruta = tempfile.mkstemp(suffix=os.path.splitext(subido.filename or '')[1].lower() or '.csv')
+        os.close(descriptor)
+        try:
+            subido.save(ruta)
+            columnas = buscar_columnas_coordenadas(ruta, hoja=None)
+            if columnas is None:
+                raise ValueError('el archivo no tiene columnas de latitud y longitud')
+            filas, lats, lons = [np.empty(0, dtype=np.int64)], [np.empty(0)], [np.empty(0)]
+            for filas_bloque, lats_bloque, lons_bloque in leer_bloques_coordenadas(ruta, *columnas, hoja=None):
+                filas.append(filas_bloque)
+                lats.append(lats_bloque)
+                lons.append(lons_bloque)
+        finally:
+            os.remove(ruta)
+        return np.concatenate(filas) + 2, np.concatenate(lats), np.concatenate(lons)
+    puntos = np.asarray((request.get_json(silent=True) or {}).get('puntos', []), dtype=float).reshape(-1, 2)
+    return np.arange(len(puntos)), puntos[:, 0], puntos[:, 1]
+
+@app.route('/api/analisis/cobertura', methods=['POST'])
+def analizar_cobertura_api():
+    """Torres del mapa cuya cobertura contiene cada punto enviado; ?formato=csv|excel descarga el resultado."""
+    try:
+        puntos, lats, lons = leer_puntos_peticion()
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'mensaje': f'Puntos inválidos: {e}'}), 400
+    ids, nombres, lats_torres, lons_torres, radios = torres_del_mapa()
+    cobertura = cobertura_puntos(ArbolEsferico(lats_torres, lons_torres), radios, lats, lons)
+    p, t = cobertura['punto'].to_numpy(), cobertura['torre'].to_numpy()
+    tabla = pd.DataFrame({
+        'punto': puntos[p], 'lat': lats[p], 'lon': lons[p],
+        'id_torre': ids[t], 'nombre_torre': nombres[t], 'distancia_m': cobertura['distancia_m'].round(1)
+    })
+    formato = request.args.get('formato', 'json')
+    if formato == 'csv':
+        return Response(tabla.to_csv(index=False), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=cobertura_puntos.csv'})
+    if formato == 'excel':
+        tabla.columns = ['Punto', 'Latitud', 'Longitud', 'ID torre', 'Nombre torre', 'Distancia (m)']
+        return respuesta_excel({'Cobertura': tabla}, 'cobertura_puntos.xlsx')
+    return jsonify({'success': True, 'puntos': len(lats), 'cubiertos': int(len(np.unique(p))),
+                    'resultados': tabla.to_dict('records')})
+
+def campo_csv(valor):
+    """Valor de una celda CSV, entre comillas solo si hace falta."""
+    texto = str(valor)
+    if any(c in texto for c in ',"\n\r'):
+        return '"' + texto.replace('"', '""') + '"'
+    return texto
+
+def puntos_seleccion(seleccion):
+    """(ids, nombres, lats, lons) de un lado de /api/distancias.
+
+    `seleccion` es un tipo o lista de tipos separados por comas ('torre',
+    'torre,etiqueta'), o un dict {'tipo': ...}, {'ids': [...]}, {'capa': id}
+    o {'puntos': [[lat, lon], ...]}. Los puntos sueltos no tienen id.
+    """
+    if isinstance(seleccion, str):
+        seleccion = {'tipo': seleccion}
+    if not isinstance(seleccion, dict) or not seleccion:
+        raise ValueError('se esperaba un tipo de elemento, ids, capa o puntos')
+    if 'puntos' in seleccion:
+        puntos = np.asarray(seleccion['puntos'], dtype=float).reshape(-1, 2)
+        return ([None] * len(puntos), [f'Punto {i + 1}' for i in range(len(puntos))],
+                puntos[:, 0], puntos[:, 1])
+    tipos = seleccion.get('tipo')
+    if isinstance(tipos, str):
+        tipos = [t.strip() for t in tipos.split(',') if t.strip()]
+    ids = set(int(i) for i in seleccion['ids']) if 'ids' in seleccion else None
+    elementos = [e for e in cargar_elementos()
+                 if e.get('lat') is not None and e.get('lon') is not None
+                 and (tipos is None or e.get('tipo') in tipos)
+                 and (ids is None or e['id'] in ids)
+                 and ('capa' not in seleccion or e.get('capa') == seleccion['capa'])]
+    return ([e['id'] for e in elementos],
+            [e.get('nombre') or e.get('texto') or f"{e.get('tipo', 'elemento')} {e['id']}" for e in elementos],
+            np.array([float(e['lat']) for e in elementos]),
+            np.array([float(e['lon']) for e in elementos]))
+
+@app.route('/api/distancias', methods=['GET', 'POST'])
+def distancias_api():
+    """Matriz de distancias entre dos conjuntos de elementos o puntos; ?formato=csv|excel descarga el resultado.
+
+    Por GET: ?origenes=torre&destinos=etiqueta[&metodo=vincenty]. Por POST,
+    un JSON con 'origenes' y 'destinos' (ver puntos_seleccion) y 'metodo'.
+    """
+    datos = request.get_json(silent=True) or {}
+    metodo = datos.get('metodo') or request.args.get('metodo', 'haversine')
+    formato = request.args.get('formato', 'json')
+    if metodo not in METODOS_DISTANCIA:
+        return jsonify({'success': False, 'mensaje': f"metodo debe ser uno de: {', '.join(METODOS_DISTANCIA)}"}), 400
+    try:
+        ids_a, nombres_a, lats_a, lons_a = puntos_seleccion(datos.get('origenes', request.args.get('origenes')))
+        ids_b, nombres_b, lats_b, lons_b = puntos_seleccion(datos.get('destinos', request.args.get('destinos')))
+    except (TypeError, ValueError, KeyError) as e:
+        return jsonify({'success': False, 'mensaje': f'origenes/destinos inválidos: {e}'}), 400
+    if not len(lats_a) or not len(lats_b):
+        return jsonify({'success': False, 'mensaje': 'No hay origenes o destinos con coordenadas'}), 400
+    celdas = len(lats_a) * len(lats_b)
+    if celdas > MAX_CELDAS_DISTANCIAS.get(formato, celdas) or (formato == 'excel' and len(lats_b) > MAX_COLUMNAS_EXCEL - 4):
+        return jsonify({'success': False, 'mensaje': f'Matriz de {len(lats_a)} x {len(lats_b)} demasiado grande; use formato=csv'}), 400
+    decimales = 3 if metodo == 'vincenty' else 1
+    cabecera = pd.DataFrame({'ID': ids_a, 'Origen': nombres_a, 'Latitud': lats_a, 'Longitud': lons_a})
+
+    if formato == 'csv':
+        # Una cadena de formato por fila: unas 4 veces mas rapido que DataFrame.to_csv
+        formato_fila = ','.join([f'%.{decimales}f'] * len(lats_b)) + '\n'
+        prefijos = [f"{'' if i is None else i},{campo_csv(n)},{la!r},{lo!r}," for i, n, la, lo
+                    in zip(ids_a, nombres_a, lats_a.tolist(), lons_a.tolist())]
+        def generar():
+            yield ','.join(campo_csv(c) for c in [*cabecera.columns, *nombres_b]) + '\n'
+            for inicio, bloque in distancias_por_bloques(lats_a, lons_a, lats_b, lons_b, metodo):
+                yield ''.join(p + formato_fila % tuple(fila) for p, fila in zip(prefijos[inicio:], bloque.tolist()))
+        return Response(generar(), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=distancias.csv'})
+    matriz = matriz_distancias(lats_a, lons_a, lats_b, lons_b, metodo).round(decimales)
+    if formato == 'excel':
+        tabla = pd.concat([cabecera, pd.DataFrame(matriz, columns=nombres_b)], axis=1)
+        return respuesta_excel({'Distancias (m)': tabla}, 'distancias.xlsx')
+    def lado(ids, nombres, lats, lons):
+        return [{'id': i, 'nombre': n, 'lat': float(la), 'lon': float(lo)} for i, n, la, lo in zip(ids, nombres, lats, lons)]
+    return jsonify({'success': True, 'metodo': metodo,
+                    'origenes': lado(ids_a, nombres_a, lats_a, lons_a),
+                    'destinos': lado(ids_b, nombres_b, lats_b, lons_b),
+                    'distancias_m': matriz.tolist()})
+
 def set_mapa_archivo(archivo, mantener_elementos=True):
     """Configura el archivo de mapa a usar."""
     os.environ['MAPA_HTML'] = archivo
-    if not mantener_elementos and os.path.exists(ARCHIVO_ELEMENTOS):
-        os.remove(ARCHIVO_ELEMENTOS)
+    almacen.descartar()
+    _semilla['clave'] = None
+    if not mantener_elementos:
+        for ruta in (ARCHIVO_ELEMENTOS, ARCHIVO_DIARIO, ARCHIVO_DB, ARCHIVO_SEMILLA):
+            if os.path.exists(ruta):
+                os.remove(ruta)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
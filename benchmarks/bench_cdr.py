@@ -0,0 +1,71 @@
+"""Rendimiento de la union de CDR con torres y las trayectorias por abonado (user-018).
+
+Escribe un CDR sintetico en CSV (fechas 'dd/mm/aaaa hh:mm:ss') y una tabla
+de torres, y mide lo mismo que `mapa_torres.py --cdr` antes de escribir al
+almacen: lectura por bloques, union por id de celda y trayectorias. Con
+--fechas-pandas se desactiva el lector de fechas por bytes para comparar
+con pd.to_datetime.
+
+    python benchmarks/bench_cdr.py --filas 10000000
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analisis  # noqa: E402
+from mapa_torres import leer_bloques_tabla  # noqa: E402
+
+
+def escribir_cdr(archivo, filas, torres, abonados, semilla=0, bloque=1000000):
+    rng = np.random.default_rng(semilla)
+    inicio = np.datetime64('2024-01-01T00:00:00', 's').astype(np.int64)
+    for desde in range(0, filas, bloque):
+        n = min(bloque, filas - desde)
+        instantes = pd.to_datetime(inicio + rng.integers(0, 30 * 86400, n), unit='s')
+        pd.DataFrame({
+            'MSISDN': (584120000000 + rng.integers(0, abonados, n)).astype(str),
+            'CGI': rng.integers(0, torres, n) + 10000,
+            'FECHA_HORA': instantes.strftime('%d/%m/%Y %H:%M:%S'),
+        }).to_csv(archivo, mode='w' if desde == 0 else 'a', header=desde == 0, index=False, sep=';')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, default=1000000)
+    parser.add_argument('--torres', type=int, default=5000)
+    parser.add_argument('--abonados', type=int, default=50000)
+    parser.add_argument('--fechas-pandas', action='store_true', help='Sin el lector de fechas por bytes')
+    args = parser.parse_args()
+
+    if args.fechas_pandas:
+        analisis._fechas_fijas = lambda valores: (None, np.zeros(len(valores), dtype=bool))
+
+    with tempfile.TemporaryDirectory() as directorio:
+        archivo = os.path.join(directorio, 'cdr.csv')
+        print(f"Generando CDR de {args.filas:,} filas...")
+        escribir_cdr(archivo, args.filas, args.torres, args.abonados)
+        print(f"CSV: {os.path.getsize(archivo) / 1e6:.0f} MB")
+
+        inicio = time.perf_counter()
+        trayectorias = analisis.TrayectoriasCDR(np.arange(args.torres) + 10000)
+        for bloque in leer_bloques_tabla(archivo, ['MSISDN', 'CGI', 'FECHA_HORA'], hoja=None):
+            trayectorias.agregar(bloque['MSISDN'], bloque['CGI'], bloque['FECHA_HORA'])
+        lectura = time.perf_counter() - inicio
+        nombres, torres, _, _ = trayectorias.trayectorias()
+        duracion = time.perf_counter() - inicio
+
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+    print(f"{trayectorias.leidos:,} registros en {duracion:.1f}s ({trayectorias.leidos / duracion:,.0f} registros/s; "
+          f"lectura y union {lectura:.1f}s)")
+    print(f"{len(nombres):,} trayectorias, {len(torres):,} puntos; pico de memoria {pico:.2f} GB")
+
+
+if __name__ == '__main__':
+    main()
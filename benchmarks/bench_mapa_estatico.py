@@ -0,0 +1,107 @@
+"""Tamano del HTML estatico de torres y tiempo de compilar sus scripts (user-010).
+
+Genera tablas de torres aleatorias (hoja FTD de un .xlsx, como las lee
+cualquier version del conversor), crea el mapa con crear_mapa_de_torres y
+mide el tamano del HTML (y del .torres.json con --datos-aparte) y lo que
+tarda Node en compilar los scripts de la pagina. Con --repo se mide otra
+copia del proyecto, por ejemplo la version base en un `git worktree`.
+
+    python benchmarks/bench_mapa_estatico.py --torres 1000 10000 100000
+    git worktree add /tmp/base 4e224ab && python benchmarks/bench_mapa_estatico.py --repo /tmp/base
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMPILAR_JS = """
+const fs = require('fs'), vm = require('vm');
+const [codigo, datos] = process.argv.slice(1);
+const resultado = {compilar_ms: 0, errores: 0};
+for (const script of JSON.parse(fs.readFileSync(codigo, 'utf8'))) {
+    const t = process.hrtime.bigint();
+    try {
+        new vm.Script(script);
+    } catch (e) {
+        resultado.errores++;
+    }
+    resultado.compilar_ms += Number(process.hrtime.bigint() - t) / 1e6;
+}
+if (datos) {
+    const texto = fs.readFileSync(datos, 'utf8');
+    const t = process.hrtime.bigint();
+    JSON.parse(texto);
+    resultado.parse_ms = Number(process.hrtime.bigint() - t) / 1e6;
+}
+console.log(JSON.stringify(resultado));
+"""
+
+
+def escribir_torres(archivo, n, semilla=0):
+    rng = np.random.default_rng(semilla)
+    pd.DataFrame({'Latitud': rng.uniform(1, 12, n).round(6), 'Longitud': rng.uniform(-73, -60, n).round(6)}).to_excel(
+        archivo, sheet_name='FTD', index=False)
+
+
+def medir_node(html, datos=None):
+    """Milisegundos de compilar cada script en linea (y de JSON.parse de `datos`), o None sin Node.
+
+    'errores' cuenta los scripts que no compilan (la version base tiene uno).
+    """
+    node = shutil.which('node')
+    if node is None:
+        return None
+    with open(html, encoding='utf-8') as f:
+        scripts = re.findall(r'<script(?![^>]*\bsrc=)[^>]*>(.*?)</script>', f.read(), re.S)
+    codigo = html + '.scripts.json'
+    with open(codigo, 'w', encoding='utf-8') as f:
+        json.dump(scripts, f)
+    salida = subprocess.run([node, '-e', COMPILAR_JS, codigo] + ([datos] if datos else []),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(salida)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--torres', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--radio', type=int, default=500)
+    parser.add_argument('--datos-aparte', action='store_true')
+    parser.add_argument('--repo', default=RAIZ, help='Copia del proyecto a medir (por defecto esta)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.repo))
+    import mapa_torres
+    opciones = {'datos_aparte': True} if args.datos_aparte else {}
+
+    print(f"{'torres':>8} {'HTML':>10} {'datos':>10} {'generar':>9} {'compilar JS':>12} {'JSON.parse':>11} {'errores JS':>11}")
+    with tempfile.TemporaryDirectory() as directorio:
+        for n in args.torres:
+            tabla = os.path.join(directorio, f'torres_{n}.xlsx')
+            html = os.path.join(directorio, f'mapa_{n}.html')
+            escribir_torres(tabla, n)
+            inicio = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                mapa_torres.crear_mapa_de_torres(tabla, args.radio, guardar_como=html, **opciones)
+            generar = time.perf_counter() - inicio
+            datos = os.path.splitext(html)[0] + '.torres.json'
+            datos = datos if os.path.exists(datos) else None
+            node = medir_node(html, datos) or {}
+            print(f"{n:>8} {os.path.getsize(html) / 1e6:>8.2f}MB "
+                  f"{(os.path.getsize(datos) / 1e6 if datos else 0):>8.2f}MB {generar:>8.2f}s "
+                  f"{node.get('compilar_ms', float('nan')):>10.1f}ms {node.get('parse_ms', float('nan')):>9.1f}ms {node.get('errores', '-'):>11}")
+
+
+if __name__ == '__main__':
+    main()
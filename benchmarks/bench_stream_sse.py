@@ -0,0 +1,125 @@
+"""Prueba de carga de /api/stream: N editores suscritos y uno haciendo cambios (user-024).
+
+Arranca el servidor del editor en un subproceso (servidor con hilos de
+Flask, en un directorio temporal), abre `--suscriptores` conexiones SSE y
+hace `--cambios` altas y bajas por la API. Mide cuantos eventos llegan a
+cada suscriptor y la latencia desde que se envia el cambio hasta que el
+suscriptor lo recibe, y el CPU del servidor.
+
+    python benchmarks/bench_stream_sse.py --suscriptores 50 --cambios 300
+"""
+import argparse
+import http.client
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def arrancar_servidor(puerto, directorio, max_flujos):
+    entorno = {**os.environ, 'PYTHONPATH': RAIZ, 'MAPA_MAX_FLUJOS_SSE': str(max_flujos)}
+    servidor = subprocess.Popen(
+        [sys.executable, '-W', 'ignore', '-c', f"import app; app.app.run(port={puerto}, threaded=True)"],
+        cwd=directorio, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            conexion = http.client.HTTPConnection('127.0.0.1', puerto)
+            conexion.request('GET', '/api/capas')
+            conexion.getresponse().read()
+            return servidor
+        except OSError:
+            time.sleep(0.1)
+    servidor.kill()
+    raise RuntimeError('El servidor no arranco')
+
+
+def suscriptor(puerto, recibidos, listos):
+    """Lee el flujo y anota cuando llega cada nombre de elemento agregado o id eliminado."""
+    conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=60)
+    conexion.request('GET', '/api/stream')
+    respuesta = conexion.getresponse()
+    assert respuesta.status == 200, respuesta.status
+    respuesta.readline()
+    respuesta.readline()
+    listos.wait()
+    while True:
+        linea = respuesta.readline()
+        if not linea:
+            return
+        if linea.startswith(b'data: '):
+            datos = json.loads(linea[6:])
+            ahora = time.perf_counter()
+            for elemento in datos.get('elementos', []):
+                recibidos.setdefault(elemento.get('nombre'), ahora)
+            for i in datos.get('elementos_eliminados', []):
+                recibidos.setdefault(f'eliminar-{i}', ahora)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--suscriptores', type=int, default=50)
+    parser.add_argument('--cambios', type=int, default=300)
+    parser.add_argument('--pausa', type=float, default=0.01, help='Segundos entre cambios')
+    args = parser.parse_args()
+
+    puerto = puerto_libre()
+    with tempfile.TemporaryDirectory() as directorio:
+        servidor = arrancar_servidor(puerto, directorio, args.suscriptores)
+        try:
+            recibidos = [dict() for _ in range(args.suscriptores)]
+            listos = threading.Barrier(args.suscriptores + 1)
+            for k in range(args.suscriptores):
+                threading.Thread(target=suscriptor, args=(puerto, recibidos[k], listos), daemon=True).start()
+            listos.wait()
+
+            enviados, ids = {}, []
+            conexion = http.client.HTTPConnection('127.0.0.1', puerto)
+            rng = np.random.default_rng(0)
+            inicio = time.perf_counter()
+            for n in range(args.cambios):
+                if n % 5 == 4 and ids:
+                    i = ids.pop(int(rng.integers(len(ids))))
+                    enviados[f'eliminar-{i}'] = time.perf_counter()
+                    conexion.request('DELETE', f'/api/eliminar-elemento/{i}')
+                    conexion.getresponse().read()
+                else:
+                    nombre = f'T{n}'
+                    enviados[nombre] = time.perf_counter()
+                    cuerpo = {'lat': float(rng.uniform(0, 12)), 'lon': float(rng.uniform(-73, -60)), 'nombre': nombre}
+                    conexion.request('POST', '/api/agregar-torre', json.dumps(cuerpo), {'Content-Type': 'application/json'})
+                    ids.append(json.loads(conexion.getresponse().read())['elemento']['id'])
+                time.sleep(args.pausa)
+            duracion = time.perf_counter() - inicio
+            time.sleep(2)
+        finally:
+            servidor.terminate()
+            servidor.wait()
+
+    latencias = np.array([r[clave] - t for r in recibidos for clave, t in enviados.items() if clave in r]) * 1e3
+    total = args.suscriptores * len(enviados)
+    uso = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(f"{args.suscriptores} suscriptores, {len(enviados)} cambios en {duracion:.1f}s ({len(enviados) / duracion:.0f}/s)")
+    print(f"Entregados {len(latencias)}/{total}")
+    if len(latencias):
+        print(f"Latencia ms: mediana {np.median(latencias):.1f}, p95 {np.percentile(latencias, 95):.1f}, "
+              f"p99 {np.percentile(latencias, 99):.1f}, max {latencias.max():.1f}")
+    print(f"CPU del servidor: {uso.ru_utime + uso.ru_stime:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,475 @@
+import math
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+from almacen import caja_elemento
+from geometria import R_TIERRA
+
+
+class IndiceRejilla:
+    """Indice espacial de rejilla sobre las cajas envolventes de los elementos.
+
+    Cada elemento se registra en las celdas (de `tam_celda` grados) que cubre
+    su caja; los que cubren mas de `max_celdas` celdas (rutas muy largas,
+    circulos enormes) se guardan aparte y se comprueban uno a uno. Se
+    mantiene al dia de forma incremental con `sincronizar()`, pensada para
+    suscribirse al almacen.
+    """
+
+    def __init__(self, tam_celda=0.02, max_celdas=256):
+        self.tam_celda = tam_celda
+        self.max_celdas = max_celdas
+        self._lock = threading.Lock()
+        self._celdas = defaultdict(set)
+        self._cajas = {}
+        self._grandes = set()
+
+    def _rango(self, min_lon, max_lon, min_lat, max_lat):
+        return (math.floor(min_lon / self.tam_celda), math.floor(max_lon / self.tam_celda),
+                math.floor(min_lat / self.tam_celda), math.floor(max_lat / self.tam_celda))
+
+    def _insertar(self, elemento_id, caja):
+        self._cajas[elemento_id] = caja
+        x0, x1, y0, y1 = self._rango(*caja)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > self.max_celdas:
+            self._grandes.add(elemento_id)
+            return
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                self._celdas[(x, y)].add(elemento_id)
+
+    def _quitar(self, elemento_id):
+        caja = self._cajas.pop(elemento_id, None)
+        if caja is None:
+            return
+        if elemento_id in self._grandes:
+            self._grandes.discard(elemento_id)
+            return
+        x0, x1, y0, y1 = self._rango(*caja)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                celda = self._celdas.get((x, y))
+                if celda is not None:
+                    celda.discard(elemento_id)
+                    if not celda:
+                        del self._celdas[(x, y)]
+
+    def reconstruir(self, elementos):
+        with self._lock:
+            self._celdas.clear()
+            self._cajas.clear()
+            self._grandes.clear()
+            for elemento in elementos:
+                caja = caja_elemento(elemento)
+                if caja:
+                    self._insertar(elemento['id'], caja)
+
+    def insertar(self, elemento):
+        """Inserta o reubica un elemento en el indice."""
+        with self._lock:
+            self._quitar(elemento['id'])
+            caja = caja_elemento(elemento)
+            if caja:
+                self._insertar(elemento['id'], caja)
+
+    def quitar(self, elemento_id):
+        with self._lock:
+            self._quitar(elemento_id)
+
+    def consultar(self, min_lon, min_lat, max_lon, max_lat):
+        """Devuelve los ids cuyas cajas intersectan la caja dada."""
+        def intersecta(caja):
+            return caja[0] <= max_lon and caja[1] >= min_lon and caja[2] <= max_lat and caja[3] >= min_lat
+
+        with self._lock:
+            x0, x1, y0, y1 = self._rango(min_lon, max_lon, min_lat, max_lat)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self._celdas):
+                # Consulta mas grande que el propio indice: basta recorrer las cajas
+                return {i for i, caja in self._cajas.items() if intersecta(caja)}
+            candidatos = set(self._grandes)
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    candidatos |= self._celdas.get((x, y), set())
+            return {i for i in candidatos if intersecta(self._cajas[i])}
+
+    def sincronizar(self, op, almacen):
+        """Aplica al indice una operacion notificada por el almacen."""
+        tipo = op['op']
+        if tipo in ('recargar', 'reemplazar'):
+            self.reconstruir(almacen.elementos())
+        elif tipo == 'agregar':
+            self.insertar(op['elemento'])
+        elif tipo == 'actualizar':
+            elemento = almacen.obtener(op['id'])
+            if elemento is not None:
+                self.insertar(elemento)
+        elif tipo == 'eliminar':
+            self.quitar(op['id'])
+        elif tipo == 'lote':
+            for sub in op['operaciones']:
+                self.sincronizar(sub, almacen)
+
+
+def proyectar_mercator(lats, lons):
+    """Proyecta lat/lon a coordenadas Web Mercator normalizadas en [0, 1]."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    seno = np.clip(np.sin(np.radians(lats)), -0.9999, 0.9999)
+    x = (lons + 180.0) / 360.0
+    y = 0.5 - np.log((1 + seno) / (1 - seno)) / (4 * np.pi)
+    return x, y
+
+
+def desproyectar_mercator(x, y):
+    """Inversa de proyectar_mercator: devuelve (lats, lons)."""
+    lons = np.asarray(x, dtype=float) * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float)))))
+    return lats, lons
+
+
+class ClustersJerarquicos:
+    """Agrupacion jerarquica de puntos precalculada por nivel de zoom.
+
+    Para cada zoom (de `zoom_max` hacia `zoom_min`) los grupos del nivel
+    inferior se reparten en una rejilla Web Mercator de `radio_px` pixeles a
+    ese zoom; cada celda ocupada es un grupo con su centroide ponderado y su
+    cantidad de puntos. Por encima de `zoom_max` se devuelven los puntos
+    originales. Todo el calculo es vectorizado con NumPy.
+    """
+
+    def __init__(self, lats, lons, zoom_min=0, zoom_max=16, radio_px=60, tam_tesela=256):
+        self.zoom_min = zoom_min
+        self.zoom_max = zoom_max
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.niveles = {}
+        cx, cy = proyectar_mercator(self.lats, self.lons)
+        cantidad = np.ones(len(cx))
+        representante = np.arange(len(cx))
+        for zoom in range(zoom_max, zoom_min - 1, -1):
+            if len(cx) == 0:
+                self.niveles[zoom] = (self.lats, self.lons, cantidad, representante)
+                continue
+            celda = radio_px / (tam_tesela * 2 ** zoom)
+            columnas = int(math.ceil(1 / celda)) + 1
+            clave = np.floor(cx / celda).astype(np.int64) * columnas + np.floor(cy / celda).astype(np.int64)
+            _, inversa = np.unique(clave, return_inverse=True)
+            total = np.bincount(inversa, weights=cantidad)
+            nx = np.bincount(inversa, weights=cx * cantidad) / total
+            ny = np.bincount(inversa, weights=cy * cantidad) / total
+            nuevo_representante = np.empty(len(total), dtype=np.int64)
+            nuevo_representante[inversa] = representante
+            cx, cy, cantidad, representante = nx, ny, total, nuevo_representante
+            self.niveles[zoom] = (*desproyectar_mercator(cx, cy), cantidad, representante)
+
+    def nivel(self, zoom):
+        """Devuelve (lats, lons, cantidades, representantes) de todos los grupos a ese zoom.
+
+        `representantes` es el indice de un punto original del grupo (el
+        propio punto cuando la cantidad es 1).
+        """
+        zoom = int(zoom)
+        if zoom > self.zoom_max:
+            return self.lats, self.lons, np.ones(len(self.lats)), np.arange(len(self.lats))
+        return self.niveles[max(zoom, self.zoom_min)]
+
+    def consultar(self, min_lon, min_lat, max_lon, max_lat, zoom):
+        """Grupos visibles en la caja a ese zoom, como en `nivel()`."""
+        lats, lons, cantidad, representante = self.nivel(zoom)
+        dentro = (lons >= min_lon) & (lons <= max_lon) & (lats >= min_lat) & (lats <= max_lat)
+        return lats[dentro], lons[dentro], cantidad[dentro], representante[dentro]
+
+    def niveles_compactos(self, umbral=0.9, decimales=6, indices=False):
+        """Exporta los niveles de zoom como listas [[lat, lon, cantidad], ...].
+
+        Solo se incluyen los niveles que agrupan de verdad: a partir del
+        primer zoom con mas de `umbral` grupos por punto se deben mostrar los
+        puntos originales. Con `indices=True` los grupos de un solo punto se
+        exportan como el indice de ese punto en lugar de repetir sus
+        coordenadas. Devuelve (niveles, zoom_puntos).
+        """
+        niveles = {}
+        for zoom in range(self.zoom_min, self.zoom_max + 1):
+            lats, lons, cantidad, representante = self.niveles[zoom]
+            if len(self.lats) and len(lats) > umbral * len(self.lats):
+                return niveles, zoom
+            niveles[zoom] = [int(r) if indices and c == 1 else
+                             [round(float(la), decimales), round(float(lo), decimales), int(c)]
+                             for la, lo, c, r in zip(lats, lons, cantidad, representante)]
+        return niveles, self.zoom_max + 1
+
+
+def a_unitarios(lats, lons):
+    """Vectores unitarios 3D (n, 3) de puntos lat/lon sobre la esfera."""
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def cuerda(metros):
+    """Cuerda en la esfera unidad que corresponde a un arco de `metros` sobre la Tierra."""
+    return 2 * np.sin(np.clip(np.asarray(metros, dtype=float) / R_TIERRA, 0, np.pi) / 2)
+
+
+def arco(cuerdas):
+    """Inversa de cuerda(): metros sobre el circulo maximo (la distancia de haversine)."""
+    return 2 * R_TIERRA * np.arcsin(np.clip(np.asarray(cuerdas, dtype=float) / 2, 0, 1))
+
+
+class ArbolEsferico:
+    """Arbol KD estatico sobre los vectores unitarios 3D de un conjunto de puntos lat/lon.
+
+    La distancia euclidea entre vectores unitarios (la cuerda) crece con la
+    distancia sobre el circulo maximo, asi que un radio en metros se
+    convierte en un radio de cuerda exacto y las distancias devueltas son
+    las de haversine, sin errores cerca de los polos ni del antimeridiano.
+
+    El arbol es implicito: los puntos se reordenan de forma que el nodo j
+    del nivel l cubre las posiciones [j * n >> l, (j + 1) * n >> l) y cada
+    nodo se parte por la mediana de su eje mas largo. Las consultas recorren
+    los niveles para todos los puntos de consulta a la vez, con operaciones
+    vectorizadas sobre los pares (consulta, nodo) que siguen vivos.
+    """
+
+    def __init__(self, lats, lons, tam_hoja=32):
+        xyz = a_unitarios(lats, lons)
+        n = len(xyz)
+        self.n = n
+        self.niveles = int(math.floor(math.log2(n / tam_hoja))) if n >= 2 * tam_hoja else 0
+        orden = np.arange(n)
+        for nivel in range(self.niveles):
+            limites = self._limites(nivel)
+            puntos = xyz[orden]
+            extension = (np.maximum.reduceat(puntos, limites[:-1], axis=0)
+                         - np.minimum.reduceat(puntos, limites[:-1], axis=0))
+            nodo = np.repeat(np.arange(len(limites) - 1), np.diff(limites))
+            clave = puntos[np.arange(n), np.argmax(extension, axis=1)[nodo]]
+            orden = orden[np.lexsort((clave, nodo))]
+        self.orden = orden
+        self.xyz = xyz[orden]
+        self.cajas = []
+        if n:
+            for nivel in range(self.niveles + 1):
+                inicios = self._limites(nivel)[:-1]
+                self.cajas.append((np.minimum.reduceat(self.xyz, inicios, axis=0),
+                                   np.maximum.reduceat(self.xyz, inicios, axis=0)))
+
+    def __len__(self):
+        return self.n
+
+    def _limites(self, nivel):
+        return (np.arange(2 ** nivel + 1, dtype=np.int64) * self.n) >> nivel
+
+    def _hojas(self, consultas, cuerdas):
+        """Pares (consulta, hoja) cuya caja esta a menos de la cuerda de cada consulta."""
+        cons = np.arange(len(consultas))
+        nodos = np.zeros(len(consultas), dtype=np.int64)
+        for nivel, (minimos, maximos) in enumerate(self.cajas):
+            if nivel:
+                cons = np.repeat(cons, 2)
+                nodos = np.repeat(nodos * 2, 2)
+                nodos[1::2] += 1
+            punto = consultas[cons]
+            exceso = np.maximum(minimos[nodos] - punto, 0) + np.maximum(punto - maximos[nodos], 0)
+            vivos = np.einsum('ij,ij->i', exceso, exceso) <= cuerdas[cons] ** 2
+            cons, nodos = cons[vivos], nodos[vivos]
+        return cons, nodos
+
+    def _posiciones(self, hojas):
+        """(puntos por hoja, posiciones en self.xyz de todos los puntos de las hojas)."""
+        limites = self._limites(self.niveles)
+        desde, tam = limites[hojas], limites[hojas + 1] - limites[hojas]
+        return tam, np.repeat(desde - np.cumsum(tam) + tam, tam) + np.arange(tam.sum())
+
+    def consultar_radio(self, lats, lons, radios, tam_lote=8192):
+        """Puntos a `radios` metros o menos de cada consulta.
+
+        `radios` es un escalar o un array por consulta. Devuelve tres arrays
+        paralelos (consulta, punto, distancia en metros); `punto` es la
+        posicion en los lats/lons con que se construyo el arbol. Las
+        consultas se procesan en lotes de `tam_lote` para acotar la memoria.
+        """
+        consultas = a_unitarios(lats, lons)
+        cuerdas = np.broadcast_to(cuerda(radios), (len(consultas),))
+        resultado = ([], [], [])
+        if self.n == 0:
+            return tuple(np.empty(0, dtype=t) for t in (np.int64, np.int64, float))
+        for inicio in range(0, len(consultas), tam_lote):
+            lote, radio_lote = consultas[inicio:inicio + tam_lote], cuerdas[inicio:inicio + tam_lote]
+            cons, hojas = self._hojas(lote, radio_lote)
+            tam, posiciones = self._posiciones(hojas)
+            cons = np.repeat(cons, tam)
+            diferencia = self.xyz[posiciones] - lote[cons]
+            cuerdas2 = np.einsum('ij,ij->i', diferencia, diferencia)
+            dentro = cuerdas2 <= radio_lote[cons] ** 2
+            resultado[0].append(cons[dentro] + inicio)
+            resultado[1].append(self.orden[posiciones[dentro]])
+            resultado[2].append(arco(np.sqrt(cuerdas2[dentro])))
+        return tuple(np.concatenate(r) for r in resultado)
+
+    def cercanos(self, lat, lon, k, radio_max=None, vivos=None):
+        """Los `k` puntos mas cercanos a (lat, lon), a `radio_max` metros o menos si se indica.
+
+        `vivos` (bool por punto, en el orden de construccion) descarta puntos
+        sin reconstruir el arbol. Para una sola consulta basta una pasada
+        vectorizada por las cajas de las hojas: la k-esima distancia dentro
+        del nodo con al menos k puntos vivos que contiene la hoja mas cercana
+        acota la busqueda, y solo se miran las hojas dentro de esa cota.
+        Devuelve (puntos, distancias en metros) de menor a mayor distancia.
+        """
+        if self.n == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        consulta = a_unitarios([lat], [lon])[0]
+        minimos, maximos = self.cajas[-1]
+        exceso = np.maximum(minimos - consulta, 0) + np.maximum(consulta - maximos, 0)
+        cercania = np.einsum('ij,ij->i', exceso, exceso)
+        limite2 = float(cuerda(np.inf if radio_max is None else radio_max)) ** 2
+        nivel = min(self.niveles, int(math.floor(math.log2(max(self.n / k, 1)))))
+        nodo = int(np.argmin(cercania)) >> (self.niveles - nivel)
+        while True:
+            desde, hasta = self._limites(nivel)[nodo:nodo + 2]
+            diferencia = self.xyz[desde:hasta] - consulta
+            if vivos is not None:
+                diferencia = diferencia[vivos[self.orden[desde:hasta]]]
+            if len(diferencia) >= k or nivel == 0:
+                break
+            nivel, nodo = nivel - 1, nodo // 2
+        if len(diferencia) >= k:
+            limite2 = min(limite2, np.partition(np.einsum('ij,ij->i', diferencia, diferencia), k - 1)[k - 1])
+        _, posiciones = self._posiciones(np.flatnonzero(cercania <= limite2))
+        if vivos is not None:
+            posiciones = posiciones[vivos[self.orden[posiciones]]]
+        diferencia = self.xyz[posiciones] - consulta
+        cuerdas2 = np.einsum('ij,ij->i', diferencia, diferencia)
+        dentro = cuerdas2 <= limite2
+        posiciones, cuerdas2 = posiciones[dentro], cuerdas2[dentro]
+        if len(posiciones) > k:
+            primeros = np.argpartition(cuerdas2, k - 1)[:k]
+            posiciones, cuerdas2 = posiciones[primeros], cuerdas2[primeros]
+        orden = np.argsort(cuerdas2, kind='stable')
+        return self.orden[posiciones[orden]], arco(np.sqrt(cuerdas2[orden]))
+
+
+class IndiceTorres:
+    """Indice de las torres del almacen para buscar las mas cercanas a un punto.
+
+    Las torres estan en un ArbolEsferico mas un bufer de cambios: las
+    torres nuevas o movidas van al bufer, que se recorre por fuerza bruta,
+    y las borradas o movidas se marcan como muertas en el arbol. Cuando el
+    bufer y las bajas pasan de `fraccion` del arbol (o de `minimo`), la
+    siguiente consulta reconstruye el arbol. Se mantiene al dia de forma
+    incremental con `sincronizar()`, como IndiceRejilla.
+    """
+
+    def __init__(self, fraccion=0.01, minimo=256):
+        self.fraccion = fraccion
+        self.minimo = minimo
+        self._lock = threading.Lock()
+        self._construir(np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+
+    def _construir(self, ids, lats, lons):
+        self._arbol = ArbolEsferico(lats, lons)
+        self._ids, self._lats, self._lons = ids, lats, lons
+        self._vivos = np.ones(len(ids), dtype=bool)
+        self._posiciones = dict(zip(ids.tolist(), range(len(ids))))
+        self._muertos = 0
+        self._pendientes = {}
+        self._bufer = None
+
+    @staticmethod
+    def _coordenadas(elemento):
+        if elemento.get('tipo') != 'torre':
+            return None
+        try:
+            return float(elemento['lat']), float(elemento['lon'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _quitar(self, elemento_id):
+        if self._pendientes.pop(elemento_id, None) is not None:
+            self._bufer = None
+        posicion = self._posiciones.pop(elemento_id, None)
+        if posicion is not None:
+            self._vivos[posicion] = False
+            self._muertos += 1
+
+    def _compactar(self):
+        """Reconstruye el arbol si el bufer y las bajas ya son demasiados."""
+        if len(self._pendientes) + self._muertos <= max(self.minimo, self.fraccion * len(self._ids)):
+            return
+        vivos = self._vivos
+        pendientes = np.array(list(self._pendientes.values()), dtype=float).reshape(-1, 2)
+        self._construir(np.concatenate([self._ids[vivos], np.fromiter(self._pendientes, dtype=np.int64)]),
+                        np.concatenate([self._lats[vivos], pendientes[:, 0]]),
+                        np.concatenate([self._lons[vivos], pendientes[:, 1]]))
+
+    def reconstruir(self, elementos):
+        ids, lats, lons = [], [], []
+        for elemento in elementos:
+            coordenadas = self._coordenadas(elemento)
+            if coordenadas:
+                ids.append(elemento['id'])
+                lats.append(coordenadas[0])
+                lons.append(coordenadas[1])
+        with self._lock:
+            self._construir(np.array(ids, dtype=np.int64), np.array(lats), np.array(lons))
+
+    def insertar(self, elemento):
+        """Inserta, mueve o (si ya no es una torre con coordenadas) quita un elemento."""
+        coordenadas = self._coordenadas(elemento)
+        with self._lock:
+            posicion = self._posiciones.get(elemento['id'])
+            if posicion is not None and coordenadas == (self._lats[posicion], self._lons[posicion]):
+                # Cambios que no mueven la torre (nombre, radio, capa...)
+                return
+            self._quitar(elemento['id'])
+            if coordenadas:
+                self._pendientes[elemento['id']] = coordenadas
+                self._bufer = None
+
+    def quitar(self, elemento_id):
+        with self._lock:
+            self._quitar(elemento_id)
+
+    def cercanas(self, lat, lon, k, radio_max=None):
+        """Ids de las `k` torres mas cercanas y sus distancias en metros, de menor a mayor."""
+        with self._lock:
+            self._compactar()
+            puntos, distancias = self._arbol.cercanos(lat, lon, k, radio_max, self._vivos)
+            ids = self._ids[puntos]
+            if self._pendientes:
+                if self._bufer is None:
+                    coordenadas = np.array(list(self._pendientes.values()), dtype=float)
+                    self._bufer = (np.fromiter(self._pendientes, dtype=np.int64),
+                                   a_unitarios(coordenadas[:, 0], coordenadas[:, 1]))
+                ids_bufer, xyz = self._bufer
+                diferencia = xyz - a_unitarios([lat], [lon])
+                distancias_bufer = arco(np.sqrt(np.einsum('ij,ij->i', diferencia, diferencia)))
+                if radio_max is not None:
+                    cerca = distancias_bufer <= radio_max
+                    ids_bufer, distancias_bufer = ids_bufer[cerca], distancias_bufer[cerca]
+                ids = np.concatenate([ids, ids_bufer])
+                distancias = np.concatenate([distancias, distancias_bufer])
+                orden = np.argsort(distancias, kind='stable')[:k]
+                ids, distancias = ids[orden], distancias[orden]
+            return ids, distancias
+
+    def sincronizar(self, op, almacen):
+        """Aplica al indice una operacion notificada por el almacen."""
+        tipo = op['op']
+        if tipo in ('recargar', 'reemplazar'):
+            self.reconstruir(almacen.elementos())
+        elif tipo == 'agregar':
+            self.insertar(op['elemento'])
+        elif tipo == 'actualizar':
+            elemento = almacen.obtener(op['id'])
+            if elemento is not None:
+                self.insertar(elemento)
+        elif tipo == 'eliminar':
+            self.quitar(op['id'])
+        elif tipo == 'lote':
+            for sub in op['operaciones']:
+                self.sincronizar(sub, almacen)
@@ -0,0 +1,182 @@
+import math
+
+import numpy as np
+
+
+R_TIERRA = 6371000.0
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+# Orden de dibujo de los sectores (colores azul, verde y rojo en el mapa)
+AZIMUTS_SECTORES = (180.0, 300.0, 60.0)
+ANCHO_SECTOR = 120.0
+CARDINALES = (('N', 0.0), ('E', 90.0), ('S', 180.0), ('O', 270.0))
+FACTOR_CARDINALES = 0.9
+
+
+def destino(lats, lons, distancias, rumbos):
+    """Punto a `distancias` metros de (lat, lon) con rumbo `rumbos` (grados) sobre la esfera.
+
+    Es la misma formula que calcularPuntoFinal en el navegador. Todos los
+    argumentos se combinan con broadcasting de NumPy; devuelve (lats, lons).
+    """
+    lat1 = np.radians(np.asarray(lats, dtype=float))
+    lon1 = np.radians(np.asarray(lons, dtype=float))
+    delta = np.asarray(distancias, dtype=float) / R_TIERRA
+    theta = np.radians(np.asarray(rumbos, dtype=float))
+    sen_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sen_d, cos_d = np.sin(delta), np.cos(delta)
+    lat2 = np.arcsin(sen_lat1 * cos_d + cos_lat1 * sen_d * np.cos(theta))
+    lon2 = lon1 + np.arctan2(np.sin(theta) * sen_d * cos_lat1, cos_d - sen_lat1 * np.sin(lat2))
+    return np.degrees(lat2), np.degrees(lon2)
+
+
+def vertices_circulo(radios, tolerancia=2.0, minimo=16, maximo=128):
+    """Vertices necesarios para que el poligono no se separe del circulo mas de `tolerancia` metros.
+
+    Se redondea a multiplos de 4 para que los puntos cardinales sean vertices.
+    """
+    radios = np.maximum(np.asarray(radios, dtype=float), tolerancia * 2)
+    vertices = np.ceil(math.pi / np.arccos(1 - tolerancia / radios))
+    vertices = np.ceil(vertices / 4) * 4
+    return np.clip(vertices, minimo, maximo).astype(int)
+
+
+def _por_grupos(claves):
+    """Itera (clave, indices) agrupando las posiciones con la misma clave."""
+    claves = np.asarray(claves)
+    for clave in np.unique(claves):
+        yield int(clave), np.flatnonzero(claves == clave)
+
+
+def circulos(lats, lons, radios, vertices=None):
+    """Anillos cerrados [[lat, lon], ...] de los circulos de cobertura, uno por centro.
+
+    Los centros con el mismo numero de vertices se calculan juntos en una
+    sola llamada vectorizada. Devuelve una lista de arrays (n + 1, 2).
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    radios = np.broadcast_to(np.asarray(radios, dtype=float), lats.shape)
+    vertices = vertices_circulo(radios) if vertices is None else np.broadcast_to(vertices, lats.shape)
+    anillos = [None] * len(lats)
+    for n, indices in _por_grupos(vertices):
+        rumbos = np.arange(n + 1) * (360.0 / n)
+        la, lo = destino(lats[indices, None], lons[indices, None], radios[indices, None], rumbos)
+        la[:, -1], lo[:, -1] = la[:, 0], lo[:, 0]
+        for i, anillo in zip(indices, np.stack([la, lo], axis=-1)):
+            anillos[i] = anillo
+    return anillos
+
+
+def _azimuts(n, azimuts):
+    if azimuts is None:
+        return np.tile(AZIMUTS_SECTORES, (n, 1))
+    return np.asarray(azimuts, dtype=float).reshape(n, -1)
+
+
+def ejes_sectores(lats, lons, radios, azimuts=None):
+    """Extremos de los ejes de sector: array (n, s, 2) con [lat, lon] (NaN donde no hay sector).
+
+    `azimuts` es un array (n, s) en grados, con NaN para completar torres con
+    menos sectores; por defecto AZIMUTS_SECTORES para todas.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    azimuts = _azimuts(len(lats), azimuts)
+    radios = np.asarray(radios, dtype=float).reshape(-1, 1)
+    la, lo = destino(lats[:, None], lons[:, None], radios, azimuts)
+    return np.stack([la, lo], axis=-1)
+
+
+def poligonos_sectores(lats, lons, radios, azimuts=None, anchos=ANCHO_SECTOR):
+    """Cuñas de cobertura de cada sector: lista por torre de arrays [[lat, lon], ...] cerrados.
+
+    Cada cuña va del centro al arco entre azimut - ancho/2 y azimut + ancho/2
+    y vuelve al centro; el arco usa los vertices proporcionales de
+    vertices_circulo. Las cuñas con el mismo numero de vertices se calculan
+    juntas.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    azimuts = _azimuts(len(lats), azimuts)
+    forma = azimuts.shape
+    radios = np.broadcast_to(np.asarray(radios, dtype=float).reshape(-1, 1), forma).ravel()
+    anchos = np.asarray(anchos, dtype=float)
+    anchos = np.broadcast_to(anchos[:, None] if anchos.ndim == 1 else anchos, forma).ravel()
+    centros_lat = np.repeat(lats, forma[1])
+    centros_lon = np.repeat(lons, forma[1])
+    azimuts = azimuts.ravel()
+    validos = np.flatnonzero(~np.isnan(azimuts))
+    tramos = np.maximum(2, np.ceil(vertices_circulo(radios[validos]) * anchos[validos] / 360.0)).astype(int)
+    poligonos = [[] for _ in range(len(lats))]
+    cunas = {}
+    for n, grupo in _por_grupos(tramos):
+        indices = validos[grupo]
+        rumbos = (azimuts[indices, None] - anchos[indices, None] / 2) + anchos[indices, None] * np.arange(n + 1) / n
+        la, lo = destino(centros_lat[indices, None], centros_lon[indices, None], radios[indices, None], rumbos)
+        centros = np.stack([centros_lat[indices], centros_lon[indices]], axis=-1)[:, None, :]
+        for i, cuna in zip(indices, np.concatenate([centros, np.stack([la, lo], axis=-1), centros], axis=1)):
+            cunas[i] = cuna
+    for i in validos:
+        poligonos[i // forma[1]].append(cunas[i])
+    return poligonos
+
+
+def puntos_cardinales(lats, lons, radios, factor=FACTOR_CARDINALES):
+    """Posiciones de las etiquetas N/E/S/O a `factor` * radio: array (n, 4, 2) con [lat, lon]."""
+    rumbos = [rumbo for _, rumbo in CARDINALES]
+    return ejes_sectores(lats, lons, np.asarray(radios, dtype=float) * factor, np.tile(rumbos, (len(lats), 1)))
+
+
+def haversine(lats1, lons1, lats2, lons2):
+    """Distancia de circulo maximo en metros entre (lats1, lons1) y (lats2, lons2).
+
+    Misma formula y radio que calcularDistanciaHaversine en el navegador;
+    los argumentos se combinan con broadcasting de NumPy.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lats1, lons1, lats2, lons2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * R_TIERRA * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def vincenty(lats1, lons1, lats2, lons2, iteraciones=200, tolerancia=1e-12):
+    """Distancia geodesica en metros sobre el elipsoide WGS84 (formula inversa de Vincenty).
+
+    Precision submilimetrica, un orden de magnitud mas lenta que haversine. Todos
+    los pares iteran a la vez; los casi antipodas en los que la iteracion
+    no converge se devuelven con la distancia de haversine.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *(np.radians(np.asarray(v, dtype=float)) for v in (lats1, lons1, lats2, lons2)))
+    b = WGS84_A * (1 - WGS84_F)
+    u1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sen_u1, cos_u1, sen_u2, cos_u2 = np.sin(u1), np.cos(u1), np.sin(u2), np.cos(u2)
+    diferencia_lon = lon2 - lon1
+    lam = diferencia_lon
+    for _ in range(iteraciones):
+        sen_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sen_sigma = np.hypot(cos_u2 * sen_lam, cos_u1 * sen_u2 - sen_u1 * cos_u2 * cos_lam)
+        cos_sigma = sen_u1 * sen_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sen_sigma, cos_sigma)
+        # Puntos coincidentes (sen_sigma = 0) y lineas ecuatoriales (cos2_alfa = 0)
+        sen_alfa = np.divide(cos_u1 * cos_u2 * sen_lam, sen_sigma, out=np.zeros_like(sigma), where=sen_sigma != 0)
+        cos2_alfa = 1 - sen_alfa ** 2
+        cos_2sm = cos_sigma - np.divide(2 * sen_u1 * sen_u2, cos2_alfa, out=np.zeros_like(sigma),
+                                        where=cos2_alfa != 0)
+        c = WGS84_F / 16 * cos2_alfa * (4 + WGS84_F * (4 - 3 * cos2_alfa))
+        previa = lam
+        lam = diferencia_lon + (1 - c) * WGS84_F * sen_alfa * (
+            sigma + c * sen_sigma * (cos_2sm + c * cos_sigma * (2 * cos_2sm ** 2 - 1)))
+        convergio = np.abs(lam - previa) <= tolerancia
+        if convergio.all():
+            break
+    u_2 = cos2_alfa * (WGS84_A ** 2 - b ** 2) / b ** 2
+    a_ = 1 + u_2 / 16384 * (4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
+    b_ = u_2 / 1024 * (256 + u_2 * (-128 + u_2 * (74 - 47 * u_2)))
+    delta_sigma = b_ * sen_sigma * (cos_2sm + b_ / 4 * (
+        cos_sigma * (2 * cos_2sm ** 2 - 1) - b_ / 6 * cos_2sm * (4 * sen_sigma ** 2 - 3) * (4 * cos_2sm ** 2 - 3)))
+    distancias = b * a_ * (sigma - delta_sigma)
+    if convergio.all():
+        return distancias
+    return np.where(convergio, distancias, haversine(lats1, lons1, lats2, lons2))
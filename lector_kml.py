@@ -0,0 +1,205 @@
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+from contextlib import contextmanager
+
+
+GEOMETRIAS = ('Point', 'LineString', 'LinearRing', 'Polygon')
+CONTENEDORES = ('kml', 'Document', 'Folder')
+
+
+_NOMBRES = {}
+
+
+def _nombre(elem):
+    """Nombre local de la etiqueta, sin el espacio de nombres."""
+    try:
+        return _NOMBRES[elem.tag]
+    except KeyError:
+        return _NOMBRES.setdefault(elem.tag, elem.tag.rsplit('}', 1)[-1])
+
+
+def _hijo(elem, nombre):
+    return next((h for h in elem if _nombre(h) == nombre), None)
+
+
+def _texto(elem, nombre):
+    hijo = _hijo(elem, nombre)
+    return (hijo.text or '').strip() if hijo is not None else ''
+
+
+def _href_icono(estilo):
+    """href del Icon de un <Style> (dentro de IconStyle), o None."""
+    icon_style = _hijo(estilo, 'IconStyle')
+    icono = _hijo(icon_style, 'Icon') if icon_style is not None else None
+    if icono is None:
+        return None
+    return _texto(icono, 'href') or None
+
+
+def _id_estilo(style_url):
+    """'#id' o 'archivo.kml#id' -> 'id'; las URLs sin fragmento no se resuelven."""
+    return style_url.rsplit('#', 1)[1] if '#' in style_url else None
+
+
+def parsear_coordenadas(texto):
+    """Convierte el texto de <coordinates> ('lon,lat[,alt] ...') en [(lat, lon), ...]."""
+    tuplas = (texto or '').split()
+    if not tuplas:
+        return []
+    # Caso comun: todas las tuplas con la misma dimension y numeros validos
+    dimension = tuplas[0].count(',') + 1
+    numeros = texto.replace(',', ' ').split()
+    if dimension >= 2 and len(numeros) == dimension * len(tuplas):
+        try:
+            valores = list(map(float, numeros))
+            return list(zip(valores[1::dimension], valores[0::dimension]))
+        except ValueError:
+            pass
+    coords = []
+    for tupla in (texto or '').split():
+        partes = tupla.split(',')
+        if len(partes) >= 2:
+            try:
+                coords.append((float(partes[1]), float(partes[0])))
+            except ValueError:
+                pass
+    return coords
+
+
+@contextmanager
+def abrir_kml(archivo):
+    """Abre un .kml, o el primer .kml dentro de un .kmz, como flujo binario sin leerlo entero."""
+    extension = os.path.splitext(archivo)[1].lower()
+    if extension == '.kmz':
+        with zipfile.ZipFile(archivo, 'r') as z:
+            nombre = next((n for n in z.namelist() if n.endswith('.kml')), None)
+            if nombre is None:
+                raise ValueError("No se encontro archivo KML dentro del KMZ.")
+            with z.open(nombre) as fuente:
+                yield fuente
+    elif extension == '.kml':
+        with open(archivo, 'rb') as fuente:
+            yield fuente
+    else:
+        raise ValueError("Extension no soportada. Use .kml o .kmz")
+
+
+class LectorKML:
+    """Lector incremental de KML basado en iterparse.
+
+    Al iterar produce un placemark por cada geometria (Point, LineString,
+    LinearRing o Polygon, tambien dentro de MultiGeometry) en cuanto se
+    cierra su <Placemark>, y lo descarta del arbol para que la memoria no
+    crezca con el tamano del documento. En la misma pasada se recogen los
+    <Style> con icono y los <StyleMap> (par 'normal'), que quedan completos
+    en `estilos` y `style_maps` al terminar la iteracion.
+
+    Cada placemark es un dict con 'tipo' ('punto', 'linea' o 'poligono'),
+    'lat'/'lon' o 'coords' [(lat, lon), ...], 'nombre', 'desc', 'style_url',
+    'carpeta' (ruta de Folders separada por '/') y, si aplica, 'icono_href'
+    (estilo en linea) y 'huecos' (innerBoundaryIs de un poligono).
+    """
+
+    def __init__(self, fuente):
+        self.fuente = fuente
+        self.estilos = {}
+        self._normales = {}
+        self._iconos_mapa = {}
+
+    @property
+    def style_maps(self):
+        """{id_stylemap: href} resolviendo el estilo 'normal' de cada StyleMap."""
+        mapas = {m: self.estilos[s] for m, s in self._normales.items() if s in self.estilos}
+        mapas.update(self._iconos_mapa)
+        return mapas
+
+    def __iter__(self):
+        pila = []
+        carpetas = []
+        for evento, elem in ET.iterparse(self.fuente, events=('start', 'end')):
+            if evento == 'start':
+                nombre = _nombre(elem)
+                pila.append((elem, nombre))
+                if nombre == 'Folder':
+                    carpetas.append('')
+                continue
+            _, nombre = pila.pop()
+            if not pila or pila[-1][1] not in CONTENEDORES:
+                continue
+            padre, nombre_padre = pila[-1]
+            if nombre == 'Placemark':
+                yield from self._placemarks(elem, '/'.join(c for c in carpetas if c))
+            elif nombre == 'Style':
+                self._registrar_estilo(elem)
+            elif nombre == 'StyleMap':
+                self._registrar_style_map(elem)
+            elif nombre == 'name' and nombre_padre == 'Folder':
+                carpetas[-1] = (elem.text or '').strip()
+            elif nombre == 'Folder':
+                carpetas.pop()
+            # Todo lo ya procesado se suelta del contenedor
+            padre.remove(elem)
+
+    def _registrar_estilo(self, estilo):
+        href = _href_icono(estilo)
+        if estilo.get('id') and href:
+            self.estilos[estilo.get('id')] = href
+
+    def _registrar_style_map(self, style_map):
+        map_id = style_map.get('id')
+        if not map_id:
+            return
+        for par in style_map:
+            if _nombre(par) != 'Pair' or _texto(par, 'key') != 'normal':
+                continue
+            style_url = _id_estilo(_texto(par, 'styleUrl'))
+            estilo = _hijo(par, 'Style')
+            if style_url:
+                self._normales[map_id] = style_url
+            elif estilo is not None and _href_icono(estilo):
+                self._iconos_mapa[map_id] = _href_icono(estilo)
+
+    def _geometrias(self, elem):
+        for hijo in elem:
+            nombre = _nombre(hijo)
+            if nombre in GEOMETRIAS:
+                yield nombre, hijo
+            elif nombre == 'MultiGeometry':
+                yield from self._geometrias(hijo)
+
+    def _placemarks(self, placemark, carpeta):
+        base = {'nombre': '', 'desc': '', 'style_url': None, 'carpeta': carpeta}
+        for hijo in placemark:
+            nombre = _nombre(hijo)
+            if nombre == 'name':
+                base['nombre'] = (hijo.text or '').strip()
+            elif nombre == 'description':
+                base['desc'] = (hijo.text or '').strip()
+            elif nombre == 'styleUrl':
+                base['style_url'] = _id_estilo((hijo.text or '').strip())
+            elif nombre == 'Style' and _href_icono(hijo):
+                base['icono_href'] = _href_icono(hijo)
+        for tipo, geometria in self._geometrias(placemark):
+            if tipo == 'Polygon':
+                exterior = _hijo(geometria, 'outerBoundaryIs')
+                anillo = _hijo(exterior, 'LinearRing') if exterior is not None else None
+                coords = parsear_coordenadas(_texto(anillo, 'coordinates')) if anillo is not None else []
+                if coords:
+                    huecos = []
+                    for interior in geometria:
+                        if _nombre(interior) == 'innerBoundaryIs':
+                            for anillo in interior:
+                                if _nombre(anillo) == 'LinearRing':
+                                    huecos.append(parsear_coordenadas(_texto(anillo, 'coordinates')))
+                    yield {**base, 'tipo': 'poligono', 'coords': coords, 'huecos': huecos}
+                continue
+            coords = parsear_coordenadas(_texto(geometria, 'coordinates'))
+            if not coords:
+                continue
+            if tipo == 'Point' or len(coords) == 1:
+                yield {**base, 'tipo': 'punto', 'lat': coords[0][0], 'lon': coords[0][1]}
+            elif tipo == 'LinearRing':
+                yield {**base, 'tipo': 'poligono', 'coords': coords, 'huecos': []}
+            else:
+                yield {**base, 'tipo': 'linea', 'coords': coords}
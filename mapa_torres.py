@@ -1,17 +1,39 @@
 import pandas as pd
+import numpy as np
 import folium
-from folium.plugins import MarkerCluster
-from folium.features import CustomIcon
+import openpyxl
 from branca.element import Element
 import argparse
+import csv
 import sys
 import json
 import os
 import zipfile
 import base64
-from fastkml import kml
+import hashlib
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from almacen import (guardar_icono, buscar_icono, crear_almacen, reemplazar_instantanea,
+                     PREFIJO_ICONO, ARCHIVO_ELEMENTOS)
+from espacial import ClustersJerarquicos, ArbolEsferico
+from analisis import solapes_torres, cobertura_puntos, escribir_excel, TrayectoriasCDR
+from lector_kml import LectorKML, abrir_kml
+import geometria
 
 NOMBRE_HOJA = "FTD"
+TAM_BLOQUE = 200000
+DIRECTORIO_CACHE = "cache_importaciones"
+# Incrementar cuando cambie el resultado de importar_kml_kmz para invalidar la cache
+VERSION_CONVERSOR = 1
+COLORES_CAPAS = ['#3498db', '#e74c3c', '#2ecc71', '#f39c12', '#9b59b6', '#1abc9c', '#e67e22', '#34495e']
+# Nombres de columna que se reconocen en la tabla de torres y en los CDR, por orden de preferencia
+COLUMNAS_ID_TORRE = ('celda', 'cell', 'cgi', 'id')
+COLUMNAS_CDR = {
+    'abonado': ('abonado', 'msisdn', 'imsi', 'numero', 'telefono', 'linea'),
+    'celda': ('celda', 'cell', 'cgi', 'ci'),
+    'tiempo': ('fecha_hora', 'fecha', 'timestamp', 'tiempo', 'hora', 'time', 'date'),
+}
 ICONO_TORRE_SVG = """<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 64 64" width="40" height="40">
   <rect x="28" y="10" width="8" height="50" fill="#8B0000"/>
   <polygon points="32,0 20,15 44,15" fill="#8B0000"/>
@@ -33,10 +55,47 @@ def limpiar_coordenada(coord_str):
     resultado = partes[0].replace('.', '') + '.' + partes[1] if len(partes) == 2 else s
     return f"-{resultado}" if negativo else resultado
 
+def limpiar_coordenadas(serie):
+    """Version vectorizada de limpiar_coordenada para una Serie completa.
+
+    Aplica las mismas reglas con operaciones de cadena de pandas: si hay
+    punto, los '-' iniciales se reducen a uno y se eliminan todos los puntos
+    salvo el ultimo (separadores de miles).
+    """
+    nulos = serie.isna()
+    s = serie.astype(str).str.strip().str.replace(' ', '', regex=False)
+    con_punto = s.str.contains('.', regex=False)
+    corregida = (s.str.replace(r'^-+', '-', regex=True)
+                  .str.replace(r'\.(?=[^.]*\.)', '', regex=True))
+    resultado = s.where(~con_punto, corregida).astype(object)
+    resultado[nulos] = None
+    return resultado
+
+def coordenadas_numericas(serie):
+    """Convierte una columna de coordenadas a un array float (NaN si no es valida).
+
+    Equivale a pd.to_numeric(serie.apply(limpiar_coordenada), errors='coerce'),
+    pero solo limpia como texto los valores que no se leen directamente como
+    numero, y cada valor distinto una sola vez.
+    """
+    if serie.dtype == object:
+        # True/False se leerian como 1/0; limpiar_coordenada los descarta como texto
+        serie = serie.mask(serie.map(type).isin((bool, np.bool_)), 'nan')
+    elif serie.dtype == bool:
+        serie = serie.astype(str)
+    valores = pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float, copy=True)
+    pendientes = np.isnan(valores) & serie.notna().to_numpy()
+    if pendientes.any():
+        codigos, unicos = pd.factorize(serie[pendientes])
+        limpios = pd.to_numeric(limpiar_coordenadas(pd.Series(unicos, dtype=object)),
+                                errors='coerce').to_numpy(dtype=float)
+        valores[pendientes] = limpios[codigos]
+    return valores
+
 def encontrar_columnas_coordenadas(df):
     col_map = {col.lower(): col for col in df.columns}
-    lat_col = next((v for k, v in col_map.items() if 'latitud' in k), None)
-    lon_col = next((v for k, v in col_map.items() if 'longitud' in k), None)
+    lat_col = next((v for k, v in col_map.items() if 'latitud' in k), col_map.get('lat'))
+    lon_col = next((v for k, v in col_map.items() if 'longitud' in k), col_map.get('lon', col_map.get('lng')))
     return (lat_col, lon_col) if lat_col and lon_col else (None, None)
 
 def crear_icono_torre():
@@ -59,7 +118,21 @@ def guardar_mapa(m, guardar_como, prefijo):
     print("-" * 50)
     return archivo
 
-def crear_html_control_y_scripts(radio_inicial, torres_data):
+def crear_html_control_y_scripts(radio_inicial, capa_torres, datos_torres, archivo_datos=None):
+    """Control de radio y scripts del mapa de torres.
+
+    `datos_torres` ({'torres': [lat0, lon0, lat1, lon1, ...], 'clusters': ...,
+    'zoomPuntos': ...}) se incrusta en la pagina, o se carga de `archivo_datos`
+    si se indica. Torres y sectores se dibujan solo para la vista actual, en
+    canvas cuando son muchos.
+    """
+    if archivo_datos:
+        carga = f"fetch({json.dumps(archivo_datos)}).then(function(r) {{ return r.json(); }}).then(iniciarTorres);"
+    else:
+        carga = f"iniciarTorres({json.dumps(datos_torres, separators=(',', ':'))});"
+    # Los sectores dependen del radio elegido en la pagina; solo sus constantes vienen de geometria
+    angulos = json.dumps(list(geometria.AZIMUTS_SECTORES))
+    cardinales = json.dumps(dict(geometria.CARDINALES))
     return f'''<div id="control-radio" style="position:fixed;top:10px;left:50%;transform:translateX(-50%);z-index:1000;background:#2c3e50;color:white;padding:10px 20px;border-radius:8px;box-shadow:0 2px 6px rgba(0,0,0,0.3);display:flex;align-items:center;gap:15px;font-family:Arial,sans-serif;">
     <h3 style="margin:0;font-size:1.1em;">Mapa de Torres Telefonicas</h3>
     <label style="font-size:0.9em;">Radio (metros):</label>
@@ -67,14 +140,53 @@ def crear_html_control_y_scripts(radio_inicial, torres_data):
     <button onclick="actualizarRadio()" style="background:#3498db;color:white;border:none;padding:8px 15px;border-radius:4px;cursor:pointer;">Actualizar</button>
 </div>
 <script>
-var torresData = {json.dumps(torres_data)};
-var sectoresLayer = null, mapInstance = null;
+var torresData = [], clustersTorres = {{}}, zoomPuntosTorres = 0, radioSectores = {radio_inicial};
+var MAX_ICONOS_TORRES = 500, MAX_SECTORES = 300, MAX_CARDINALES = 50;
+var sectoresLayer = null, mapInstance = null, iconoTorre = null, rendererTorres = null;
 document.addEventListener('DOMContentLoaded', function() {{
     setTimeout(function() {{
         for (var key in window) if (window[key] instanceof L.Map) {{ mapInstance = window[key]; break; }}
-        if (mapInstance) {{ sectoresLayer = L.layerGroup().addTo(mapInstance); dibujarSectores({radio_inicial}); }}
+        if (mapInstance) {{ {carga} }}
     }}, 500);
 }});
+function iniciarTorres(datos) {{
+    torresData = datos.torres; clustersTorres = datos.clusters; zoomPuntosTorres = datos.zoomPuntos;
+    rendererTorres = L.canvas({{padding: 0.2}});
+    sectoresLayer = L.layerGroup().addTo(mapInstance);
+    iconoTorre = L.icon({{iconUrl: '{crear_icono_torre()}', iconSize: [40, 40], iconAnchor: [20, 40]}});
+    mapInstance.on('moveend', dibujarTorres); dibujarTorres();
+}}
+function torresVisibles(limites) {{
+    var visibles = [];
+    for (var i = 0; i < torresData.length; i += 2) if (limites.contains([torresData[i], torresData[i + 1]])) visibles.push(i / 2);
+    return visibles;
+}}
+function marcadorTorre(lat, lon, conIcono) {{
+    var m = conIcono ? L.marker([lat, lon], {{icon: iconoTorre}})
+        : L.circleMarker([lat, lon], {{renderer: rendererTorres, radius: 4, color: '#8B0000', weight: 1, fillOpacity: 0.8}});
+    return m.bindTooltip('Lat: ' + lat.toFixed(4) + ', Lon: ' + lon.toFixed(4));
+}}
+function dibujarTorres() {{
+    {capa_torres}.clearLayers();
+    var zoom = mapInstance.getZoom(), limites = mapInstance.getBounds().pad(0.2);
+    if (zoom >= zoomPuntosTorres) {{
+        var visibles = torresVisibles(limites), conIcono = visibles.length <= MAX_ICONOS_TORRES;
+        visibles.forEach(function(i) {{ marcadorTorre(torresData[2 * i], torresData[2 * i + 1], conIcono).addTo({capa_torres}); }});
+    }} else {{
+        (clustersTorres[zoom] || []).forEach(function(g) {{
+            if (typeof g === 'number') g = [torresData[2 * g], torresData[2 * g + 1], 1];
+            if (!limites.contains([g[0], g[1]])) return;
+            if (g[2] > 1) {{
+                var tam = g[2] < 100 ? 34 : (g[2] < 1000 ? 42 : 50);
+                L.marker([g[0], g[1]], {{icon: L.divIcon({{className: 'cluster-torres', html: '<div style="width:' + tam + 'px;height:' + tam + 'px;line-height:' + tam + 'px;border-radius:50%;background:rgba(139,0,0,0.75);border:3px solid rgba(255,255,255,0.8);color:white;font-weight:bold;text-align:center;font-family:Arial,sans-serif;">' + g[2] + '</div>', iconSize: [tam, tam], iconAnchor: [tam / 2, tam / 2]}})}})
+                    .on('click', function() {{ mapInstance.setView([g[0], g[1]], zoom + 2); }}).addTo({capa_torres});
+            }} else {{
+                marcadorTorre(g[0], g[1], true).addTo({capa_torres});
+            }}
+        }});
+    }}
+    dibujarSectores();
+}}
 function calcularPuntoFinal(lat, lon, distKm, angulo) {{
     var R = 6371, distRad = distKm / R, brngRad = angulo * Math.PI / 180;
     var lat1Rad = lat * Math.PI / 180, lon1Rad = lon * Math.PI / 180;
@@ -84,17 +196,23 @@ function calcularPuntoFinal(lat, lon, distKm, angulo) {{
 }}
 function dibujarSectores(radioMetros) {{
     if (!sectoresLayer) return;
+    if (radioMetros) radioSectores = radioMetros;
     sectoresLayer.clearLayers();
-    var angulos = [180, 300, 60], colores = ['blue', 'green', 'red'], cardinales = {{'N': 0, 'E': 90, 'S': 180, 'O': 270}};
-    torresData.forEach(function(torre) {{
-        L.circle([torre.lat, torre.lon], {{radius: radioMetros, color: '#FFFF00', fill: true, fillOpacity: 0.15, weight: 1}}).addTo(sectoresLayer);
-        angulos.forEach(function(angulo, i) {{
-            var pf = calcularPuntoFinal(torre.lat, torre.lon, radioMetros / 1000, angulo);
-            L.polyline([[torre.lat, torre.lon], pf], {{color: colores[i], weight: 2, opacity: 0.8, dashArray: '5, 5'}}).addTo(sectoresLayer);
+    // Los sectores solo se dibujan para las torres en pantalla y si no son demasiadas
+    var visibles = torresVisibles(mapInstance.getBounds().pad(0.2));
+    if (visibles.length > MAX_SECTORES) return;
+    var angulos = {angulos}, colores = ['blue', 'green', 'red'], cardinales = {cardinales};
+    visibles.forEach(function(i) {{
+        var lat = torresData[2 * i], lon = torresData[2 * i + 1];
+        L.circle([lat, lon], {{renderer: rendererTorres, radius: radioSectores, color: '#FFFF00', fill: true, fillOpacity: 0.15, weight: 1}}).addTo(sectoresLayer);
+        angulos.forEach(function(angulo, j) {{
+            var pf = calcularPuntoFinal(lat, lon, radioSectores / 1000, angulo);
+            L.polyline([[lat, lon], pf], {{renderer: rendererTorres, color: colores[j], weight: 2, opacity: 0.8, dashArray: '5, 5'}}).addTo(sectoresLayer);
         }});
+        if (visibles.length > MAX_CARDINALES) return;
         for (var p in cardinales) {{
-            var pc = calcularPuntoFinal(torre.lat, torre.lon, (radioMetros * 0.9) / 1000, cardinales[p]);
-            L.marker(pc, {{icon: L.divIcon({{className: 'cardinal-label', html: '<div style="font-size:10pt;font-weight:bold;color:black;background:white;padding:2px;border-radius:3px;">' + p + '</div>', iconSize: [20, 20], iconAnchor: [0, 0]}}))}}).addTo(sectoresLayer);
+            var pc = calcularPuntoFinal(lat, lon, (radioSectores * {geometria.FACTOR_CARDINALES}) / 1000, cardinales[p]);
+            L.marker(pc, {{icon: L.divIcon({{className: 'cardinal-label', html: '<div style="font-size:10pt;font-weight:bold;color:black;background:white;padding:2px;border-radius:3px;">' + p + '</div>', iconSize: [20, 20], iconAnchor: [0, 0]}})}}).addTo(sectoresLayer);
         }}
     }});
 }}
@@ -104,187 +222,368 @@ function actualizarRadio() {{
 }}
 </script>'''
 
-def crear_mapa_de_torres(archivo_excel, radio_metros, guardar_como=None):
-    print(f"Buscando hoja '{NOMBRE_HOJA}' en '{archivo_excel}'...")
-    print(f"Radio configurado: {radio_metros} metros")
+def _formato_tabla(archivo):
+    extension = os.path.splitext(archivo)[1].lower()
+    if extension in ('.csv', '.txt'):
+        return 'csv'
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    if extension in ('.xlsx', '.xlsm'):
+        return 'xlsx'
+    return 'excel'
+
+def _separador_csv(archivo):
+    with open(archivo, 'r', encoding='utf-8', errors='replace', newline='') as f:
+        muestra = f.read(65536)
     try:
-        df = pd.read_excel(archivo_excel, sheet_name=NOMBRE_HOJA)
+        return csv.Sniffer().sniff(muestra, delimiters=',;\t|').delimiter
+    except csv.Error:
+        return ','
+
+def _hoja_xlsx(libro, hoja=NOMBRE_HOJA):
+    if hoja is None:
+        return libro.worksheets[0]
+    if hoja not in libro.sheetnames:
+        raise ValueError(f"Worksheet named '{hoja}' not found")
+    return libro[hoja]
+
+def _encabezados_xlsx(fila):
+    return [str(v) if v is not None else f"Unnamed: {i}" for i, v in enumerate(fila)]
+
+def leer_columnas_tabla(archivo, hoja=NOMBRE_HOJA):
+    """Nombres de columna de un CSV, Parquet o Excel (hoja FTD, o la primera con hoja=None) sin leer los datos."""
+    formato = _formato_tabla(archivo)
+    if formato == 'csv':
+        return list(pd.read_csv(archivo, sep=_separador_csv(archivo), nrows=0, encoding_errors='replace').columns)
+    if formato == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(archivo).schema_arrow.names
+    if formato == 'xlsx':
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            return _encabezados_xlsx(next(_hoja_xlsx(libro, hoja).iter_rows(max_row=1, values_only=True), ()))
+        finally:
+            libro.close()
+    return list(pd.read_excel(archivo, sheet_name=0 if hoja is None else hoja, nrows=0).columns)
+
+def leer_bloques_tabla(archivo, columnas, tam_bloque=TAM_BLOQUE, hoja=NOMBRE_HOJA):
+    """Itera DataFrames de a lo sumo `tam_bloque` filas con solo `columnas`.
+
+    CSV y Parquet se leen por bloques con proyeccion de columnas y los .xlsx
+    fila a fila con openpyxl en modo solo lectura, asi que la memoria no
+    depende del numero de filas. Otros formatos de Excel se leen enteros.
+    """
+    formato = _formato_tabla(archivo)
+    if formato == 'csv':
+        yield from pd.read_csv(archivo, sep=_separador_csv(archivo), usecols=columnas,
+                               chunksize=tam_bloque, encoding_errors='replace')
+    elif formato == 'parquet':
+        import pyarrow.parquet as pq
+        for lote in pq.ParquetFile(archivo).iter_batches(batch_size=tam_bloque, columns=columnas):
+            yield lote.to_pandas()
+    elif formato == 'xlsx':
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            filas = _hoja_xlsx(libro, hoja).iter_rows(values_only=True)
+            encabezados = _encabezados_xlsx(next(filas, ()))
+            indices = [encabezados.index(c) for c in columnas]
+            bloque = []
+            for fila in filas:
+                bloque.append([fila[i] if i < len(fila) else None for i in indices])
+                if len(bloque) == tam_bloque:
+                    yield pd.DataFrame(bloque, columns=columnas, dtype=object)
+                    bloque = []
+            if bloque:
+                yield pd.DataFrame(bloque, columns=columnas, dtype=object)
+        finally:
+            libro.close()
+    else:
+        yield pd.read_excel(archivo, sheet_name=0 if hoja is None else hoja, usecols=columnas)
+
+def leer_bloques_coordenadas(archivo, lat_col, lon_col, hoja=NOMBRE_HOJA, tam_bloque=TAM_BLOQUE):
+    """Itera (filas, lats, lons) con las coordenadas validas de cada bloque de la tabla.
+
+    `filas` es la posicion de cada coordenada entre las filas de datos del
+    archivo (sin contar la cabecera).
+    """
+    leidas = 0
+    for bloque in leer_bloques_tabla(archivo, [lat_col, lon_col], tam_bloque, hoja):
+        lats = coordenadas_numericas(bloque[lat_col])
+        lons = coordenadas_numericas(bloque[lon_col])
+        validas = ~(np.isnan(lats) | np.isnan(lons))
+        yield np.flatnonzero(validas) + leidas, lats[validas], lons[validas]
+        leidas += len(bloque)
+
+def buscar_columnas_coordenadas(archivo, hoja=NOMBRE_HOJA):
+    """(lat_col, lon_col) de la tabla, o None con el error ya mostrado."""
+    if _formato_tabla(archivo) in ('xlsx', 'excel'):
+        print(f"Buscando hoja '{hoja}' en '{archivo}'..." if hoja else f"Leyendo primera hoja de '{archivo}'...")
+    else:
+        print(f"Leyendo '{archivo}'...")
+    try:
+        columnas = leer_columnas_tabla(archivo, hoja)
     except FileNotFoundError:
-        print(f"Error: Archivo '{archivo_excel}' no encontrado.")
+        print(f"Error: Archivo '{archivo}' no encontrado.")
+        return None
+    except ImportError:
+        print("Error: Para leer archivos Parquet instale pyarrow (pip install pyarrow).")
         return None
     except ValueError:
-        print(f"Error: Hoja '{NOMBRE_HOJA}' no encontrada en el archivo.")
+        print(f"Error: Hoja '{hoja}' no encontrada en el archivo.")
         return None
     except Exception as e:
-        print(f"Error al leer Excel: {e}")
+        print(f"Error al leer archivo: {e}")
         return None
     
-    lat_col, lon_col = encontrar_columnas_coordenadas(df)
+    lat_col, lon_col = encontrar_columnas_coordenadas(pd.DataFrame(columns=columnas))
     if not lat_col or not lon_col:
         print("Error: No se encontraron columnas 'Latitud' y 'Longitud'.")
         return None
     
     print(f"Columnas encontradas: Latitud ('{lat_col}'), Longitud ('{lon_col}')")
-    df['Lat_F'] = pd.to_numeric(df[lat_col].apply(limpiar_coordenada), errors='coerce')
-    df['Lon_F'] = pd.to_numeric(df[lon_col].apply(limpiar_coordenada), errors='coerce')
-    df_valido = df.dropna(subset=['Lat_F', 'Lon_F'])
+    return lat_col, lon_col
+
+def leer_torres(archivo_excel):
+    """Lee las coordenadas validas de un Excel (hoja FTD), CSV o Parquet.
+
+    Devuelve (lats, lons, filas), donde `filas` es la posicion de cada torre
+    entre las filas de datos del archivo, o None (con el error ya mostrado).
+    """
+    columnas = buscar_columnas_coordenadas(archivo_excel)
+    if columnas is None:
+        return None
+    lats, lons, filas = [], [], []
+    try:
+        for filas_bloque, lat_bloque, lon_bloque in leer_bloques_coordenadas(archivo_excel, *columnas):
+            filas.append(filas_bloque)
+            lats.append(lat_bloque)
+            lons.append(lon_bloque)
+    except Exception as e:
+        print(f"Error al leer archivo: {e}")
+        return None
+    lats = np.concatenate(lats) if lats else np.empty(0)
+    lons = np.concatenate(lons) if lons else np.empty(0)
+    filas = np.concatenate(filas) if filas else np.empty(0, dtype=np.int64)
     
-    if df_valido.empty:
+    if len(lats) == 0:
         print("Error: No se encontraron coordenadas validas.")
         return None
+    return lats, lons, filas
+
+def crear_mapa_de_torres(archivo_excel, radio_metros, guardar_como=None, datos_aparte=False):
+    """Crea el mapa de torres desde un Excel (hoja FTD), CSV o Parquet."""
+    print(f"Radio configurado: {radio_metros} metros")
+    torres = leer_torres(archivo_excel)
+    if torres is None:
+        return None
+    lats, lons, _ = torres
     
-    print(f"{len(df_valido)} coordenadas validas procesadas.")
-    torres_data = [{'lat': row['Lat_F'], 'lon': row['Lon_F']} for _, row in df_valido.iterrows()]
+    print(f"{len(lats)} coordenadas validas procesadas.")
+    clusters = ClustersJerarquicos(lats, lons)
+    niveles_clusters, zoom_puntos = clusters.niveles_compactos(indices=True)
+    datos_torres = {
+        'torres': np.round(np.column_stack([lats, lons]), 6).ravel().tolist(),
+        'clusters': niveles_clusters,
+        'zoomPuntos': zoom_puntos,
+    }
     
-    m = crear_mapa_base(df_valido['Lat_F'].mean(), df_valido['Lon_F'].mean())
-    cluster = MarkerCluster(name='Torres Telefonicas').add_to(m)
-    icono_url = crear_icono_torre()
+    m = crear_mapa_base(lats.mean(), lons.mean())
+    capa_torres = folium.FeatureGroup(name='Torres Telefonicas').add_to(m)
+    folium.LayerControl(position='topleft', collapsed=False).add_to(m)
     
-    for _, row in df_valido.iterrows():
-        folium.Marker(
-            location=[row['Lat_F'], row['Lon_F']],
-            icon=CustomIcon(icono_url, icon_size=(40, 40), icon_anchor=(20, 40)),
-            tooltip=f"Lat: {row['Lat_F']:.4f}, Lon: {row['Lon_F']:.4f}"
-        ).add_to(cluster)
+    archivo_datos = None
+    if datos_aparte:
+        guardar_como = guardar_como or f"mapa_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.html"
+        ruta_datos = os.path.splitext(guardar_como)[0] + '.torres.json'
+        with open(ruta_datos, 'w', encoding='utf-8') as f:
+            json.dump(datos_torres, f, separators=(',', ':'))
+        archivo_datos = os.path.basename(ruta_datos)
+        print(f"Datos de torres guardados en: {ruta_datos}")
     
-    folium.LayerControl(position='topleft', collapsed=False).add_to(m)
-    m.get_root().html.add_child(Element(crear_html_control_y_scripts(radio_metros, torres_data)))
+    m.get_root().html.add_child(Element(crear_html_control_y_scripts(
+        radio_metros, capa_torres.get_name(), datos_torres, archivo_datos)))
     return guardar_mapa(m, guardar_como, 'mapa')
 
-def leer_contenido_kml(archivo):
-    extension = archivo.lower().split('.')[-1]
+def analizar_solapes(archivo_excel, radio_metros, guardar_como=None):
+    """Exporta a Excel los pares de torres del archivo cuyas coberturas de `radio_metros` se solapan."""
+    torres = leer_torres(archivo_excel)
+    if torres is None:
+        return None
+    lats, lons, filas = torres
+    inicio = time.perf_counter()
+    solapes = solapes_torres(lats, lons, radio_metros)
+    a, b = solapes['torre_a'].to_numpy(), solapes['torre_b'].to_numpy()
+    print(f"{len(solapes)} pares solapados entre {len(lats)} torres ({time.perf_counter() - inicio:.2f} s).")
+    # Fila del archivo contando la cabecera, como se ve en Excel
+    tabla = pd.DataFrame({
+        'Fila A': filas[a] + 2, 'Latitud A': lats[a], 'Longitud A': lons[a],
+        'Fila B': filas[b] + 2, 'Latitud B': lats[b], 'Longitud B': lons[b],
+        'Distancia (m)': solapes['distancia_m'].round(1), 'Solape (m)': solapes['solape_m'].round(1),
+    })
+    archivo = guardar_como or f"solapes_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    escribir_excel({'Solapes': tabla}, archivo)
+    print(f"Solapes guardados en: {archivo}")
+    return archivo
+
+def analizar_cobertura(archivo_excel, radio_metros, archivo_puntos, guardar_como=None):
+    """Para cada punto de `archivo_puntos`, las torres del archivo cuya cobertura lo contiene.
+
+    Los puntos (primera hoja si es Excel) se leen y se buscan por bloques en
+    un arbol de las torres. La salida tiene una fila por par punto-torre,
+    ordenada por punto y distancia; en CSV se escribe bloque a bloque, asi
+    que sirve para millones de puntos.
+    """
+    torres = leer_torres(archivo_excel)
+    if torres is None:
+        return None
+    lats, lons, filas_torres = torres
+    columnas = buscar_columnas_coordenadas(archivo_puntos, hoja=None)
+    if columnas is None:
+        return None
+    archivo = guardar_como or f"cobertura_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    en_excel = _formato_tabla(archivo) in ('xlsx', 'excel')
+    inicio = time.perf_counter()
+    arbol = ArbolEsferico(lats, lons)
+    total = cubiertos = pares = 0
+    tablas = []
     try:
-        if extension == 'kmz':
-            with zipfile.ZipFile(archivo, 'r') as z:
-                for nombre in z.namelist():
-                    if nombre.endswith('.kml'):
-                        return z.read(nombre)
-            print("Error: No se encontro archivo KML dentro del KMZ.")
-            return None
-        elif extension == 'kml':
-            with open(archivo, 'rb') as f:
-                return f.read()
-        else:
-            print("Error: Extension no soportada. Use .kml o .kmz")
-            return None
+        for numero, (filas, lat_puntos, lon_puntos) in enumerate(
+                leer_bloques_coordenadas(archivo_puntos, *columnas, hoja=None)):
+            cobertura = cobertura_puntos(arbol, radio_metros, lat_puntos, lon_puntos)
+            p, t = cobertura['punto'].to_numpy(), cobertura['torre'].to_numpy()
+            tabla = pd.DataFrame({
+                'Fila punto': filas[p] + 2, 'Latitud punto': lat_puntos[p], 'Longitud punto': lon_puntos[p],
+                'Fila torre': filas_torres[t] + 2, 'Latitud torre': lats[t], 'Longitud torre': lons[t],
+                'Distancia (m)': cobertura['distancia_m'].round(1),
+            })
+            if en_excel:
+                tablas.append(tabla)
+            else:
+                tabla.to_csv(archivo, mode='w' if numero == 0 else 'a', header=numero == 0, index=False)
+            total += len(filas)
+            cubiertos += len(np.unique(p))
+            pares += len(tabla)
     except Exception as e:
         print(f"Error al leer archivo: {e}")
         return None
+    if en_excel:
+        escribir_excel({'Cobertura': pd.concat(tablas, ignore_index=True) if tablas else pd.DataFrame()}, archivo)
+    segundos = time.perf_counter() - inicio
+    print(f"{cubiertos} de {total} puntos con cobertura ({pares} pares punto-torre) en {segundos:.2f} s.")
+    print(f"Cobertura guardada en: {archivo}")
+    return archivo
 
-def extraer_iconos_kmz(archivo):
-    iconos_base64 = {}
+def buscar_columna(columnas, nombres):
+    """Primera columna que se llama como alguno de `nombres` o, si no hay, que lo contiene."""
+    minusculas = {str(c).strip().lower(): c for c in columnas}
+    for nombre in nombres:
+        if nombre in minusculas:
+            return minusculas[nombre]
+    for nombre in nombres:
+        for clave, columna in minusculas.items():
+            if len(nombre) > 2 and nombre in clave:
+                return columna
+    return None
+
+def importar_cdr(archivo_excel, archivo_cdr, columnas=None, abonados=None, min_puntos=2):
+    """Une un CDR con la tabla de torres y agrega la trayectoria de cada abonado al editor.
+
+    El CDR (Excel en su primera hoja, CSV o Parquet) se lee por bloques; cada
+    registro se une por id de celda con la torre del archivo de torres y,
+    al terminar, se ordena por abonado y hora. Cada abonado con al menos
+    `min_puntos` cambios de torre se agrega como una 'ruta' (con la hora de
+    cada punto en 'tiempos') en una capa nueva del almacen del editor, en
+    una sola operacion. `columnas` permite indicar
+    {'id_torre', 'abonado', 'celda', 'tiempo'} si no se reconocen solas.
+    """
+    columnas = dict(columnas or {})
+    coordenadas = buscar_columnas_coordenadas(archivo_excel)
+    if coordenadas is None:
+        return None
+    col_id = columnas.get('id_torre') or buscar_columna(leer_columnas_tabla(archivo_excel), COLUMNAS_ID_TORRE)
+    if not col_id:
+        print("Error: No se encontro la columna con el id de celda de las torres.")
+        return None
+    ids, lats, lons = [], [], []
+    for bloque in leer_bloques_tabla(archivo_excel, [col_id, *coordenadas]):
+        lat_bloque = coordenadas_numericas(bloque[coordenadas[0]])
+        lon_bloque = coordenadas_numericas(bloque[coordenadas[1]])
+        validas = ~(np.isnan(lat_bloque) | np.isnan(lon_bloque))
+        ids.append(bloque[col_id].to_numpy(dtype=object)[validas])
+        lats.append(lat_bloque[validas])
+        lons.append(lon_bloque[validas])
+    ids, lats, lons = np.concatenate(ids), np.concatenate(lats), np.concatenate(lons)
+    print(f"{len(ids)} torres con id ('{col_id}') y coordenadas.")
+    
+    try:
+        columnas_cdr = leer_columnas_tabla(archivo_cdr, hoja=None)
+    except Exception as e:
+        print(f"Error al leer el CDR: {e}")
+        return None
+    campos = {campo: columnas.get(campo) or buscar_columna(columnas_cdr, nombres)
+              for campo, nombres in COLUMNAS_CDR.items()}
+    faltan = [campo for campo, columna in campos.items() if not columna]
+    if faltan:
+        print(f"Error: No se encontraron en el CDR las columnas de: {', '.join(faltan)}.")
+        return None
+    print(f"Columnas del CDR: abonado ('{campos['abonado']}'), celda ('{campos['celda']}'), hora ('{campos['tiempo']}')")
+    
+    trayectorias = TrayectoriasCDR(ids, abonados)
+    inicio = time.perf_counter()
+    for bloque in leer_bloques_tabla(archivo_cdr, list(dict.fromkeys(campos.values())), hoja=None):
+        trayectorias.agregar(bloque[campos['abonado']], bloque[campos['celda']], bloque[campos['tiempo']])
+    lectura = time.perf_counter() - inicio
+    nombres, torres, instantes, limites = trayectorias.trayectorias(min_puntos)
+    duracion = time.perf_counter() - inicio
+    print(f"{trayectorias.leidos} registros en {duracion:.1f}s ({trayectorias.leidos / max(duracion, 1e-9):,.0f} registros/s; "
+          f"lectura y union {lectura:.1f}s). Sin torre: {trayectorias.sin_torre}, sin hora valida: {trayectorias.sin_tiempo}.")
+    if len(nombres) == 0:
+        print("No hay abonados con trayectoria.")
+        return []
+    
+    almacen = crear_almacen()
+    capa_id = almacen.siguiente_id_capa()
+    puntos = np.round(np.column_stack([lats[torres], lons[torres]]), 6).tolist()
+    tiempos = np.datetime_as_string(instantes, unit='s').tolist()
+    limites = limites.tolist()
+    operaciones = [{'op': 'agregar_capa', 'capa': {
+        'id': capa_id, 'nombre': f"CDR {os.path.splitext(os.path.basename(archivo_cdr))[0]}",
+        'color': COLORES_CAPAS[(capa_id - 1) % len(COLORES_CAPAS)], 'visible': True}}]
+    for k, abonado in enumerate(nombres):
+        desde, hasta = limites[k], limites[k + 1]
+        operaciones.append({'op': 'agregar', 'elemento': {
+            'tipo': 'ruta', 'nombre': f"Abonado {abonado}", 'abonado': abonado,
+            'puntos': puntos[desde:hasta], 'tiempos': tiempos[desde:hasta],
+            'color': COLORES_CAPAS[k % len(COLORES_CAPAS)], 'grosor': 3, 'capa': capa_id}})
+    # El historial de deshacer vive en el proceso del servidor: desde la linea de comandos no se guarda
+    resultados = almacen.aplicar({'op': 'lote', 'operaciones': operaciones}, deshacible=False)
+    almacen.guardar()
+    print(f"Se agregaron {len(nombres)} trayectorias ({len(puntos)} puntos) en la capa {capa_id}.")
+    return resultados[1:]
+
+def extraer_iconos_kmz(archivo, mostrar=True):
+    """Guarda los iconos PNG del KMZ en el almacen de iconos y devuelve {ruta_en_kmz: 'sha256:<hash>'}."""
+    iconos = {}
     extension = archivo.lower().split('.')[-1]
     if extension != 'kmz':
-        return iconos_base64
+        return iconos
     try:
         with zipfile.ZipFile(archivo, 'r') as z:
             for nombre in z.namelist():
                 if nombre.startswith('images/') and nombre.endswith('.png'):
-                    datos = z.read(nombre)
-                    icono_base64 = f"data:image/png;base64,{base64.b64encode(datos).decode()}"
-                    iconos_base64[nombre] = icono_base64
-                    print(f"  Icono extraido: {nombre}")
+                    iconos[nombre] = guardar_icono(z.read(nombre), 'png')
+                    if mostrar:
+                        print(f"  Icono extraido: {nombre}")
     except Exception as e:
         print(f"Error al extraer iconos: {e}")
-    return iconos_base64
-
-def parsear_estilos_kml(contenido_kml):
-    import re
-    estilos = {}
-    style_maps = {}
-    contenido_str = contenido_kml.decode('utf-8') if isinstance(contenido_kml, bytes) else contenido_kml
-    style_pattern = r'<Style id="([^"]+)"[^>]*>.*?<Icon>.*?<href>([^<]+)</href>.*?</Icon>.*?</Style>'
-    for match in re.finditer(style_pattern, contenido_str, re.DOTALL):
-        style_id = match.group(1)
-        href = match.group(2)
-        estilos[style_id] = href
-    stylemap_pattern = r'<StyleMap id="([^"]+)"[^>]*>.*?<Pair>.*?<key>normal</key>.*?<styleUrl>#([^<]+)</styleUrl>.*?</Pair>.*?</StyleMap>'
-    for match in re.finditer(stylemap_pattern, contenido_str, re.DOTALL):
-        map_id = match.group(1)
-        normal_style = match.group(2)
-        if normal_style in estilos:
-            style_maps[map_id] = estilos[normal_style]
-    return estilos, style_maps
-
-def obtener_style_url_placemark(contenido_kml, nombre_placemark):
-    import re
-    contenido_str = contenido_kml.decode('utf-8') if isinstance(contenido_kml, bytes) else contenido_kml
-    pattern = rf'<Placemark[^>]*>.*?<name>{re.escape(nombre_placemark)}</name>.*?<styleUrl>#([^<]+)</styleUrl>.*?</Placemark>'
-    match = re.search(pattern, contenido_str, re.DOTALL)
-    if match:
-        return match.group(1)
-    return None
+    return iconos
 
-def extraer_placemarks_con_estilos(contenido_kml):
-    import re
-    contenido_str = contenido_kml.decode('utf-8') if isinstance(contenido_kml, bytes) else contenido_kml
-    placemarks = []
-    placemark_pattern = r'<Placemark[^>]*>(.*?)</Placemark>'
-    for match in re.finditer(placemark_pattern, contenido_str, re.DOTALL):
-        placemark_content = match.group(1)
-        name_match = re.search(r'<name>([^<]*)</name>', placemark_content)
-        nombre = name_match.group(1) if name_match else ''
-        desc_match = re.search(r'<description>([^<]*)</description>', placemark_content)
-        desc = desc_match.group(1) if desc_match else ''
-        style_match = re.search(r'<styleUrl>#([^<]+)</styleUrl>', placemark_content)
-        style_url = style_match.group(1) if style_match else None
-        coord_match = re.search(r'<coordinates>([^<]+)</coordinates>', placemark_content)
-        if coord_match:
-            coords_str = coord_match.group(1).strip()
-            coords_list = coords_str.split()
-            if len(coords_list) == 1:
-                parts = coords_str.split(',')
-                if len(parts) >= 2:
-                    try:
-                        lon = float(parts[0])
-                        lat = float(parts[1])
-                        placemarks.append({
-                            'tipo': 'punto',
-                            'lat': lat,
-                            'lon': lon,
-                            'nombre': nombre,
-                            'desc': desc,
-                            'style_url': style_url
-                        })
-                    except:
-                        pass
-            else:
-                coords = []
-                for coord in coords_list:
-                    parts = coord.split(',')
-                    if len(parts) >= 2:
-                        try:
-                            lon = float(parts[0])
-                            lat = float(parts[1])
-                            coords.append((lat, lon))
-                        except:
-                            pass
-                if coords:
-                    if coords[0] == coords[-1] and len(coords) > 3:
-                        placemarks.append({
-                            'tipo': 'poligono',
-                            'coords': coords,
-                            'nombre': nombre,
-                            'desc': desc,
-                            'style_url': style_url
-                        })
-                    else:
-                        placemarks.append({
-                            'tipo': 'linea',
-                            'coords': coords,
-                            'nombre': nombre,
-                            'desc': desc,
-                            'style_url': style_url
-                        })
-    return placemarks
-
-def guardar_elementos_json(elementos, archivo='elementos_mapa.json'):
-    """Guarda los elementos en el archivo JSON para el editor."""
-    with open(archivo, 'w', encoding='utf-8') as f:
-        json.dump(elementos, f, ensure_ascii=False, indent=2)
+def guardar_elementos_json(elementos, archivo=ARCHIVO_ELEMENTOS, capas=None):
+    """Guarda los elementos (y las capas, si se dan) en los JSON del editor, descartando su diario."""
+    reemplazar_instantanea(elementos, capas, archivo)
     print(f"Elementos guardados en: {archivo}")
 
-def convertir_placemarks_a_elementos(placemarks, estilos, style_maps, iconos_base64):
+def convertir_placemarks_a_elementos(placemarks, estilos, style_maps, iconos):
     """Convierte los placemarks del KMZ al formato del editor."""
     elementos = []
     id_counter = 1
@@ -301,8 +600,10 @@ def convertir_placemarks_a_elementos(placemarks, estilos, style_maps, iconos_bas
                     href = estilos[style_id]
                 elif style_id + '-normal' in estilos:
                     href = estilos[style_id + '-normal']
-                if href and href in iconos_base64:
-                    icono_url = iconos_base64[href]
+                if href and href in iconos:
+                    icono_url = iconos[href]
+            if not icono_url and p.get('icono_href') in iconos:
+                icono_url = iconos[p['icono_href']]
             
             elemento = {
                 'id': id_counter,
@@ -352,43 +653,184 @@ def convertir_placemarks_a_elementos(placemarks, estilos, style_maps, iconos_bas
     
     return elementos
 
-def importar_kml_kmz(archivo, guardar_como=None):
-    print(f"Importando archivo: {archivo}")
-    contenido = leer_contenido_kml(archivo)
-    if not contenido:
+def hash_archivo(archivo):
+    h = hashlib.sha256()
+    with open(archivo, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+def ruta_cache_importacion(archivo):
+    """Directorio de cache para el contenido de `archivo` y la version actual del conversor."""
+    return os.path.join(DIRECTORIO_CACHE, f"{hash_archivo(archivo)}-v{VERSION_CONVERSOR}")
+
+def guardar_cache_importacion(ruta_cache, archivo_mapa, archivo_elementos, elementos):
+    temporal = f"{ruta_cache}.tmp"
+    shutil.rmtree(temporal, ignore_errors=True)
+    os.makedirs(temporal)
+    shutil.copyfile(archivo_mapa, os.path.join(temporal, 'mapa.html'))
+    shutil.copyfile(archivo_elementos, os.path.join(temporal, 'elementos.json'))
+    iconos = sorted({e['icono'] for e in elementos if str(e.get('icono', '')).startswith(PREFIJO_ICONO)})
+    with open(os.path.join(temporal, 'iconos.json'), 'w', encoding='utf-8') as f:
+        json.dump(iconos, f)
+    shutil.rmtree(ruta_cache, ignore_errors=True)
+    os.replace(temporal, ruta_cache)
+
+def restaurar_cache_importacion(ruta_cache, guardar_como, archivo_elementos):
+    """Copia el mapa y los elementos cacheados; devuelve el HTML o None si la cache no sirve."""
+    try:
+        with open(os.path.join(ruta_cache, 'iconos.json'), 'r', encoding='utf-8') as f:
+            iconos = json.load(f)
+    except (OSError, ValueError):
         return None
-    
-    print("Extrayendo iconos del archivo...")
-    iconos_base64 = extraer_iconos_kmz(archivo)
-    
-    print("Parseando estilos...")
-    estilos, style_maps = parsear_estilos_kml(contenido)
-    
-    print("Extrayendo elementos con estilos...")
-    placemarks = extraer_placemarks_con_estilos(contenido)
+    if not all(buscar_icono(icono) for icono in iconos):
+        return None
+    archivo = guardar_como or f"mapa_kml_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.html"
+    try:
+        with open(os.path.join(ruta_cache, 'elementos.json'), 'r', encoding='utf-8') as f:
+            elementos = json.load(f)
+        shutil.copyfile(os.path.join(ruta_cache, 'mapa.html'), archivo)
+    except (OSError, ValueError):
+        return None
+    print(f"Importacion sin cambios, usando cache: {ruta_cache}")
+    guardar_elementos_json(elementos, archivo_elementos)
+    print("-" * 50)
+    print(f"Mapa generado: {archivo}")
+    print("-" * 50)
+    return archivo
+
+def limpiar_cache_importaciones():
+    if os.path.isdir(DIRECTORIO_CACHE):
+        shutil.rmtree(DIRECTORIO_CACHE)
+        print(f"Cache de importaciones eliminada: {DIRECTORIO_CACHE}")
+
+def convertir_kml_kmz(archivo, mostrar=True):
+    """Lee un KML/KMZ y lo convierte a elementos del editor (con ids desde 1).
+
+    Solo escribe los iconos en el almacen de iconos. Devuelve un dict con
+    'elementos', el numero de 'puntos', 'lineas' y 'poligonos', y 'suma'
+    (suma de latitudes, suma de longitudes, numero de coordenadas) para
+    calcular el centro. Los errores de lectura se propagan.
+    """
+    if mostrar:
+        print("Leyendo estilos y elementos...")
+    with abrir_kml(archivo) as fuente:
+        lector = LectorKML(fuente)
+        placemarks = list(lector)
     
     puntos = [p for p in placemarks if p['tipo'] == 'punto']
     lineas = [p for p in placemarks if p['tipo'] == 'linea']
     poligonos = [p for p in placemarks if p['tipo'] == 'poligono']
+    if mostrar and placemarks:
+        print(f"Elementos: {len(puntos)} puntos, {len(lineas)} lineas, {len(poligonos)} poligonos")
+        print("Extrayendo iconos del archivo...")
+    iconos = extraer_iconos_kmz(archivo, mostrar) if placemarks else {}
     
-    if not placemarks:
-        print("Error: No se encontraron elementos geograficos.")
+    suma_lat = sum(p['lat'] for p in puntos) + sum(c[0] for p in lineas + poligonos for c in p['coords'])
+    suma_lon = sum(p['lon'] for p in puntos) + sum(c[1] for p in lineas + poligonos for c in p['coords'])
+    total = len(puntos) + sum(len(p['coords']) for p in lineas + poligonos)
+    return {
+        'elementos': convertir_placemarks_a_elementos(placemarks, lector.estilos, lector.style_maps, iconos),
+        'puntos': len(puntos),
+        'lineas': len(lineas),
+        'poligonos': len(poligonos),
+        'suma': (suma_lat, suma_lon, total),
+    }
+
+def importar_kml_kmz(archivo, guardar_como=None, usar_cache=True):
+    print(f"Importando archivo: {archivo}")
+    archivo_elementos = ARCHIVO_ELEMENTOS
+    ruta_cache = None
+    if usar_cache and os.path.isfile(archivo):
+        ruta_cache = ruta_cache_importacion(archivo)
+        resultado = restaurar_cache_importacion(ruta_cache, guardar_como, archivo_elementos)
+        if resultado:
+            return resultado
+    
+    try:
+        conversion = convertir_kml_kmz(archivo)
+    except Exception as e:
+        print(f"Error al leer archivo: {e}")
         return None
     
-    print(f"Elementos: {len(puntos)} puntos, {len(lineas)} lineas, {len(poligonos)} poligonos")
+    suma_lat, suma_lon, total = conversion['suma']
+    if not total:
+        print("Error: No se encontraron elementos geograficos.")
+        return None
     
-    elementos_editor = convertir_placemarks_a_elementos(placemarks, estilos, style_maps, iconos_base64)
-    guardar_elementos_json(elementos_editor)
+    elementos_editor = conversion['elementos']
+    guardar_elementos_json(elementos_editor, archivo_elementos)
     print(f"Se han registrado {len(elementos_editor)} elementos para edicion")
     
-    todas = [(p['lat'], p['lon']) for p in puntos]
-    for l in lineas: todas.extend(l['coords'])
-    for p in poligonos: todas.extend(p['coords'])
+    m = crear_mapa_base(suma_lat / total, suma_lon / total)
+    folium.LayerControl(position='topleft', collapsed=False).add_to(m)
+    archivo_mapa = guardar_mapa(m, guardar_como, 'mapa_kml')
+    if ruta_cache:
+        try:
+            guardar_cache_importacion(ruta_cache, archivo_mapa, archivo_elementos, elementos_editor)
+        except OSError as e:
+            print(f"Aviso: no se pudo guardar la cache de importacion: {e}")
+    return archivo_mapa
+
+def _convertir_en_proceso(archivo):
+    """Trabajo de importar_lote: (archivo, conversion o None, error o None, segundos)."""
+    inicio = time.perf_counter()
+    try:
+        return archivo, convertir_kml_kmz(archivo, mostrar=False), None, time.perf_counter() - inicio
+    except Exception as e:
+        return archivo, None, str(e), time.perf_counter() - inicio
+
+def importar_lote(directorio, guardar_como=None, procesos=None):
+    """Importa todos los KML/KMZ de un directorio en paralelo, con una capa por archivo.
+
+    Cada archivo se convierte en un proceso del pool; los resultados se
+    unen con ids consecutivos y se guardan en los JSON del editor
+    (elementos y capas), reemplazando su contenido.
+    """
+    if not os.path.isdir(directorio):
+        print(f"Error: Directorio '{directorio}' no encontrado.")
+        return None
+    archivos = sorted(os.path.join(directorio, n) for n in os.listdir(directorio)
+                      if n.lower().endswith(('.kml', '.kmz')))
+    if not archivos:
+        print(f"Error: No hay archivos KML/KMZ en '{directorio}'.")
+        return None
+    
+    procesos = procesos or os.cpu_count() or 1
+    print(f"Importando {len(archivos)} archivos con {procesos} procesos...")
+    inicio = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(procesos, len(archivos))) as pool:
+        resultados = list(pool.map(_convertir_en_proceso, archivos))
     
-    m = crear_mapa_base(sum(c[0] for c in todas)/len(todas), sum(c[1] for c in todas)/len(todas))
+    elementos, capas = [], []
+    suma_lat = suma_lon = total = 0
+    for archivo, conversion, error, segundos in resultados:
+        nombre = os.path.basename(archivo)
+        if error:
+            print(f"  {nombre}: ERROR {error} ({segundos:.2f}s)")
+            continue
+        capa_id = len(capas) + 1
+        capas.append({'id': capa_id, 'nombre': os.path.splitext(nombre)[0],
+                      'color': COLORES_CAPAS[(capa_id - 1) % len(COLORES_CAPAS)], 'visible': True})
+        for elemento in conversion['elementos']:
+            elementos.append({**elemento, 'id': len(elementos) + 1, 'capa': capa_id})
+        suma_lat += conversion['suma'][0]
+        suma_lon += conversion['suma'][1]
+        total += conversion['suma'][2]
+        print(f"  {nombre}: {len(conversion['elementos'])} elementos en {segundos:.2f}s")
     
+    duracion = time.perf_counter() - inicio
+    print(f"{len(capas)}/{len(archivos)} archivos en {duracion:.2f}s ({len(archivos) / duracion:.1f} archivos/s)")
+    if not total:
+        print("Error: No se encontraron elementos geograficos.")
+        return None
+    
+    guardar_elementos_json(elementos, capas=capas)
+    print(f"Se han registrado {len(elementos)} elementos en {len(capas)} capas")
+    
+    m = crear_mapa_base(suma_lat / total, suma_lon / total)
     folium.LayerControl(position='topleft', collapsed=False).add_to(m)
-    return guardar_mapa(m, guardar_como, 'mapa_kml')
+    return guardar_mapa(m, guardar_como, 'mapa_lote')
 
 def mostrar_menu_principal():
     print("\n" + "=" * 60)
@@ -412,7 +854,7 @@ def mostrar_menu_trabajar():
 
 def opcion_crear_mapa():
     print("\n--- CREAR MAPA DE INTELIGENCIA ---\n")
-    archivo = input("Ruta del archivo Excel [torres.xlsx]: ").strip() or "torres.xlsx"
+    archivo = input("Ruta del archivo de torres (Excel, CSV o Parquet) [torres.xlsx]: ").strip() or "torres.xlsx"
     radio = input("Radio en metros [500]: ").strip()
     if crear_mapa_de_torres(archivo, int(radio) if radio else 500):
         print("\nAbra el archivo en su navegador para ver las torres.")
@@ -451,7 +893,7 @@ def opcion_trabajar_mapa():
             
     elif opcion == 'B':
         print("\n--- NUEVO MAPA PARA EDICION ---\n")
-        archivo = input("Ruta del archivo Excel [torres.xlsx]: ").strip() or "torres.xlsx"
+        archivo = input("Ruta del archivo de torres (Excel, CSV o Parquet) [torres.xlsx]: ").strip() or "torres.xlsx"
         radio = input("Radio en metros [500]: ").strip()
         resultado = crear_mapa_de_torres(archivo, int(radio) if radio else 500, guardar_como="mapa_trabajo_temp.html")
         if resultado:
@@ -473,13 +915,55 @@ def modo_interactivo():
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         parser = argparse.ArgumentParser(description="Sistema de Mapas de Inteligencia")
-        parser.add_argument("archivo_excel", nargs='?', help="Ruta al archivo Excel")
+        parser.add_argument("archivo_excel", nargs='?', help="Ruta al archivo de torres (Excel, CSV o Parquet)")
         parser.add_argument("-r", "--radio", type=int, default=500, help="Radio en metros (default: 500)")
         parser.add_argument("--servidor", action="store_true", help="Modo servidor para edicion")
         parser.add_argument("--html", type=str, help="Archivo HTML para editar")
+        parser.add_argument("--persistencia", choices=['json', 'diario', 'sqlite'], default=None,
+                            help="Modo de persistencia del editor: json (instantanea), diario de operaciones o sqlite")
+        parser.add_argument("--datos-aparte", action="store_true",
+                            help="Guardar las coordenadas de las torres en un JSON junto al HTML en lugar de incrustarlas")
+        parser.add_argument("--limpiar-cache", action="store_true", help="Borrar la cache de importaciones KML/KMZ")
+        parser.add_argument("--importar-lote", metavar="DIR", help="Importar todos los KML/KMZ de un directorio, una capa por archivo")
+        parser.add_argument("--procesos", type=int, default=None, help="Procesos para --importar-lote (default: uno por nucleo)")
+        parser.add_argument("--solapes", action="store_true",
+                            help="Exportar a Excel los pares de torres del archivo cuyas coberturas (radio -r) se solapan")
+        parser.add_argument("--cobertura", metavar="PUNTOS",
+                            help="Archivo de puntos (Excel, CSV o Parquet): exportar que torres del archivo (radio -r) cubren cada punto")
+        parser.add_argument("--cdr", metavar="CDR",
+                            help="Registros de llamadas (Excel, CSV o Parquet): unir con las torres del archivo y agregar una ruta por abonado al editor")
+        parser.add_argument("--abonado", action="append", default=None, help="Con --cdr, importar solo este abonado (repetible)")
+        parser.add_argument("--columnas-cdr", metavar="CAMPO=COLUMNA", nargs='+', default=[],
+                            help="Con --cdr, columnas que no se reconocen solas: id_torre, abonado, celda, tiempo")
+        parser.add_argument("--salida", type=str, default=None, help="Archivo de salida para --solapes o --cobertura (.xlsx o .csv)")
         args = parser.parse_args()
+        if args.limpiar_cache:
+            limpiar_cache_importaciones()
+        if args.persistencia:
+            os.environ['MAPA_PERSISTENCIA'] = args.persistencia
         
-        if args.servidor:
+        if args.solapes:
+            if args.archivo_excel:
+                analizar_solapes(args.archivo_excel, args.radio, args.salida)
+            else:
+                print("Error: --solapes requiere un archivo de torres.")
+        elif args.cdr:
+            if args.archivo_excel:
+                columnas = dict(c.split('=', 1) for c in args.columnas_cdr if '=' in c)
+                importar_cdr(args.archivo_excel, args.cdr, columnas, args.abonado)
+                if args.servidor and args.html: iniciar_servidor_editor(args.html)
+            else:
+                print("Error: --cdr requiere un archivo de torres.")
+        elif args.cobertura:
+            if args.archivo_excel:
+                analizar_cobertura(args.archivo_excel, args.radio, args.cobertura, args.salida)
+            else:
+                print("Error: --cobertura requiere un archivo de torres.")
+        elif args.importar_lote:
+            resultado = importar_lote(args.importar_lote, guardar_como="mapa_lote_temp.html" if args.servidor else None,
+                                      procesos=args.procesos)
+            if resultado and args.servidor: iniciar_servidor_editor(resultado)
+        elif args.servidor:
             if args.html and os.path.exists(args.html):
                 iniciar_servidor_editor(args.html)
             elif args.archivo_excel:
@@ -488,7 +972,7 @@ if __name__ == "__main__":
             else:
                 print("Error: Debe proporcionar --html o un archivo Excel para modo servidor.")
         elif args.archivo_excel:
-            crear_mapa_de_torres(args.archivo_excel, args.radio)
+            crear_mapa_de_torres(args.archivo_excel, args.radio, datos_aparte=args.datos_aparte)
         else:
             modo_interactivo()
     else:
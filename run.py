@@ -1,5 +1,13 @@
-from mapa_torres import importar_kml_kmz, iniciar_servidor_editor
+import argparse
+from mapa_torres import importar_kml_kmz, iniciar_servidor_editor, limpiar_cache_importaciones
 
-resultado = importar_kml_kmz("ROBO-SANARE.kmz", guardar_como="mapa_kml_temp.html")
+parser = argparse.ArgumentParser(description="Importa ROBO-SANARE.kmz y abre el editor")
+parser.add_argument("--sin-cache", action="store_true", help="Reimportar aunque el KMZ no haya cambiado")
+parser.add_argument("--limpiar-cache", action="store_true", help="Borrar la cache de importaciones antes de importar")
+args = parser.parse_args()
+if args.limpiar_cache:
+    limpiar_cache_importaciones()
+
+resultado = importar_kml_kmz("ROBO-SANARE.kmz", guardar_como="mapa_kml_temp.html", usar_cache=not args.sin_cache)
 if resultado:
     iniciar_servidor_editor("mapa_kml_temp.html")
@@ -0,0 +1,63 @@
+"""ETags de revision, deltas de /api/cambios e iconos de /api/iconos."""
+import pytest
+
+import app
+from almacen import AlmacenMapa, guardar_icono
+
+
+@pytest.fixture
+def almacen(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    almacen = AlmacenMapa(str(tmp_path / 'elementos.json'), str(tmp_path / 'capas.json'), retardo=0)
+    almacen.suscribir(app.registro.registrar)
+    monkeypatch.setattr(app, 'almacen', almacen)
+    yield almacen
+    almacen.guardar()
+
+
+def test_etag_de_revision(almacen):
+    cliente = app.app.test_client()
+    almacen.agregar({'tipo': 'torre', 'lat': 1, 'lon': 1})
+    primera = cliente.get('/api/elementos')
+    etag = primera.headers['ETag']
+    assert primera.status_code == 200 and len(primera.json) == 1
+    assert cliente.get('/api/elementos', headers={'If-None-Match': etag}).status_code == 304
+    # Otra URL tiene su propio ETag aunque la revision sea la misma
+    assert cliente.get('/api/elementos?bbox=0,0,2,2', headers={'If-None-Match': etag}).status_code == 200
+
+    almacen.agregar({'tipo': 'torre', 'lat': 2, 'lon': 2})
+    segunda = cliente.get('/api/elementos', headers={'If-None-Match': etag})
+    assert segunda.status_code == 200 and segunda.headers['ETag'] != etag and len(segunda.json) == 2
+
+
+def test_cambios_desde_revision(almacen):
+    cliente = app.app.test_client()
+    torre = almacen.agregar({'tipo': 'torre', 'lat': 1, 'lon': 1})
+    etiqueta = almacen.agregar({'tipo': 'etiqueta', 'lat': 2, 'lon': 2})
+    todo = cliente.get('/api/cambios').json
+    assert todo['completo'] and len(todo['elementos']) == 2
+
+    capa = almacen.agregar_capa({'nombre': 'Nueva'})
+    almacen.actualizar(torre['id'], {'radio': 900})
+    almacen.eliminar(etiqueta['id'])
+    delta = cliente.get(f"/api/cambios?desde={todo['revision']}").json
+    assert not delta['completo'] and delta['revision'] > todo['revision']
+    assert [(e['id'], e['radio']) for e in delta['elementos']] == [(torre['id'], 900)]
+    assert delta['elementos_eliminados'] == [etiqueta['id']]
+    assert [c['id'] for c in delta['capas']] == [capa['id']] and delta['capas_eliminadas'] == []
+
+    sin_cambios = cliente.get(f"/api/cambios?desde={delta['revision']}").json
+    assert sin_cambios['elementos'] == [] and sin_cambios['elementos_eliminados'] == []
+    # Una revision que el registro no cubre pide el estado completo
+    assert cliente.get('/api/cambios?desde=1').json['completo']
+    assert cliente.get('/api/cambios?desde=x').status_code == 400
+
+
+def test_iconos_por_hash(almacen):
+    cliente = app.app.test_client()
+    clave = guardar_icono(b'\x89PNG icono', 'png')
+    respuesta = cliente.get(f'/api/iconos/{clave}')
+    assert respuesta.status_code == 200 and respuesta.data == b'\x89PNG icono'
+    assert respuesta.mimetype == 'image/png' and respuesta.cache_control.immutable
+    assert cliente.get('/api/iconos/sha256:' + '0' * 64).status_code == 404
+    assert cliente.get('/api/iconos/..%2Fapp.py').status_code == 404
@@ -0,0 +1,71 @@
+"""Paridad entre la limpieza vectorizada de coordenadas y la original fila a fila."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from mapa_torres import (coordenadas_numericas, leer_bloques_coordenadas, limpiar_coordenada,
+                         limpiar_coordenadas)
+
+# Comas decimales, separadores de miles, simbolos de grado, hemisferios,
+# vacios, fuera de rango, NaN y tipos que no son texto
+VALORES = [
+    '9.7489', '-69.5839', ' 9.74 89 ', '--69.5839', '1.234.567', '-1.234.5', '9,7489', '-69,5839',
+    '9.7489°', '9°44\'56"N', '69.5839 W', 'N 9.7489', '-69.5839O', '', '   ', None, np.nan, float('nan'),
+    'nan', 'NaN', '95.5', '-190.25', '1e3', '12', '-', '.', '..5', 'abc', 9.7489, -69, 0, 1234.5,
+    True, False, pd.NA, '0x1A', '+9.5', '9.5.', '٩.٥',
+]
+
+
+def limpieza_original(serie):
+    return pd.to_numeric(serie.apply(limpiar_coordenada), errors='coerce').to_numpy(dtype=float)
+
+
+@pytest.mark.parametrize('serie', [
+    pd.Series(VALORES, dtype=object),
+    pd.Series(VALORES[:20], dtype=object),
+    pd.Series([9.7489, -69.5, np.nan, 200.0]),
+    pd.Series([1, 2, 3]),
+    pd.Series([True, False]),
+    pd.Series(VALORES * 50, dtype=object).sample(frac=1, random_state=0).reset_index(drop=True),
+])
+def test_coordenadas_numericas_igual_que_original(serie):
+    np.testing.assert_array_equal(coordenadas_numericas(serie), limpieza_original(serie))
+
+
+def test_limpiar_coordenadas_igual_que_original():
+    serie = pd.Series(VALORES, dtype=object)
+    esperado = serie.apply(limpiar_coordenada)
+    obtenido = limpiar_coordenadas(serie)
+    assert [None if pd.isna(v) else v for v in obtenido] == [None if pd.isna(v) else v for v in esperado]
+
+
+def test_mismas_filas_descartadas(tmp_path):
+    n = len(VALORES)
+    df = pd.DataFrame({'Latitud': VALORES, 'Longitud': VALORES[::-1]}, dtype=object)
+    esperado = df.assign(Lat_F=limpieza_original(df['Latitud']),
+                         Lon_F=limpieza_original(df['Longitud'])).dropna(subset=['Lat_F', 'Lon_F'])
+
+    lats, lons = coordenadas_numericas(df['Latitud']), coordenadas_numericas(df['Longitud'])
+    validas = ~(np.isnan(lats) | np.isnan(lons))
+    np.testing.assert_array_equal(np.flatnonzero(validas), esperado.index.to_numpy())
+    np.testing.assert_array_equal(lats[validas], esperado['Lat_F'].to_numpy())
+    np.testing.assert_array_equal(lons[validas], esperado['Lon_F'].to_numpy())
+
+    # Lectura desde archivo por bloques pequenos: mismas filas y valores
+    archivo = tmp_path / 'torres.csv'
+    pd.DataFrame({'Latitud': [limpiar_texto_csv(v) for v in VALORES],
+                  'Longitud': [limpiar_texto_csv(v) for v in VALORES[::-1]]}).to_csv(archivo, sep=';', index=False)
+    leido = pd.read_csv(archivo, sep=';', dtype=str, keep_default_na=False)
+    esperado = leido.assign(Lat_F=limpieza_original(leido['Latitud']),
+                            Lon_F=limpieza_original(leido['Longitud'])).dropna(subset=['Lat_F', 'Lon_F'])
+    bloques = list(leer_bloques_coordenadas(str(archivo), 'Latitud', 'Longitud', tam_bloque=7))
+    assert n > 7 and len(bloques) > 1
+    filas = np.concatenate([b[0] for b in bloques])
+    np.testing.assert_array_equal(filas, esperado.index.to_numpy())
+    np.testing.assert_array_equal(np.concatenate([b[1] for b in bloques]), esperado['Lat_F'].to_numpy())
+    np.testing.assert_array_equal(np.concatenate([b[2] for b in bloques]), esperado['Lon_F'].to_numpy())
+
+
+def limpiar_texto_csv(valor):
+    """Como quedaria el valor escrito en una celda de CSV (vacio para los nulos)."""
+    return '' if valor is None or valor is pd.NA or (isinstance(valor, float) and np.isnan(valor)) else str(valor)
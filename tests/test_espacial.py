@@ -0,0 +1,101 @@
+"""Busquedas del arbol KD esferico y del indice de torres contra fuerza bruta."""
+import numpy as np
+import pytest
+
+from espacial import ArbolEsferico, IndiceTorres
+from geometria import haversine, vincenty
+
+
+def puntos_aleatorios(n, semilla=0):
+    rng = np.random.default_rng(semilla)
+    # Incluye puntos cerca de los polos y a ambos lados del antimeridiano
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    lons = rng.uniform(-180, 180, n)
+    return lats, lons
+
+
+def cercanos_fuerza_bruta(lats, lons, lat, lon, k, radio_max=None, vivos=None):
+    distancias = haversine(np.full(len(lats), lat), np.full(len(lons), lon), lats, lons)
+    candidatos = np.arange(len(lats))
+    if vivos is not None:
+        candidatos = candidatos[vivos]
+    if radio_max is not None:
+        candidatos = candidatos[distancias[candidatos] <= radio_max]
+    orden = candidatos[np.argsort(distancias[candidatos], kind='stable')][:k]
+    return distancias[orden]
+
+
+@pytest.mark.parametrize('n', [0, 10, 100, 5000])
+@pytest.mark.parametrize('k', [1, 7, 64])
+def test_cercanos_coincide_con_fuerza_bruta(n, k):
+    lats, lons = puntos_aleatorios(n)
+    arbol = ArbolEsferico(lats, lons, tam_hoja=8)
+    for lat, lon in [(0, 0), (89.9, 10), (-45, 179.99), (10, -180)]:
+        puntos, distancias = arbol.cercanos(lat, lon, k)
+        esperado = cercanos_fuerza_bruta(lats, lons, lat, lon, k)
+        assert len(puntos) == len(esperado) == min(k, n)
+        np.testing.assert_allclose(distancias, esperado, rtol=1e-9, atol=1e-6)
+        np.testing.assert_allclose(
+            haversine(np.full(len(puntos), lat), np.full(len(puntos), lon), lats[puntos], lons[puntos]),
+            distancias, rtol=1e-9, atol=1e-6)
+
+
+def test_cercanos_con_radio_y_puntos_muertos():
+    lats, lons = puntos_aleatorios(3000, semilla=1)
+    arbol = ArbolEsferico(lats, lons)
+    vivos = np.random.default_rng(2).random(len(lats)) < 0.3
+    for radio in (5e5, 2e6):
+        puntos, distancias = arbol.cercanos(20, 30, 25, radio, vivos)
+        assert vivos[puntos].all()
+        np.testing.assert_allclose(distancias, cercanos_fuerza_bruta(lats, lons, 20, 30, 25, radio, vivos),
+                                   rtol=1e-9, atol=1e-6)
+
+
+def test_consultar_radio_coincide_con_fuerza_bruta():
+    lats, lons = puntos_aleatorios(2000, semilla=3)
+    arbol = ArbolEsferico(lats, lons)
+    qlats, qlons = puntos_aleatorios(50, semilla=4)
+    radios = np.linspace(1e5, 1.5e6, 50)
+    consultas, puntos, distancias = arbol.consultar_radio(qlats, qlons, radios, tam_lote=16)
+    encontrados = set(zip(consultas.tolist(), puntos.tolist()))
+    esperados = set()
+    for i in range(len(qlats)):
+        d = haversine(np.full(len(lats), qlats[i]), np.full(len(lons), qlons[i]), lats, lons)
+        esperados.update((i, j) for j in np.flatnonzero(d <= radios[i]).tolist())
+    assert encontrados == esperados
+    np.testing.assert_allclose(distancias, haversine(qlats[consultas], qlons[consultas],
+                                                     lats[puntos], lons[puntos]), rtol=1e-9, atol=1e-6)
+
+
+def test_indice_torres_incremental():
+    lats, lons = puntos_aleatorios(600, semilla=5)
+    torres = [{'id': i + 1, 'tipo': 'torre', 'lat': lat, 'lon': lon} for i, (lat, lon) in enumerate(zip(lats, lons))]
+    indice = IndiceTorres(minimo=50)
+    indice.reconstruir(torres + [{'id': 1000, 'tipo': 'etiqueta', 'lat': 0, 'lon': 0}])
+    rng = np.random.default_rng(6)
+    vigentes = {t['id']: t for t in torres}
+    for paso in range(120):
+        elemento_id = int(rng.integers(1, 700))
+        if paso % 3 == 0 and elemento_id in vigentes:
+            indice.quitar(elemento_id)
+            del vigentes[elemento_id]
+        else:
+            torre = {'id': elemento_id, 'tipo': 'torre', 'lat': float(rng.uniform(-60, 60)),
+                     'lon': float(rng.uniform(-180, 180))}
+            indice.insertar(torre)
+            vigentes[elemento_id] = torre
+        ids, distancias = indice.cercanas(5, 5, 10)
+        ids_vigentes = np.array(list(vigentes))
+        vlats = np.array([vigentes[i]['lat'] for i in ids_vigentes])
+        vlons = np.array([vigentes[i]['lon'] for i in ids_vigentes])
+        np.testing.assert_allclose(distancias, cercanos_fuerza_bruta(vlats, vlons, 5, 5, 10), rtol=1e-9, atol=1e-6)
+        assert set(ids.tolist()) <= set(vigentes)
+
+
+def test_haversine_y_vincenty():
+    # Un grado de meridiano en el ecuador y dos ciudades de referencia
+    assert haversine(0.0, 0.0, 1.0, 0.0) == pytest.approx(111194.9, abs=0.1)
+    assert vincenty(0.0, 0.0, 1.0, 0.0) == pytest.approx(110574.4, abs=0.5)
+    caracas, maracaibo = (10.4806, -66.9036), (10.6427, -71.6125)
+    assert vincenty(*caracas, *maracaibo) == pytest.approx(haversine(*caracas, *maracaibo), rel=5e-3)
+    assert haversine(*caracas, *caracas) == 0
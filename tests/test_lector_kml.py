@@ -0,0 +1,107 @@
+"""Lector incremental de KML/KMZ (lector_kml)."""
+import zipfile
+
+import pytest
+
+from lector_kml import LectorKML, abrir_kml, parsear_coordenadas
+
+KML = '''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+  <Style id="torre"><IconStyle><Icon><href>images/torre.png</href></Icon></IconStyle></Style>
+  <StyleMap id="mapa_torre">
+    <Pair><key>normal</key><styleUrl>#torre</styleUrl></Pair>
+    <Pair><key>highlight</key><styleUrl>#otro</styleUrl></Pair>
+  </StyleMap>
+  <StyleMap id="mapa_en_linea">
+    <Pair><key>normal</key><Style><IconStyle><Icon><href>images/antena.png</href></Icon></IconStyle></Style></Pair>
+  </StyleMap>
+  <Folder>
+    <name>Zona Norte</name>
+    <Folder>
+      <name>Torres</name>
+      <Placemark>
+        <name> T1 </name>
+        <description>Sitio principal</description>
+        <styleUrl>#mapa_torre</styleUrl>
+        <Point><coordinates>-66.9,10.5,0</coordinates></Point>
+      </Placemark>
+    </Folder>
+    <Placemark>
+      <name>Ruta</name>
+      <LineString><coordinates>-66.9,10.5 -67.0,10.6 -67.1,10.7</coordinates></LineString>
+    </Placemark>
+  </Folder>
+  <Placemark>
+    <name>Area</name>
+    <styleUrl>otro.kml#mapa_en_linea</styleUrl>
+    <MultiGeometry>
+      <Polygon>
+        <outerBoundaryIs><LinearRing><coordinates>0,0 0,1 1,1 0,0</coordinates></LinearRing></outerBoundaryIs>
+        <innerBoundaryIs><LinearRing><coordinates>0.2,0.2 0.2,0.3 0.3,0.3 0.2,0.2</coordinates></LinearRing></innerBoundaryIs>
+      </Polygon>
+      <Point><coordinates>0.5,0.5</coordinates></Point>
+    </MultiGeometry>
+  </Placemark>
+  <Placemark>
+    <name>Propio</name>
+    <Style><IconStyle><Icon><href>http://ejemplo.com/icono.png</href></Icon></IconStyle></Style>
+    <Point><coordinates>1,2</coordinates></Point>
+  </Placemark>
+  <Placemark><name>Vacio</name><Point><coordinates></coordinates></Point></Placemark>
+</Document>
+</kml>
+'''
+
+
+@pytest.fixture(params=['.kml', '.kmz'])
+def archivo(request, tmp_path):
+    ruta = tmp_path / f'mapa{request.param}'
+    if request.param == '.kml':
+        ruta.write_text(KML, encoding='utf-8')
+    else:
+        with zipfile.ZipFile(ruta, 'w') as kmz:
+            kmz.writestr('images/torre.png', b'png')
+            kmz.writestr('doc.kml', KML)
+    return str(ruta)
+
+
+def test_lee_placemarks_estilos_y_carpetas(archivo):
+    with abrir_kml(archivo) as fuente:
+        lector = LectorKML(fuente)
+        placemarks = list(lector)
+
+    assert [(p['tipo'], p['nombre']) for p in placemarks] == [
+        ('punto', 'T1'), ('linea', 'Ruta'), ('poligono', 'Area'), ('punto', 'Area'), ('punto', 'Propio')]
+    torre, ruta, area, centro, propio = placemarks
+    assert (torre['lat'], torre['lon']) == (10.5, -66.9)
+    assert torre['carpeta'] == 'Zona Norte/Torres' and torre['desc'] == 'Sitio principal'
+    assert torre['style_url'] == 'mapa_torre'
+    assert ruta['carpeta'] == 'Zona Norte'
+    assert ruta['coords'] == [(10.5, -66.9), (10.6, -67.0), (10.7, -67.1)]
+    assert area['carpeta'] == '' and area['style_url'] == 'mapa_en_linea'
+    assert area['coords'][1] == (1.0, 0.0) and len(area['huecos']) == 1
+    assert (centro['lat'], centro['lon']) == (0.5, 0.5)
+    assert propio['icono_href'] == 'http://ejemplo.com/icono.png'
+
+    assert lector.estilos == {'torre': 'images/torre.png'}
+    assert lector.style_maps == {'mapa_torre': 'images/torre.png', 'mapa_en_linea': 'images/antena.png'}
+
+
+def test_abrir_kml_rechaza_otros_archivos(tmp_path):
+    kmz = tmp_path / 'vacio.kmz'
+    with zipfile.ZipFile(kmz, 'w') as z:
+        z.writestr('leeme.txt', 'nada')
+    with pytest.raises(ValueError):
+        with abrir_kml(str(kmz)):
+            pass
+    with pytest.raises(ValueError):
+        with abrir_kml(str(tmp_path / 'mapa.geojson')):
+            pass
+
+
+def test_parsear_coordenadas():
+    assert parsear_coordenadas('1,2 3,4,5') == [(2.0, 1.0), (4.0, 3.0)]
+    assert parsear_coordenadas('1,2,0\n 3,4,0 ') == [(2.0, 1.0), (4.0, 3.0)]
+    assert parsear_coordenadas('1,2 x,4 5') == [(2.0, 1.0)]
+    assert parsear_coordenadas(None) == [] and parsear_coordenadas('  ') == []
@@ -0,0 +1,67 @@
+"""Lotes atomicos del almacen (aplicar_lote) y de /api/lote."""
+import pytest
+
+from almacen import AlmacenMapa, LoteRechazado
+
+
+@pytest.fixture
+def almacen(tmp_path):
+    almacen = AlmacenMapa(str(tmp_path / 'elementos.json'), str(tmp_path / 'capas.json'), retardo=0)
+    yield almacen
+    almacen.guardar()
+
+
+def test_lote_rechazado_no_deja_rastro(almacen):
+    existente = almacen.agregar({'tipo': 'etiqueta', 'lat': 1, 'lon': 2})
+    antes = [dict(e) for e in almacen.elementos()]
+    with pytest.raises(LoteRechazado) as error:
+        almacen.aplicar_lote([
+            {'op': 'agregar', 'elemento': {'tipo': 'torre', 'lat': 1, 'lon': 1}},
+            {'op': 'agregar_capa', 'capa': {'nombre': 'Caso'}},
+            {'op': 'actualizar', 'id': existente['id'], 'cambios': {'color': '#000000'}},
+            {'op': 'actualizar', 'id': 999, 'cambios': {'color': '#000000'}},
+        ])
+    assert error.value.posicion == 3
+    assert [dict(e) for e in almacen.elementos()] == antes
+    assert almacen.capas() == []
+    assert almacen.siguiente_id() == existente['id'] + 1
+    assert almacen.siguiente_id_capa() == 1
+    assert almacen.agregar({'tipo': 'torre', 'lat': 0, 'lon': 0})['id'] == existente['id'] + 1
+
+
+def test_lote_se_deshace_en_un_paso(almacen):
+    resultados = almacen.aplicar_lote([
+        {'op': 'agregar', 'elemento': {'tipo': 'torre', 'lat': 1, 'lon': 1}},
+        {'op': 'agregar', 'elemento': {'tipo': 'torre', 'lat': 2, 'lon': 2}},
+        {'op': 'eliminar', 'id': 999},
+    ])
+    assert [r['id'] for r in resultados[:2]] == [1, 2] and resultados[2] is None
+    almacen.deshacer()
+    assert almacen.elementos() == []
+
+
+def test_api_lote_actualiza_solo_campos_del_tipo(almacen, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'almacen', almacen)
+    ruta = almacen.agregar({'tipo': 'ruta', 'puntos': [[0, 0], [1, 1]], 'color': '#FF0000', 'grosor': 3})
+    etiqueta = almacen.agregar({'tipo': 'etiqueta', 'lat': 1, 'lon': 2, 'texto': 'A', 'color': '#000000'})
+    torre = almacen.agregar({'tipo': 'torre', 'lat': 1, 'lon': 2, 'radio': 500})
+    campos = {'color': '#123456', 'radio': 900, 'lat': 5, 'lon': 6, 'azimuts': [0, 90], 'grosor': 7, 'nombre': 'X'}
+    respuesta = app.app.test_client().post('/api/lote', json={'operaciones': [
+        {'op': 'actualizar', 'id': i, **campos} for i in (ruta['id'], etiqueta['id'], torre['id'])]})
+    assert respuesta.status_code == 200
+    ruta, etiqueta, torre = respuesta.json['elementos']
+    assert (ruta['color'], ruta['grosor'], ruta['nombre']) == ('#123456', 7, 'X')
+    assert 'radio' not in ruta and 'lat' not in ruta and 'azimuts' not in ruta
+    assert (etiqueta['color'], etiqueta['lat'], etiqueta['lon']) == ('#123456', 1, 2)
+    assert 'radio' not in etiqueta and 'azimuts' not in etiqueta and 'grosor' not in etiqueta
+    assert (torre['radio'], torre['lat'], torre['azimuts'], torre['grosor']) == (900, 5.0, [0.0, 90.0], 7)
+
+
+def test_api_lote_elemento_inexistente(almacen, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'almacen', almacen)
+    respuesta = app.app.test_client().post('/api/lote', json={'operaciones': [
+        {'op': 'agregar', 'tipo': 'torre', 'lat': 1, 'lon': 1}, {'op': 'actualizar', 'id': 99, 'color': '#000000'}]})
+    assert respuesta.status_code == 404 and respuesta.json['posicion'] == 1
+    assert almacen.elementos() == []
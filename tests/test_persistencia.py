@@ -0,0 +1,107 @@
+"""Persistencia del almacen: diario de operaciones, SQLite e importaciones que reemplazan la instantanea."""
+import os
+
+import pytest
+
+from almacen import (AlmacenMapa, AlmacenSQLite, escribir_json, leer_json, migrar_json_a_sqlite,
+                     reemplazar_instantanea)
+
+
+@pytest.fixture
+def rutas(tmp_path):
+    return str(tmp_path / 'elementos.json'), str(tmp_path / 'capas.json'), str(tmp_path / 'diario.jsonl')
+
+
+def test_importacion_descarta_el_diario(rutas):
+    elementos, capas, diario = rutas
+    almacen = AlmacenMapa(elementos, capas, diario=diario)
+    almacen.agregar({'tipo': 'torre', 'lat': 1, 'lon': 1})
+    almacen.agregar_capa({'nombre': 'Previa'})
+    almacen.eliminar(1)
+    reemplazar_instantanea([{'id': 1, 'tipo': 'etiqueta', 'lat': 2, 'lon': 2}], archivo_elementos=elementos,
+                           archivo_capas=capas, diario=diario)
+    almacen.descartar()
+    nuevo = AlmacenMapa(elementos, capas, diario=diario)
+    assert [e['tipo'] for e in nuevo.elementos()] == ['etiqueta']
+    # Los cambios de capas del diario se conservan al reemplazar solo los elementos
+    assert [c['nombre'] for c in nuevo.capas()] == ['Previa']
+
+
+def test_deshacer_actualizar_capa_quita_claves_nuevas(rutas):
+    elementos, capas, _ = rutas
+    almacen = AlmacenMapa(elementos, capas, retardo=0)
+    capa = almacen.agregar_capa({'nombre': 'Norte', 'color': '#FF0000'})
+    almacen.actualizar_capa(capa['id'], {'color': '#00FF00', 'opacidad': 0.5})
+    almacen.deshacer()
+    assert almacen.capas() == [{'id': capa['id'], 'nombre': 'Norte', 'color': '#FF0000'}]
+    almacen.rehacer()
+    assert almacen.capas()[0]['opacidad'] == 0.5
+    almacen.guardar()
+
+
+def test_diario_se_reproduce_al_reabrir(rutas):
+    elementos, capas, diario = rutas
+    almacen = AlmacenMapa(elementos, capas, diario=diario)
+    capa = almacen.agregar_capa({'nombre': 'Sur'})
+    torre = almacen.agregar({'tipo': 'torre', 'lat': 1, 'lon': 1, 'capa': capa['id']})
+    almacen.actualizar(torre['id'], {'radio': 800})
+    almacen.agregar({'tipo': 'etiqueta', 'lat': 2, 'lon': 2})
+    almacen.eliminar(torre['id'] + 1)
+    esperado = [dict(e) for e in almacen.elementos()], almacen.capas()
+    almacen.descartar()
+    # Una ultima linea a medio escribir por un cierre abrupto se ignora
+    with open(diario, 'a', encoding='utf-8') as f:
+        f.write('{"op": "agregar", "elem')
+    for _ in range(2):
+        reabierto = AlmacenMapa(elementos, capas, diario=diario)
+        assert ([dict(e) for e in reabierto.elementos()], reabierto.capas()) == esperado
+        assert reabierto.siguiente_id() == torre['id'] + 2
+        reabierto.descartar()
+
+
+def test_compactar_vacia_el_diario(rutas):
+    elementos, capas, diario = rutas
+    almacen = AlmacenMapa(elementos, capas, diario=diario, compactar_cada=3)
+    for i in range(4):
+        almacen.agregar({'tipo': 'torre', 'lat': i, 'lon': i})
+    with open(diario, encoding='utf-8') as f:
+        assert len(f.readlines()) == 1
+    assert len(leer_json(elementos)) == 3
+    almacen.guardar()
+    assert not os.path.exists(diario)
+    assert [e['id'] for e in leer_json(elementos)] == [1, 2, 3, 4]
+
+
+def test_sqlite_migra_json_y_persiste_operaciones(rutas, tmp_path):
+    elementos, capas, _ = rutas
+    escribir_json(elementos, [{'id': 1, 'tipo': 'torre', 'lat': 1, 'lon': 1, 'capa': 1},
+                              {'id': 5, 'tipo': 'ruta', 'puntos': [[0, 0], [1, 1]], 'capa': 1}])
+    escribir_json(capas, [{'id': 1, 'nombre': 'Base'}])
+    db = str(tmp_path / 'mapa.sqlite3')
+    assert migrar_json_a_sqlite(db, elementos, capas) == (2, 1)
+
+    almacen = AlmacenSQLite(db, elementos, capas)
+    assert almacen.siguiente_id() == 6
+    almacen.actualizar(1, {'radio': 300})
+    almacen.agregar({'tipo': 'etiqueta', 'lat': 3, 'lon': 3})
+    almacen.eliminar_capa(1)
+    esperado = [dict(e) for e in almacen.elementos()], almacen.capas()
+    almacen.descartar()
+
+    reabierto = AlmacenSQLite(db, elementos, capas)
+    assert ([dict(e) for e in reabierto.elementos()], reabierto.capas()) == esperado
+    assert reabierto.obtener(1)['radio'] == 300
+    assert all(e['capa'] is None for e in reabierto.elementos() if e['id'] != 6)
+    reabierto.descartar()
+
+
+def test_sqlite_vuelve_a_migrar_json_mas_reciente(rutas, tmp_path):
+    elementos, capas, _ = rutas
+    escribir_json(elementos, [{'id': 1, 'tipo': 'torre', 'lat': 1, 'lon': 1}])
+    db = str(tmp_path / 'mapa.sqlite3')
+    migrar_json_a_sqlite(db, elementos, capas)
+    escribir_json(elementos, [{'id': 7, 'tipo': 'etiqueta', 'lat': 2, 'lon': 2}])
+    os.utime(elementos, (os.path.getmtime(elementos) + 10,) * 2)
+    almacen = AlmacenSQLite(db, elementos, capas)
+    assert [e['id'] for e in almacen.elementos()] == [7]
+    almacen.descartar()
@@ -0,0 +1,39 @@
+"""Limite de flujos SSE simultaneos de /api/stream."""
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def cliente(monkeypatch):
+    monkeypatch.setattr(app, '_flujos_sse', threading.BoundedSemaphore(2))
+    return app.app.test_client()
+
+
+def test_limite_de_flujos(cliente):
+    primero = cliente.get('/api/stream', buffered=False)
+    segundo = cliente.get('/api/stream', buffered=False)
+    assert primero.status_code == segundo.status_code == 200
+    assert next(primero.response).startswith(b'retry:')
+
+    rechazado = cliente.get('/api/stream', buffered=False)
+    assert rechazado.status_code == 503
+    assert rechazado.headers['Retry-After']
+
+    # Cerrar un flujo libera su plaza
+    primero.close()
+    tercero = cliente.get('/api/stream', buffered=False)
+    assert tercero.status_code == 200
+    segundo.close()
+    tercero.close()
+    assert app._flujos_sse.acquire(blocking=False) and app._flujos_sse.acquire(blocking=False)
+
+
+def test_desde_invalido_no_ocupa_plaza(cliente):
+    assert cliente.get('/api/stream?desde=x').status_code == 400
+    abiertos = [cliente.get('/api/stream', buffered=False) for _ in range(2)]
+    assert [r.status_code for r in abiertos] == [200, 200]
+    for respuesta in abiertos:
+        respuesta.close()